@@ -23,27 +23,64 @@ import datetime
 import logging
 import os
 import sys
+import time
+
+from functools import partial
 
 from openstack import connection, exceptions
 
-from sqlalchemy import and_, MetaData, select, Table, create_engine
+from sqlalchemy import and_, cast, literal, select, union_all, create_engine, String
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
+from helper.check_runner import Check, run_checks
+from helper.consistency_daemon import ConsistencyDaemon
+from helper.db_batch import DEFAULT_BATCH_SIZE, iter_partitions, soft_delete_cascade, soft_delete_rows
+from helper.db_purge import DbPurger
+from helper.db_schema import get_table, load_metadata, save_metadata
+from helper.findings_report import FindingsReport, get_finding_writer, log_findings
+from helper.inventory import DEFAULT_PAGE_SIZE, drop_temp_table, fetch_uuid_inventory, fetch_uuid_inventory_db, get_nova_cell_db_urls, \
+    load_uuid_temp_table
+from helper.prometheus_exporter import prometheus_push
+from helper.watermark import DEFAULT_FULL_SWEEP_EVERY, WatermarkState, deleted_since_condition, get_deleted_watermarks
 
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)-15s %(message)s')
 
 
-# get all instances from nova
-def get_nova_instances(conn):
+# get the uuids of all instances straight from the nova cell dbs found via the cell_mappings in the nova api db
+# - with the read-only credentials of the cell db url template if given
+def get_nova_instances_db(nova_api_db_url, nova_cell_db_url_template=None):
+
+    if not nova_cell_db_url_template:
+        log.warn("- no nova cell db url template given - reading the nova cell dbs with the read-write credentials "
+                 "of nova from the cell mappings")
+    sources = [(cell_db_url, "SELECT uuid FROM instances WHERE deleted = 0")
+               for cell_db_url in get_nova_cell_db_urls(nova_api_db_url, nova_cell_db_url_template).values()]
+    # instances which are not scheduled to a cell yet only exist as build requests in the api db
+    sources.append((nova_api_db_url, "SELECT instance_uuid FROM build_requests"))
+    return fetch_uuid_inventory_db(sources, 'nova instance')
+
+
+# get the uuids of all instances from nova - from the nova dbs if a nova api db url is given and from the api otherwise
+def get_nova_instances(conn, page_size=DEFAULT_PAGE_SIZE, nova_api_db_url=None, nova_cell_db_url_template=None):
 
-    nova_instances = dict()
+    if nova_api_db_url:
+        try:
+            nova_instances = get_nova_instances_db(nova_api_db_url, nova_cell_db_url_template)
+            if nova_instances:
+                return nova_instances
+            log.warn("- did not get any nova instances back from the nova dbs - falling back to the nova api")
+        except SQLAlchemyError as e:
+            log.warn("- could not read the nova instances from the nova dbs - falling back to the nova api: %s", str(e))
+
+    # get all instance from nova page by page, only keeping their uuids
+    def list_page(marker, limit):
+        return conn.compute.servers(details=False, all_projects=1, limit=limit, marker=marker, paginated=False)
 
-    # get all instance from nova
     try:
-        for nova_instance in conn.compute.servers(details=False, all_projects=1):
-            nova_instances[nova_instance.id] = nova_instance
+        nova_instances = fetch_uuid_inventory(list_page, 'nova instance', page_size)
         if not nova_instances:
             raise RuntimeError('- PLEASE CHECK MANUALLY - did not get any nova instances back from the nova api - this should in theory never happen ...')
 
@@ -55,9 +92,6 @@ def get_nova_instances(conn):
         log.warn("- PLEASE CHECK MANUALLY - got an sdk exception connecting to openstack: %s", str(e))
         sys.exit(1)
 
-    # for i in nova_instances:
-    #     print nova_instances[i].id
-
     if not nova_instances:
         raise RuntimeError('Did not get any nova instances back.')
 
@@ -68,7 +102,7 @@ def get_nova_instances(conn):
 def get_orphan_volume_attachments(meta):
 
     orphan_volume_attachments = {}
-    orphan_volume_attachment_t = Table('volume_attachment', meta, autoload=True)
+    orphan_volume_attachment_t = get_table(meta, 'volume_attachment')
     columns = [orphan_volume_attachment_t.c.id, orphan_volume_attachment_t.c.instance_uuid]
     orphan_volume_attachment_q = select(columns=columns, whereclause=and_(orphan_volume_attachment_t.c.deleted == 0))
 
@@ -80,337 +114,462 @@ def get_orphan_volume_attachments(meta):
 
 
 # get all the volume attachments in the cinder db for already deleted instances in nova
-def get_wrong_orphan_volume_attachments(nova_instances, orphan_volume_attachments):
+def get_wrong_orphan_volume_attachments(nova_instances, orphan_volume_attachments, limit=None, on_finding=None):
 
     wrong_orphan_volume_attachments = {}
 
     for orphan_volume_attachment_id in orphan_volume_attachments:
-        if nova_instances.get(orphan_volume_attachments[orphan_volume_attachment_id]) is None:
+        if orphan_volume_attachments[orphan_volume_attachment_id] not in nova_instances:
             wrong_orphan_volume_attachments[orphan_volume_attachment_id] = orphan_volume_attachments[orphan_volume_attachment_id]
+            if on_finding:
+                on_finding(orphan_volume_attachment_id, orphan_volume_attachments[orphan_volume_attachment_id])
+            if limit and len(wrong_orphan_volume_attachments) >= limit:
+                break
 
     return wrong_orphan_volume_attachments
 
 
-# delete volume attachments in the cinder db for already deleted instances in nova
-def fix_wrong_orphan_volume_attachments(meta, wrong_orphan_volume_attachments, fix_limit):
+# get all the volume attachments in the cinder db for already deleted instances in nova via an anti-join
+# in the db against the nova instance uuids loaded into a temporary table - only the orphans are returned
+def get_wrong_orphan_volume_attachments_db(meta, nova_instances, batch_size=DEFAULT_BATCH_SIZE, limit=None, on_finding=None):
+
+    wrong_orphan_volume_attachments = {}
+    volume_attachment_t = get_table(meta, 'volume_attachment')
+
+    with meta.bind.connect() as conn:
+        nova_instances_t = load_uuid_temp_table(conn, 'nanny_nova_instances', nova_instances, batch_size)
+        try:
+            attachment_join = volume_attachment_t.outerjoin(nova_instances_t, volume_attachment_t.c.instance_uuid == nova_instances_t.c.uuid)
+            columns = [volume_attachment_t.c.id, volume_attachment_t.c.instance_uuid]
+            # attachments created after the nova instances were listed might belong to instances not in the list yet
+            wrong_orphan_volume_attachment_q = select(columns=columns).select_from(attachment_join).\
+                where(and_(volume_attachment_t.c.deleted == 0, nova_instances_t.c.uuid.is_(None),
+                           volume_attachment_t.c.created_at < nova_instances.fetched_at))
+            if limit:
+                wrong_orphan_volume_attachment_q = wrong_orphan_volume_attachment_q.limit(limit)
+
+            # return a dict indexed by orphan_volume_attachment_id and with the value nova_instance_uuid for non deleted orphan_volume_attachments
+            for (orphan_volume_attachment_id, nova_instance_uuid) in conn.execute(wrong_orphan_volume_attachment_q):
+                wrong_orphan_volume_attachments[orphan_volume_attachment_id] = nova_instance_uuid
+                if on_finding:
+                    on_finding(orphan_volume_attachment_id, nova_instance_uuid)
+        finally:
+            drop_temp_table(conn, nova_instances_t)
+
+    return wrong_orphan_volume_attachments
+
+
+# delete volume attachments in the cinder db for already deleted instances in nova - return whether they have been fixed
+def fix_wrong_orphan_volume_attachments(meta, wrong_orphan_volume_attachments, fix_limit, batch_size=DEFAULT_BATCH_SIZE):
 
     if len(wrong_orphan_volume_attachments) <= int(fix_limit):
 
-        orphan_volume_attachment_t = Table('volume_attachment', meta, autoload=True)
+        orphan_volume_attachment_t = get_table(meta, 'volume_attachment')
 
-        for orphan_volume_attachment_id in wrong_orphan_volume_attachments:
-            log.info("-- action: deleting orphan volume attachment id: %s", orphan_volume_attachment_id)
-            now = datetime.datetime.utcnow()
-            delete_orphan_volume_attachment_q = orphan_volume_attachment_t.update().\
-                where(orphan_volume_attachment_t.c.id == orphan_volume_attachment_id).values(updated_at=now, deleted_at=now, deleted=1)
-            delete_orphan_volume_attachment_q.execute()
+        log.info("-- action: deleting %s orphan volume attachments", len(wrong_orphan_volume_attachments))
+        soft_delete_rows(meta.bind, orphan_volume_attachment_t, wrong_orphan_volume_attachments, batch_size)
 
     else:
         log.warn("- PLEASE CHECK MANUALLY - too many (more than %s) wrong orphan volume attachments - denying to fix them automatically", str(fix_limit))
+        return False
+
+    return True
 
 
 # get all the volumes in state "error_deleting"
-def get_error_deleting_volumes(meta):
+def get_error_deleting_volumes(meta, on_finding=None):
 
     error_deleting_volumes = []
 
-    volumes_t = Table('volumes', meta, autoload=True)
+    volumes_t = get_table(meta, 'volumes')
     error_deleting_volumes_q = select(columns=[volumes_t.c.id]).where(and_(volumes_t.c.status == "error_deleting", volumes_t.c.deleted == 0))
 
     # convert the query result into a list
     for i in error_deleting_volumes_q.execute():
         error_deleting_volumes.append(i[0])
+        if on_finding:
+            on_finding(i[0])
 
     return error_deleting_volumes
 
 
 # delete all the volumes in state "error_deleting"
-def fix_error_deleting_volumes(meta, error_deleting_volumes):
-
-    volumes_t = Table('volumes', meta, autoload=True)
-    volume_attachment_t = Table('volume_attachment', meta, autoload=True)
-    volume_metadata_t = Table('volume_metadata', meta, autoload=True)
-    volume_admin_metadata_t = Table('volume_admin_metadata', meta, autoload=True)
-
-    for error_deleting_volumes_id in error_deleting_volumes:
-        now = datetime.datetime.utcnow()
-        log.info("-- action: deleting possible volume admin metadata for volume id: %s", error_deleting_volumes_id)
-        delete_volume_admin_metadata_q = volume_admin_metadata_t.update().\
-            where(volume_admin_metadata_t.c.volume_id == error_deleting_volumes_id).values(updated_at=now, deleted_at=now, deleted=1)
-        delete_volume_admin_metadata_q.execute()
-        log.info("-- action: deleting possible volume metadata for volume id: %s", error_deleting_volumes_id)
-        delete_volume_metadata_q = volume_metadata_t.update().\
-            where(volume_metadata_t.c.volume_id == error_deleting_volumes_id).values(updated_at=now, deleted_at=now, deleted=1)
-        delete_volume_metadata_q.execute()
-        log.info("-- action: deleting possible volume attachments for volume id: %s", error_deleting_volumes_id)
-        delete_volume_attachment_q = volume_attachment_t.update().\
-            where(volume_attachment_t.c.volume_id == error_deleting_volumes_id).values(updated_at=now, deleted_at=now, deleted=1)
-        delete_volume_attachment_q.execute()
-        log.info("-- action: deleting volume id: %s", error_deleting_volumes_id)
-        delete_volume_q = volumes_t.update().\
-            where(volumes_t.c.id == error_deleting_volumes_id).values(updated_at=now, deleted_at=now, deleted=1)
-        delete_volume_q.execute()
+def fix_error_deleting_volumes(meta, error_deleting_volumes, batch_size=DEFAULT_BATCH_SIZE):
+
+    volumes_t = get_table(meta, 'volumes')
+    volume_attachment_t = get_table(meta, 'volume_attachment')
+    volume_metadata_t = get_table(meta, 'volume_metadata')
+    volume_admin_metadata_t = get_table(meta, 'volume_admin_metadata')
+
+    # the children of the volumes first and the volumes last, all in one transaction per chunk of volumes
+    cascade_steps = [
+        (volume_admin_metadata_t, volume_admin_metadata_t.c.volume_id),
+        (volume_metadata_t, volume_metadata_t.c.volume_id),
+        (volume_attachment_t, volume_attachment_t.c.volume_id),
+        (volumes_t, volumes_t.c.id),
+    ]
+    log.info("-- action: deleting %s volumes together with their admin metadata, metadata and attachments", len(error_deleting_volumes))
+    soft_delete_cascade(meta.bind, cascade_steps, error_deleting_volumes, batch_size)
 
 
 # get all the snapshots in state "error_deleting"
-def get_error_deleting_snapshots(meta):
+def get_error_deleting_snapshots(meta, on_finding=None):
 
     error_deleting_snapshots = []
 
-    snapshots_t = Table('snapshots', meta, autoload=True)
+    snapshots_t = get_table(meta, 'snapshots')
     error_deleting_snapshots_q = select(columns=[snapshots_t.c.id]).where(and_(snapshots_t.c.status == "error_deleting", snapshots_t.c.deleted == 0))
 
     # convert the query result into a list
     for i in error_deleting_snapshots_q.execute():
         error_deleting_snapshots.append(i[0])
+        if on_finding:
+            on_finding(i[0])
 
     return error_deleting_snapshots
 
 
 # delete all the snapshots in state "error_deleting"
-def fix_error_deleting_snapshots(meta, error_deleting_snapshots):
+def fix_error_deleting_snapshots(meta, error_deleting_snapshots, batch_size=DEFAULT_BATCH_SIZE):
 
-    snapshots_t = Table('snapshots', meta, autoload=True)
+    snapshots_t = get_table(meta, 'snapshots')
 
-    for error_deleting_snapshots_id in error_deleting_snapshots:
-        log.info("-- action: deleting snapshot id: %s", error_deleting_snapshots_id)
-        now = datetime.datetime.utcnow()
-        delete_snapshot_q = snapshots_t.update().\
-            where(snapshots_t.c.id == error_deleting_snapshots_id).values(updated_at=now, deleted_at=now, deleted=1)
-        delete_snapshot_q.execute()
+    log.info("-- action: deleting %s snapshots", len(error_deleting_snapshots))
+    soft_delete_rows(meta.bind, snapshots_t, error_deleting_snapshots, batch_size)
 
 
 # get all the rows with a volume_admin_metadata still defined where the corresponding volume is already deleted
-def get_wrong_volume_admin_metadata(meta):
+def get_wrong_volume_admin_metadata(meta, deleted_since=None, on_finding=None):
 
     wrong_admin_metadata = {}
-    volume_admin_metadata_t = Table('volume_admin_metadata', meta, autoload=True)
-    volumes_t = Table('volumes', meta, autoload=True)
+    volume_admin_metadata_t = get_table(meta, 'volume_admin_metadata')
+    volumes_t = get_table(meta, 'volumes')
     admin_metadata_join = volume_admin_metadata_t.join(volumes_t, volume_admin_metadata_t.c.volume_id == volumes_t.c.id)
     columns = [volumes_t.c.id, volumes_t.c.deleted, volume_admin_metadata_t.c.id, volume_admin_metadata_t.c.deleted]
     wrong_volume_admin_metadata_q = select(columns=columns).select_from(admin_metadata_join).\
         where(and_(volumes_t.c.deleted == 1, volume_admin_metadata_t.c.deleted == 0))
+    if deleted_since:
+        wrong_volume_admin_metadata_q = wrong_volume_admin_metadata_q.where(deleted_since_condition(volumes_t, deleted_since))
 
     # return a dict indexed by volume_admin_metadata_id and with the value volume_id for non deleted volume_admin_metadata
     for (volume_id, volume_deleted, volume_admin_metadata_id, volume_admin_metadata_deleted) in wrong_volume_admin_metadata_q.execute():
         wrong_admin_metadata[volume_admin_metadata_id] = volume_id
+        if on_finding:
+            on_finding(volume_admin_metadata_id, volume_id)
     return wrong_admin_metadata
 
 
 # delete volume_admin_metadata still defined where the corresponding volume is already deleted
-def fix_wrong_volume_admin_metadata(meta, wrong_admin_metadata):
+def fix_wrong_volume_admin_metadata(meta, wrong_admin_metadata, batch_size=DEFAULT_BATCH_SIZE):
 
-    volume_admin_metadata_t = Table('volume_admin_metadata', meta, autoload=True)
+    volume_admin_metadata_t = get_table(meta, 'volume_admin_metadata')
 
-    for volume_admin_metadata_id in wrong_admin_metadata:
-        log.info("-- action: deleting volume_admin_metadata id: %s", volume_admin_metadata_id)
-        now = datetime.datetime.utcnow()
-        delete_volume_admin_metadata_q = volume_admin_metadata_t.update().\
-            where(volume_admin_metadata_t.c.id == volume_admin_metadata_id).values(updated_at=now, deleted_at=now, deleted=1)
-        delete_volume_admin_metadata_q.execute()
+    log.info("-- action: deleting %s volume_admin_metadata entries", len(wrong_admin_metadata))
+    soft_delete_rows(meta.bind, volume_admin_metadata_t, wrong_admin_metadata, batch_size)
 
 
 # get all the rows with a volume_glance_metadata still defined where the corresponding volume is already deleted
-def get_wrong_volume_glance_metadata_volumes(meta):
+def get_wrong_volume_glance_metadata_volumes(meta, deleted_since=None, on_finding=None):
 
     wrong_glance_metadata = {}
-    volume_glance_metadata_t = Table('volume_glance_metadata', meta, autoload=True)
-    volumes_t = Table('volumes', meta, autoload=True)
+    volume_glance_metadata_t = get_table(meta, 'volume_glance_metadata')
+    volumes_t = get_table(meta, 'volumes')
     glance_metadata_join = volume_glance_metadata_t.join(volumes_t, volume_glance_metadata_t.c.volume_id == volumes_t.c.id)
     columns = [volumes_t.c.id, volumes_t.c.deleted, volume_glance_metadata_t.c.id, volume_glance_metadata_t.c.deleted]
     wrong_volume_glance_metadata_q = select(columns=columns).select_from(glance_metadata_join).\
         where(and_(volumes_t.c.deleted == 1, volume_glance_metadata_t.c.deleted == 0))
+    if deleted_since:
+        wrong_volume_glance_metadata_q = wrong_volume_glance_metadata_q.where(deleted_since_condition(volumes_t, deleted_since))
 
     # return a dict indexed by volume_glance_metadata_id and with the value volume_id for non deleted volume_glance_metadata
     for (volume_id, volume_deleted, volume_glance_metadata_id, volume_glance_metadata_deleted) in wrong_volume_glance_metadata_q.execute():
         wrong_glance_metadata[volume_glance_metadata_id] = volume_id
+        if on_finding:
+            on_finding(volume_glance_metadata_id, volume_id)
     return wrong_glance_metadata
 
 
 # delete volume_glance_metadata still defined where the corresponding volume is already deleted
-def fix_wrong_volume_glance_metadata_volumes(meta, wrong_glance_metadata):
+def fix_wrong_volume_glance_metadata_volumes(meta, wrong_glance_metadata, batch_size=DEFAULT_BATCH_SIZE):
 
-    volume_glance_metadata_t = Table('volume_glance_metadata', meta, autoload=True)
+    volume_glance_metadata_t = get_table(meta, 'volume_glance_metadata')
 
-    for volume_glance_metadata_id in wrong_glance_metadata:
-        log.info("-- action: deleting volume_glance_metadata id (volume): %s", volume_glance_metadata_id)
-        now = datetime.datetime.utcnow()
-        delete_volume_glance_metadata_q = volume_glance_metadata_t.update().\
-            where(volume_glance_metadata_t.c.id == volume_glance_metadata_id).values(updated_at=now, deleted_at=now, deleted=1)
-        delete_volume_glance_metadata_q.execute()
+    log.info("-- action: deleting %s volume_glance_metadata entries (volume)", len(wrong_glance_metadata))
+    soft_delete_rows(meta.bind, volume_glance_metadata_t, wrong_glance_metadata, batch_size)
 
 
 # get all the rows with a volume_glance_metadata still defined where the corresponding snapshot is already deleted
-def get_wrong_volume_glance_metadata_snapshots(meta):
+def get_wrong_volume_glance_metadata_snapshots(meta, deleted_since=None, on_finding=None):
 
     wrong_glance_metadata = {}
-    volume_glance_metadata_t = Table('volume_glance_metadata', meta, autoload=True)
-    snapshots_t = Table('snapshots', meta, autoload=True)
+    volume_glance_metadata_t = get_table(meta, 'volume_glance_metadata')
+    snapshots_t = get_table(meta, 'snapshots')
     glance_metadata_join = volume_glance_metadata_t.join(snapshots_t, volume_glance_metadata_t.c.snapshot_id == snapshots_t.c.id)
     columns = [snapshots_t.c.id, snapshots_t.c.deleted, volume_glance_metadata_t.c.id, volume_glance_metadata_t.c.deleted]
     wrong_volume_glance_metadata_q = select(columns=columns).select_from(glance_metadata_join).\
         where(and_(snapshots_t.c.deleted == 1, volume_glance_metadata_t.c.deleted == 0))
+    if deleted_since:
+        wrong_volume_glance_metadata_q = wrong_volume_glance_metadata_q.where(deleted_since_condition(snapshots_t, deleted_since))
 
     # return a dict indexed by volume_glance_metadata_id and with the value volume_id for non deleted volume_glance_metadata
     for (snapshot_id, snapshot_deleted, volume_glance_metadata_id, volume_glance_metadata_deleted) in wrong_volume_glance_metadata_q.execute():
         wrong_glance_metadata[volume_glance_metadata_id] = snapshot_id
+        if on_finding:
+            on_finding(volume_glance_metadata_id, snapshot_id)
     return wrong_glance_metadata
 
 
 # delete volume_glance_metadata still defined where the corresponding volume is snapshot deleted
-def fix_wrong_volume_glance_metadata_snapshots(meta, wrong_glance_metadata):
+def fix_wrong_volume_glance_metadata_snapshots(meta, wrong_glance_metadata, batch_size=DEFAULT_BATCH_SIZE):
 
-    volume_glance_metadata_t = Table('volume_glance_metadata', meta, autoload=True)
+    volume_glance_metadata_t = get_table(meta, 'volume_glance_metadata')
 
-    for volume_glance_metadata_id in wrong_glance_metadata:
-        log.info("-- action: deleting volume_glance_metadata id (snapshot): %s", volume_glance_metadata_id)
-        now = datetime.datetime.utcnow()
-        delete_volume_glance_metadata_q = volume_glance_metadata_t.update().\
-            where(volume_glance_metadata_t.c.id == volume_glance_metadata_id).values(updated_at=now, deleted_at=now, deleted=1)
-        delete_volume_glance_metadata_q.execute()
+    log.info("-- action: deleting %s volume_glance_metadata entries (snapshot)", len(wrong_glance_metadata))
+    soft_delete_rows(meta.bind, volume_glance_metadata_t, wrong_glance_metadata, batch_size)
 
 
 # get all the rows with a volume_metadata still defined where the corresponding volume is already deleted
-def get_wrong_volume_metadata(meta):
+def get_wrong_volume_metadata(meta, deleted_since=None, on_finding=None):
 
     wrong_metadata = {}
-    volume_metadata_t = Table('volume_metadata', meta, autoload=True)
-    volumes_t = Table('volumes', meta, autoload=True)
+    volume_metadata_t = get_table(meta, 'volume_metadata')
+    volumes_t = get_table(meta, 'volumes')
     metadata_join = volume_metadata_t.join(volumes_t, volume_metadata_t.c.volume_id == volumes_t.c.id)
     columns = [volumes_t.c.id, volumes_t.c.deleted, volume_metadata_t.c.id, volume_metadata_t.c.deleted]
     wrong_volume_metadata_q = select(columns=columns).select_from(metadata_join).\
         where(and_(volumes_t.c.deleted == 1, volume_metadata_t.c.deleted == 0))
+    if deleted_since:
+        wrong_volume_metadata_q = wrong_volume_metadata_q.where(deleted_since_condition(volumes_t, deleted_since))
 
     # return a dict indexed by volume_metadata_id and with the value volume_id for non deleted volume_metadata
     for (volume_id, volume_deleted, volume_metadata_id, volume_metadata_deleted) in wrong_volume_metadata_q.execute():
         wrong_metadata[volume_metadata_id] = volume_id
+        if on_finding:
+            on_finding(volume_metadata_id, volume_id)
     return wrong_metadata
 
 
 # delete volume_metadata still defined where the corresponding volume is already deleted
-def fix_wrong_volume_metadata(meta, wrong_metadata):
+def fix_wrong_volume_metadata(meta, wrong_metadata, batch_size=DEFAULT_BATCH_SIZE):
 
-    volume_metadata_t = Table('volume_metadata', meta, autoload=True)
+    volume_metadata_t = get_table(meta, 'volume_metadata')
 
-    for volume_metadata_id in wrong_metadata:
-        log.info("-- action: deleting volume_metadata id: %s", volume_metadata_id)
-        now = datetime.datetime.utcnow()
-        delete_volume_metadata_q = volume_metadata_t.update().\
-            where(volume_metadata_t.c.id == volume_metadata_id).values(updated_at=now, deleted_at=now, deleted=1)
-        delete_volume_metadata_q.execute()
+    log.info("-- action: deleting %s volume_metadata entries", len(wrong_metadata))
+    soft_delete_rows(meta.bind, volume_metadata_t, wrong_metadata, batch_size)
 
 
 # get all the rows with a volume attachment still defined where the corresponding volume is already deleted
-def get_wrong_volume_attachments(meta):
+def get_wrong_volume_attachments(meta, limit=None, deleted_since=None, on_finding=None):
 
     wrong_attachments = {}
-    volume_attachment_t = Table('volume_attachment', meta, autoload=True)
-    volumes_t = Table('volumes', meta, autoload=True)
+    volume_attachment_t = get_table(meta, 'volume_attachment')
+    volumes_t = get_table(meta, 'volumes')
     attachment_join = volume_attachment_t.join(volumes_t, volume_attachment_t.c.volume_id == volumes_t.c.id)
     columns = [volumes_t.c.id, volumes_t.c.deleted, volume_attachment_t.c.id, volume_attachment_t.c.deleted]
     wrong_volume_attachment_q = select(columns=columns).select_from(attachment_join).\
         where(and_(volumes_t.c.deleted == 1, volume_attachment_t.c.deleted == 0))
+    if deleted_since:
+        wrong_volume_attachment_q = wrong_volume_attachment_q.where(deleted_since_condition(volumes_t, deleted_since))
+    if limit:
+        wrong_volume_attachment_q = wrong_volume_attachment_q.limit(limit)
 
     # return a dict indexed by volume_attachment_id and with the value volume_id for non deleted volume_attachments
     for (volume_id, volume_deleted, volume_attachment_id, volume_attachment_deleted) in wrong_volume_attachment_q.execute():
         wrong_attachments[volume_attachment_id] = volume_id
+        if on_finding:
+            on_finding(volume_attachment_id, volume_id)
     return wrong_attachments
 
 
-# delete volume attachment still defined where the corresponding volume is already deleted
-def fix_wrong_volume_attachments(meta, wrong_attachments, fix_limit):
+# delete volume attachment still defined where the corresponding volume is already deleted - return whether they have been fixed
+def fix_wrong_volume_attachments(meta, wrong_attachments, fix_limit, batch_size=DEFAULT_BATCH_SIZE):
 
     if len(wrong_attachments) <= int(fix_limit):
 
-        volume_attachment_t = Table('volume_attachment', meta, autoload=True)
+        volume_attachment_t = get_table(meta, 'volume_attachment')
 
-        for volume_attachment_id in wrong_attachments:
-            log.info("-- action: deleting volume attachment id: %s", volume_attachment_id)
-            now = datetime.datetime.utcnow()
-            delete_volume_attachment_q = volume_attachment_t.update().\
-                where(volume_attachment_t.c.id == volume_attachment_id).values(updated_at=now, deleted_at=now, deleted=1)
-            delete_volume_attachment_q.execute()
+        log.info("-- action: deleting %s volume attachments", len(wrong_attachments))
+        soft_delete_rows(meta.bind, volume_attachment_t, wrong_attachments, batch_size)
 
     else:
         log.warn("- PLEASE CHECK MANUALLY - too many (more than %s) wrong volume attachments - denying to fix them automatically", str(fix_limit))
+        return False
+
+    return True
 
 
 # get all the rows with a snapshot_metadata still defined where the corresponding snapshot is already deleted
-def get_wrong_snapshot_metadata(meta):
+def get_wrong_snapshot_metadata(meta, deleted_since=None, on_finding=None):
 
     wrong_metadata = {}
-    snapshot_metadata_t = Table('snapshot_metadata', meta, autoload=True)
-    snapshots_t = Table('snapshots', meta, autoload=True)
+    snapshot_metadata_t = get_table(meta, 'snapshot_metadata')
+    snapshots_t = get_table(meta, 'snapshots')
     metadata_join = snapshot_metadata_t.join(snapshots_t, snapshot_metadata_t.c.snapshot_id == snapshots_t.c.id)
     columns = [snapshots_t.c.id, snapshots_t.c.deleted, snapshot_metadata_t.c.id, snapshot_metadata_t.c.deleted]
     wrong_snapshot_metadata_q = select(columns=columns).select_from(metadata_join).\
         where(and_(snapshots_t.c.deleted == 1, snapshot_metadata_t.c.deleted == 0))
+    if deleted_since:
+        wrong_snapshot_metadata_q = wrong_snapshot_metadata_q.where(deleted_since_condition(snapshots_t, deleted_since))
 
     # return a dict indexed by snapshot_metadata_id and with the value snapshot_id for non deleted snapshot_metadata
     for (snapshot_id, snapshot_deleted, snapshot_metadata_id, snapshot_metadata_deleted) in wrong_snapshot_metadata_q.execute():
         wrong_metadata[snapshot_metadata_id] = snapshot_id
+        if on_finding:
+            on_finding(snapshot_metadata_id, snapshot_id)
     return wrong_metadata
 
 
 # delete snapshot_metadata still defined where the corresponding snapshot is already deleted
-def fix_wrong_snapshot_metadata(meta, wrong_metadata):
+def fix_wrong_snapshot_metadata(meta, wrong_metadata, batch_size=DEFAULT_BATCH_SIZE):
+
+    snapshot_metadata_t = get_table(meta, 'snapshot_metadata')
+
+    log.info("-- action: deleting %s snapshot_metadata entries", len(wrong_metadata))
+    soft_delete_rows(meta.bind, snapshot_metadata_t, wrong_metadata, batch_size)
+
 
-    snapshot_metadata_t = Table('snapshot_metadata', meta, autoload=True)
+# the "child of deleted parent" checks covered by the single pass scanner:
+# (check name, child table, foreign key column in the child table, parent table)
+ORPHAN_CHILD_CHECKS = [
+    ('volume_admin_metadata', 'volume_admin_metadata', 'volume_id', 'volumes'),
+    ('volume_glance_metadata_volumes', 'volume_glance_metadata', 'volume_id', 'volumes'),
+    ('volume_glance_metadata_snapshots', 'volume_glance_metadata', 'snapshot_id', 'snapshots'),
+    ('volume_metadata', 'volume_metadata', 'volume_id', 'volumes'),
+    ('volume_attachments', 'volume_attachment', 'volume_id', 'volumes'),
+    ('snapshot_metadata', 'snapshot_metadata', 'snapshot_id', 'snapshots'),
+]
 
-    for snapshot_metadata_id in wrong_metadata:
-        log.info("-- action: deleting snapshot_metadata id: %s", snapshot_metadata_id)
-        now = datetime.datetime.utcnow()
-        delete_snapshot_metadata_q = snapshot_metadata_t.update().\
-            where(snapshot_metadata_t.c.id == snapshot_metadata_id).values(updated_at=now, deleted_at=now, deleted=1)
-        delete_snapshot_metadata_q.execute()
+
+# build the query for the rows of one of the ORPHAN_CHILD_CHECKS still defined where the corresponding parent is already deleted
+# with the child id and the parent id as columns - for_union adds the check name and returns the child id as string
+# deleted_since optionally limits the parents to the ones deleted since then
+def get_orphan_child_q(meta, check, deleted_since=None, for_union=False):
+
+    (_, child_table, fk_column, parent_table) = next(spec for spec in ORPHAN_CHILD_CHECKS if spec[0] == check)
+    child_t = get_table(meta, child_table)
+    parent_t = get_table(meta, parent_table)
+    child_join = child_t.join(parent_t, child_t.c[fk_column] == parent_t.c.id)
+    if for_union:
+        columns = [literal(check).label('check'), cast(child_t.c.id, String(36)).label('child_id'), parent_t.c.id.label('parent_id')]
+    else:
+        columns = [child_t.c.id.label('child_id'), parent_t.c.id.label('parent_id')]
+    orphan_child_q = select(columns=columns).select_from(child_join).\
+        where(and_(parent_t.c.deleted == 1, child_t.c.deleted == 0))
+    if deleted_since:
+        orphan_child_q = orphan_child_q.where(deleted_since_condition(parent_t, deleted_since))
+    return orphan_child_q
+
+
+# get the rows of all the ORPHAN_CHILD_CHECKS still defined where the corresponding parent is already deleted
+# in a single round trip - one UNION ALL of all the joins with the check name as discriminator
+# deleted_since optionally limits the parents per parent table to the ones deleted since then
+def get_wrong_orphan_children(meta, deleted_since=None):
+
+    wrong_orphan_children = {}
+    child_id_types = {}
+    orphan_children_selects = []
+    for (check, child_table, fk_column, parent_table) in ORPHAN_CHILD_CHECKS:
+        orphan_children_selects.append(get_orphan_child_q(meta, check, (deleted_since or {}).get(parent_table), for_union=True))
+        # the ids come back as strings from the union - remember how to convert them back
+        child_id_types[check] = get_table(meta, child_table).c.id.type.python_type
+        wrong_orphan_children[check] = {}
+
+    start = time.monotonic()
+    # return a dict indexed by check name with dicts indexed by child id and with the value parent id as the values
+    for (check, child_id, parent_id) in union_all(*orphan_children_selects).execute():
+        wrong_orphan_children[check][child_id_types[check](child_id)] = parent_id
+    log.info("- single pass orphan child scan of %s checks took %.2fs", len(ORPHAN_CHILD_CHECKS), time.monotonic() - start)
+    return wrong_orphan_children
+
+
+# compare the timing and results of the single pass orphan child scan against the sequence of the separate checks
+def compare_orphan_child_scans(meta):
+
+    get_wrong_functions = {
+        'volume_admin_metadata': get_wrong_volume_admin_metadata,
+        'volume_glance_metadata_volumes': get_wrong_volume_glance_metadata_volumes,
+        'volume_glance_metadata_snapshots': get_wrong_volume_glance_metadata_snapshots,
+        'volume_metadata': get_wrong_volume_metadata,
+        'volume_attachments': get_wrong_volume_attachments,
+        'snapshot_metadata': get_wrong_snapshot_metadata,
+    }
+
+    start = time.monotonic()
+    sequential_results = {check: get_wrong_function(meta) for check, get_wrong_function in get_wrong_functions.items()}
+    sequential_duration = time.monotonic() - start
+
+    start = time.monotonic()
+    single_pass_results = get_wrong_orphan_children(meta)
+    single_pass_duration = time.monotonic() - start
+
+    log.info("- orphan child scan timings: %.2fs for the sequence of %s checks vs. %.2fs for the single pass",
+             sequential_duration, len(get_wrong_functions), single_pass_duration)
+    for check in get_wrong_functions:
+        if sequential_results[check] != single_pass_results[check]:
+            log.warn("- PLEASE CHECK MANUALLY - single pass orphan child scan result differs for %s: %s vs. %s entries",
+                     check, len(sequential_results[check]), len(single_pass_results[check]))
+
+
+# run the single pass orphan child scan (and its comparison) and keep its results in orphan_children for the checks using them
+def scan_orphan_children(meta, args, orphan_children, deleted_since=None):
+
+    if args.compare_single_pass:
+        compare_orphan_child_scans(meta)
+    if args.single_pass:
+        orphan_children.update(get_wrong_orphan_children(meta, deleted_since))
 
 
 # get all the rows with a group_volume_type_mapping still defined where the corresponding group_id is already deleted
-def get_wrong_group_volume_type_mappings(meta):
+def get_wrong_group_volume_type_mappings(meta, limit=None, on_finding=None):
 
     wrong_group_volume_type_mappings = {}
-    group_volume_type_mapping_t = Table('group_volume_type_mapping', meta, autoload=True)
-    groups_t = Table('groups', meta, autoload=True)
+    group_volume_type_mapping_t = get_table(meta, 'group_volume_type_mapping')
+    groups_t = get_table(meta, 'groups')
     group_volume_type_mapping_join = group_volume_type_mapping_t.join(groups_t, group_volume_type_mapping_t.c.group_id == groups_t.c.id)
     columns = [groups_t.c.id, groups_t.c.deleted, group_volume_type_mapping_t.c.id, group_volume_type_mapping_t.c.deleted]
     wrong_group_volume_type_mapping_q = select(columns=columns).select_from(group_volume_type_mapping_join).\
         where(and_(groups_t.c.deleted == 1, group_volume_type_mapping_t.c.deleted == 0))
+    if limit:
+        wrong_group_volume_type_mapping_q = wrong_group_volume_type_mapping_q.limit(limit)
 
     # return a dict indexed by volume_attachment_id and with the value volume_id for non deleted volume_attachments
     for (group_id, group_deleted, group_volume_type_mapping_id, group_volume_type_mapping_deleted) in wrong_group_volume_type_mapping_q.execute():
         wrong_group_volume_type_mappings[group_volume_type_mapping_id] = group_id
+        if on_finding:
+            on_finding(group_volume_type_mapping_id, group_id)
     return wrong_group_volume_type_mappings
 
 
-# delete group_volume_type_mapping still defined where the corresponding groupid is already deleted
-def fix_wrong_group_volume_type_mappings(meta, wrong_group_volume_type_mappings, fix_limit):
+# delete group_volume_type_mapping still defined where the corresponding groupid is already deleted - return whether they have been fixed
+def fix_wrong_group_volume_type_mappings(meta, wrong_group_volume_type_mappings, fix_limit, batch_size=DEFAULT_BATCH_SIZE):
 
     if len(wrong_group_volume_type_mappings) <= int(fix_limit):
 
-        group_volume_type_mapping_t = Table('group_volume_type_mapping', meta, autoload=True)
+        group_volume_type_mapping_t = get_table(meta, 'group_volume_type_mapping')
 
-        for group_volume_type_mapping_id in wrong_group_volume_type_mappings:
-            log.info("-- action: deleting group_volume_type_mapping id: %s", group_volume_type_mapping_id)
-            now = datetime.datetime.utcnow()
-            delete_group_volume_type_mapping_q = group_volume_type_mapping_t.update().\
-                where(group_volume_type_mapping_t.c.id == group_volume_type_mapping_id).values(updated_at=now, deleted_at=now, deleted=1)
-            delete_group_volume_type_mapping_q.execute()
+        log.info("-- action: deleting %s group_volume_type_mappings", len(wrong_group_volume_type_mappings))
+        soft_delete_rows(meta.bind, group_volume_type_mapping_t, wrong_group_volume_type_mappings, batch_size)
 
     else:
         log.warn("- PLEASE CHECK MANUALLY - too many (more than %s) wrong group_volume_type_mappings - denying to fix them automatically", str(fix_limit))
+        return False
+
+    return True
 
 
 # get all the rows, which have the deleted flag set, but not the delete_at column
-def get_missing_deleted_at(meta, table_names):
+def get_missing_deleted_at(meta, table_names, on_finding=None):
 
     missing_deleted_at = {}
     for t in table_names:
-        a_table_t = Table(t, meta, autoload=True)
+        a_table_t = get_table(meta, t)
         a_table_select_deleted_at_q = a_table_t.select().where(
             and_(a_table_t.c.deleted == 1, a_table_t.c.deleted_at is None))
 
         for row in a_table_select_deleted_at_q.execute():
             missing_deleted_at[row.id] = t
+            if on_finding:
+                on_finding(t, row.id)
     return missing_deleted_at
 
 
@@ -418,7 +577,7 @@ def get_missing_deleted_at(meta, table_names):
 def fix_missing_deleted_at(meta, table_names):
     now = datetime.datetime.utcnow()
     for t in table_names:
-        a_table_t = Table(t, meta, autoload=True)
+        a_table_t = get_table(meta, t)
 
         log.info("- action: fixing columns with missing deleted_at times in the %s table", t)
         a_table_set_deleted_at_q = a_table_t.update().where(
@@ -428,11 +587,11 @@ def fix_missing_deleted_at(meta, table_names):
 
 
 # get all the rows with a service still defined where the corresponding volume is already deleted
-def get_deleted_services_still_used_in_volumes(meta):
+def get_deleted_services_still_used_in_volumes(meta, on_finding=None):
 
     deleted_services_still_used_in_volumes = {}
-    services_t = Table('services', meta, autoload=True)
-    volumes_t = Table('volumes', meta, autoload=True)
+    services_t = get_table(meta, 'services')
+    volumes_t = get_table(meta, 'volumes')
     services_volumes_join = services_t.join(volumes_t, services_t.c.uuid == volumes_t.c.service_uuid)
     columns = [services_t.c.uuid, services_t.c.deleted, volumes_t.c.id, volumes_t.c.deleted]
     deleted_services_still_used_in_volumes_q = select(columns=columns).select_from(services_volumes_join).\
@@ -441,13 +600,15 @@ def get_deleted_services_still_used_in_volumes(meta):
     # return a dict indexed by service_uuid and with the value volume_id for deleted but still referenced services
     for (service_uuid, service_deleted, volume_id, volume_deleted) in deleted_services_still_used_in_volumes_q.execute():
         deleted_services_still_used_in_volumes[service_uuid] = volume_id
+        if on_finding:
+            on_finding(service_uuid, volume_id)
     return deleted_services_still_used_in_volumes
 
 
 # delete services still defined where the corresponding volume is already deleted
 def fix_deleted_services_still_used_in_volumes(meta, deleted_services_still_used_in_volumes):
 
-    services_t = Table('services', meta, autoload=True)
+    services_t = get_table(meta, 'services')
 
     for deleted_services_still_used_in_volumes_id in deleted_services_still_used_in_volumes:
         log.info("-- action: undeleting service uuid: %s", deleted_services_still_used_in_volumes_id)
@@ -455,232 +616,522 @@ def fix_deleted_services_still_used_in_volumes(meta, deleted_services_still_used
         undelete_services_q.execute()
 
 
-# establish an openstack connection
-def makeOsConnection():
-    try:
-        conn = connection.Connection(auth_url=os.getenv('OS_AUTH_URL'),
-                                     project_name=os.getenv('OS_PROJECT_NAME'),
-                                     project_domain_name=os.getenv('OS_PROJECT_DOMAIN_NAME'),
-                                     username=os.getenv('OS_USERNAME'),
-                                     user_domain_name=os.getenv('OS_USER_DOMAIN_NAME'),
-                                     password=os.getenv('OS_PASSWORD'),
-                                     identity_api_version="3")
-    except Exception as e:
-        log.warn("- PLEASE CHECK MANUALLY - problems connecting to openstack: %s", str(e))
-        sys.exit(1)
-
-    return conn
-
-
-# establish a database connection and return the handle
-def makeConnection(db_url):
-    engine = create_engine(db_url)
-    engine.connect()
-    Session = sessionmaker(bind=engine)
-    thisSession = Session()
-    metadata = MetaData()
-    metadata.bind = engine
-    Base = declarative_base()
-    return thisSession, metadata, Base
-
-
-# return the database connection string from the config file
-def get_db_url(config_file):
-    parser = configparser.ConfigParser()
-    try:
-        parser.read(config_file)
-        db_url = parser.get('database', 'connection', raw=True)
-    except Exception as e:
-        log.info("ERROR: Check Cinder configuration file - error %s", str(e))
-        sys.exit(2)
-    return db_url
-
+# return the number of findings to fetch at most for a check limited by fix_limit - one more than fix_limit
+# is enough to know that fixing will be denied, so there is no need to fetch and log all of them
+def get_finding_limit(fix_limit, count_first):
+    if count_first:
+        return int(fix_limit) + 1
+    return None
 
-# cmdline handling
-def parse_cmdline_args():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--config",
-                        default='./cinder.conf',
-                        help='configuration file')
-    parser.add_argument("--dry-run", action="store_true", help='print only what would be done without actually doing it')
-    parser.add_argument("--fix-limit", default=25, help='maximum number of inconsistencies to fix automatically - if there are more, automatic fixing is denied')
-    return parser.parse_args()
 
+# warn if a capped fetch has hit its limit, i.e. only a sample of the findings has been fetched
+def check_finding_limit(findings, finding_limit, name):
+    if finding_limit and len(findings) >= finding_limit:
+        log.warn("- PLEASE CHECK MANUALLY - more than %s %s found - only showing a sample of them", str(finding_limit - 1), name)
 
-def main():
-    try:
-        args = parse_cmdline_args()
-    except Exception as e:
-        log.error("Check command line arguments (%s)", e.strerror)
 
-    # connect to openstack
-    conn = makeOsConnection()
+# check and fix volume attachments at no longer existing instances
+def check_orphan_volume_attachments(meta, args, conn, finding_limit=None, report=None, unfixed=None):
 
-    # connect to the DB
-    db_url = get_db_url(args.config)
-    cinder_session, cinder_metadata, cinder_Base = makeConnection(db_url)
-
-    # fixing volume attachments at no longer existing instances
-    orphan_volume_attachments = get_orphan_volume_attachments(cinder_metadata)
-    nova_instances = get_nova_instances(conn)
-    wrong_orphan_volume_attachments = get_wrong_orphan_volume_attachments(nova_instances, orphan_volume_attachments)
+    write_finding = get_finding_writer(report, 'orphan volume attachments', 'volume_attachment')
+    if args.db_anti_join:
+        nova_instances = get_nova_instances(conn, args.inventory_page_size, args.nova_api_db_url, args.nova_cell_db_url_template)
+        wrong_orphan_volume_attachments = get_wrong_orphan_volume_attachments_db(meta, nova_instances, args.batch_size, finding_limit, write_finding)
+    else:
+        orphan_volume_attachments = get_orphan_volume_attachments(meta)
+        nova_instances = get_nova_instances(conn, args.inventory_page_size, args.nova_api_db_url, args.nova_cell_db_url_template)
+        wrong_orphan_volume_attachments = get_wrong_orphan_volume_attachments(nova_instances, orphan_volume_attachments, finding_limit, write_finding)
     if len(wrong_orphan_volume_attachments) != 0:
         log.info("- orphan volume attachments found:")
+        check_finding_limit(wrong_orphan_volume_attachments, finding_limit, 'orphan volume attachments')
         # print out what we would delete
-        for orphan_volume_attachment_id in wrong_orphan_volume_attachments:
-            log.info("-- orphan volume attachment (id in cinder db: %s) for non existent instance in nova: %s", orphan_volume_attachment_id,
-                     orphan_volume_attachments[orphan_volume_attachment_id])
+        log_findings(report, 'orphan volume attachments', 'volume_attachment', wrong_orphan_volume_attachments,
+                     "-- orphan volume attachment (id in cinder db: %s) for non existent instance in nova: %s", written=True)
         if not args.dry_run:
             log.info("- deleting orphan volume attachment inconsistencies found")
-            fix_wrong_orphan_volume_attachments(cinder_metadata, wrong_orphan_volume_attachments, args.fix_limit)
+            if not fix_wrong_orphan_volume_attachments(meta, wrong_orphan_volume_attachments, args.fix_limit, args.batch_size) and unfixed is not None:
+                unfixed.append('orphan volume attachments')
     else:
         log.info("- no orphan volume attachments found")
 
-    # fixing possible volumes in state "error-deleting"
-    error_deleting_volumes = get_error_deleting_volumes(cinder_metadata)
+    return len(wrong_orphan_volume_attachments)
+
+
+# check and fix possible volumes in state "error-deleting"
+def check_error_deleting_volumes(meta, args, report=None):
+
+    error_deleting_volumes = get_error_deleting_volumes(meta, get_finding_writer(report, 'error_deleting volumes', 'volumes'))
     if len(error_deleting_volumes) != 0:
         log.info("- volumes in state error_deleting found")
         # print out what we would delete
-        for error_deleting_volumes_id in error_deleting_volumes:
-            log.info("-- volume id: %s", error_deleting_volumes_id)
+        log_findings(report, 'error_deleting volumes', 'volumes', error_deleting_volumes,
+                     "-- volume id: %s", written=True)
         if not args.dry_run:
             log.info("- deleting volumes in state error_deleting")
-            fix_error_deleting_volumes(cinder_metadata, error_deleting_volumes)
+            fix_error_deleting_volumes(meta, error_deleting_volumes, args.batch_size)
     else:
         log.info("- no volumes in state error_deleting found")
 
-    # fixing possible snapshots in state "error-deleting"
-    error_deleting_snapshots = get_error_deleting_snapshots(cinder_metadata)
+    return len(error_deleting_volumes)
+
+
+# check and fix possible snapshots in state "error-deleting"
+def check_error_deleting_snapshots(meta, args, report=None):
+
+    error_deleting_snapshots = get_error_deleting_snapshots(meta, get_finding_writer(report, 'error_deleting snapshots', 'snapshots'))
     if len(error_deleting_snapshots) != 0:
         log.info("- snapshots in state error_deleting found")
         # print out what we would delete
-        for error_deleting_snapshots_id in error_deleting_snapshots:
-            log.info("-- snapshot id: %s", error_deleting_snapshots_id)
+        log_findings(report, 'error_deleting snapshots', 'snapshots', error_deleting_snapshots,
+                     "-- snapshot id: %s", written=True)
         if not args.dry_run:
             log.info("- deleting snapshots in state error_deleting")
-            fix_error_deleting_snapshots(cinder_metadata, error_deleting_snapshots)
+            fix_error_deleting_snapshots(meta, error_deleting_snapshots, args.batch_size)
     else:
         log.info("- no snapshots in state error_deleting found")
 
-    # fixing possible wrong admin_metadata entries
-    wrong_admin_metadata = get_wrong_volume_admin_metadata(cinder_metadata)
+    return len(error_deleting_snapshots)
+
+
+# check and fix the rows of one of the ORPHAN_CHILD_CHECKS partition by partition while they are streamed from the db,
+# so that the memory used stays bounded by the batch size and fixing starts before the whole result set is read
+def check_orphan_children_streamed(meta, args, check, name, message, report=None, deleted_since=None):
+
+    child_t = get_table(meta, next(spec[1] for spec in ORPHAN_CHILD_CHECKS if spec[0] == check))
+    orphan_child_q = get_orphan_child_q(meta, check, deleted_since)
+    found = 0
+    for partition in iter_partitions(meta.bind, orphan_child_q, args.batch_size, stream=True):
+        # a dict indexed by child id and with the value parent id like the non streamed checks
+        wrong_children = {child_id: parent_id for (child_id, parent_id) in partition}
+        if found == 0:
+            log.info("- %s inconsistencies found", name)
+        found += len(wrong_children)
+        # print out what we would delete
+        log_findings(report, name, child_t.name, wrong_children, message)
+        if not args.dry_run:
+            log.info("- removing %s inconsistencies found", name)
+            soft_delete_rows(meta.bind, child_t, wrong_children, args.batch_size)
+    if found == 0:
+        log.info("- %s entries are consistent", name)
+
+    return found
+
+
+# check and fix possible wrong admin_metadata entries
+def check_volume_admin_metadata(meta, args, orphan_children=None, report=None, deleted_since=None):
+
+    if args.stream_results and not orphan_children:
+        return check_orphan_children_streamed(meta, args, 'volume_admin_metadata', 'volume_admin_metadata', "-- volume_admin_metadata id: %s - deleted volume id: %s",
+                                              report, (deleted_since or {}).get('volumes'))
+    wrong_admin_metadata = orphan_children['volume_admin_metadata'] if orphan_children else \
+        get_wrong_volume_admin_metadata(meta, (deleted_since or {}).get('volumes'), get_finding_writer(report, 'volume_admin_metadata', 'volume_admin_metadata'))
     if len(wrong_admin_metadata) != 0:
         log.info("- volume_admin_metadata inconsistencies found")
         # print out what we would delete
-        for volume_admin_metadata_id in wrong_admin_metadata:
-            log.info("-- volume_admin_metadata id: %s - deleted volume id: %s", volume_admin_metadata_id, wrong_admin_metadata[volume_admin_metadata_id])
+        log_findings(report, 'volume_admin_metadata', 'volume_admin_metadata', wrong_admin_metadata,
+                     "-- volume_admin_metadata id: %s - deleted volume id: %s", written=not orphan_children)
         if not args.dry_run:
             log.info("- removing volume_admin_metadata inconsistencies found")
-            fix_wrong_volume_admin_metadata(cinder_metadata, wrong_admin_metadata)
+            fix_wrong_volume_admin_metadata(meta, wrong_admin_metadata, args.batch_size)
     else:
         log.info("- volume_admin_metadata entries are consistent")
 
-    # fixing possible wrong glance_metadata entries for volumes
-    wrong_glance_metadata = get_wrong_volume_glance_metadata_volumes(cinder_metadata)
+    return len(wrong_admin_metadata)
+
+
+# check and fix possible wrong glance_metadata entries for volumes
+def check_volume_glance_metadata_volumes(meta, args, orphan_children=None, report=None, deleted_since=None):
+
+    if args.stream_results and not orphan_children:
+        return check_orphan_children_streamed(meta, args, 'volume_glance_metadata_volumes', 'volume_glance_metadata for volumes', "-- volume_glance_metadata id: %s - deleted volume id: %s",
+                                              report, (deleted_since or {}).get('volumes'))
+    wrong_glance_metadata = orphan_children['volume_glance_metadata_volumes'] if orphan_children else \
+        get_wrong_volume_glance_metadata_volumes(meta, (deleted_since or {}).get('volumes'), get_finding_writer(report, 'volume_glance_metadata for volumes', 'volume_glance_metadata'))
     if len(wrong_glance_metadata) != 0:
         log.info("- volume_glance_metadata inconsistencies for volumes found")
         # print out what we would delete
-        for volume_glance_metadata_id in wrong_glance_metadata:
-            log.info("-- volume_glance_metadata id: %s - deleted volume id: %s", volume_glance_metadata_id, wrong_glance_metadata[volume_glance_metadata_id])
+        log_findings(report, 'volume_glance_metadata for volumes', 'volume_glance_metadata', wrong_glance_metadata,
+                     "-- volume_glance_metadata id: %s - deleted volume id: %s", written=not orphan_children)
         if not args.dry_run:
             log.info("- removing volume_glance_metadata inconsistencies found")
-            fix_wrong_volume_glance_metadata_volumes(cinder_metadata, wrong_glance_metadata)
+            fix_wrong_volume_glance_metadata_volumes(meta, wrong_glance_metadata, args.batch_size)
     else:
         log.info("- volume_glance_metadata entries for volumes are consistent")
 
-    # fixing possible wrong glance_metadata entries for snapshots
-    wrong_glance_metadata = get_wrong_volume_glance_metadata_snapshots(cinder_metadata)
+    return len(wrong_glance_metadata)
+
+
+# check and fix possible wrong glance_metadata entries for snapshots
+def check_volume_glance_metadata_snapshots(meta, args, orphan_children=None, report=None, deleted_since=None):
+
+    if args.stream_results and not orphan_children:
+        return check_orphan_children_streamed(meta, args, 'volume_glance_metadata_snapshots', 'volume_glance_metadata for snapshots', "-- volume_glance_metadata id: %s - deleted snapshot id: %s",
+                                              report, (deleted_since or {}).get('snapshots'))
+    wrong_glance_metadata = orphan_children['volume_glance_metadata_snapshots'] if orphan_children else \
+        get_wrong_volume_glance_metadata_snapshots(meta, (deleted_since or {}).get('snapshots'), get_finding_writer(report, 'volume_glance_metadata for snapshots', 'volume_glance_metadata'))
     if len(wrong_glance_metadata) != 0:
         log.info("- volume_glance_metadata inconsistencies for snapshots found")
         # print out what we would delete
-        for volume_glance_metadata_id in wrong_glance_metadata:
-            log.info("-- volume_glance_metadata id: %s - deleted snapshot id: %s", volume_glance_metadata_id, wrong_glance_metadata[volume_glance_metadata_id])
+        log_findings(report, 'volume_glance_metadata for snapshots', 'volume_glance_metadata', wrong_glance_metadata,
+                     "-- volume_glance_metadata id: %s - deleted snapshot id: %s", written=not orphan_children)
         if not args.dry_run:
             log.info("- removing volume_glance_metadata inconsistencies found")
-            fix_wrong_volume_glance_metadata_snapshots(cinder_metadata, wrong_glance_metadata)
+            fix_wrong_volume_glance_metadata_snapshots(meta, wrong_glance_metadata, args.batch_size)
     else:
         log.info("- volume_glance_metadata entries for snapshots are consistent")
 
-    # fixing possible wrong volume metadata entries
-    wrong_metadata = get_wrong_volume_metadata(cinder_metadata)
+    return len(wrong_glance_metadata)
+
+
+# check and fix possible wrong volume metadata entries
+def check_volume_metadata(meta, args, orphan_children=None, report=None, deleted_since=None):
+
+    if args.stream_results and not orphan_children:
+        return check_orphan_children_streamed(meta, args, 'volume_metadata', 'volume_metadata', "-- volume_metadata id: %s - deleted volume id: %s",
+                                              report, (deleted_since or {}).get('volumes'))
+    wrong_metadata = orphan_children['volume_metadata'] if orphan_children else \
+        get_wrong_volume_metadata(meta, (deleted_since or {}).get('volumes'), get_finding_writer(report, 'volume_metadata', 'volume_metadata'))
     if len(wrong_metadata) != 0:
         log.info("- volume_metadata inconsistencies found")
         # print out what we would delete
-        for volume_metadata_id in wrong_metadata:
-            log.info("-- volume_metadata id: %s - deleted volume id: %s", volume_metadata_id, wrong_metadata[volume_metadata_id])
+        log_findings(report, 'volume_metadata', 'volume_metadata', wrong_metadata,
+                     "-- volume_metadata id: %s - deleted volume id: %s", written=not orphan_children)
         if not args.dry_run:
             log.info("- removing volume_metadata inconsistencies found")
-            fix_wrong_volume_metadata(cinder_metadata, wrong_metadata)
+            fix_wrong_volume_metadata(meta, wrong_metadata, args.batch_size)
     else:
         log.info("- volume_metadata entries are consistent")
 
-    # fixing possible wrong attachment entries
-    wrong_attachments = get_wrong_volume_attachments(cinder_metadata)
+    return len(wrong_metadata)
+
+
+# check and fix possible wrong attachment entries
+def check_volume_attachments(meta, args, orphan_children=None, finding_limit=None, report=None, deleted_since=None, unfixed=None):
+
+    # the single pass scan is not capped, so a capped fetch takes precedence over it
+    if orphan_children and not finding_limit:
+        wrong_attachments = orphan_children['volume_attachments']
+        written = False
+    else:
+        wrong_attachments = get_wrong_volume_attachments(meta, finding_limit, (deleted_since or {}).get('volumes'),
+                                                         get_finding_writer(report, 'volume attachments', 'volume_attachment'))
+        written = True
     if len(wrong_attachments) != 0:
         log.info("- volume attachment inconsistencies found")
+        check_finding_limit(wrong_attachments, finding_limit, 'volume attachment inconsistencies')
         # print out what we would delete
-        for volume_attachment_id in wrong_attachments:
-            log.info("-- volume attachment id: %s - deleted volume id: %s", volume_attachment_id, wrong_attachments[volume_attachment_id])
+        log_findings(report, 'volume attachments', 'volume_attachment', wrong_attachments,
+                     "-- volume attachment id: %s - deleted volume id: %s", written=written)
         if not args.dry_run:
             log.info("- removing volume attachment inconsistencies found")
-            fix_wrong_volume_attachments(cinder_metadata, wrong_attachments, args.fix_limit)
+            if not fix_wrong_volume_attachments(meta, wrong_attachments, args.fix_limit, args.batch_size) and unfixed is not None:
+                unfixed.append('volume attachments')
     else:
         log.info("- volume attachments are consistent")
 
-    # fixing possible wrong snapshot metadata entries
-    wrong_metadata = get_wrong_snapshot_metadata(cinder_metadata)
+    return len(wrong_attachments)
+
+
+# check and fix possible wrong snapshot metadata entries
+def check_snapshot_metadata(meta, args, orphan_children=None, report=None, deleted_since=None):
+
+    if args.stream_results and not orphan_children:
+        return check_orphan_children_streamed(meta, args, 'snapshot_metadata', 'snapshot_metadata', "-- snapshot_metadata id: %s - deleted snapshot id: %s",
+                                              report, (deleted_since or {}).get('snapshots'))
+    wrong_metadata = orphan_children['snapshot_metadata'] if orphan_children else \
+        get_wrong_snapshot_metadata(meta, (deleted_since or {}).get('snapshots'), get_finding_writer(report, 'snapshot_metadata', 'snapshot_metadata'))
     if len(wrong_metadata) != 0:
         log.info("- snapshot_metadata inconsistencies found")
         # print out what we would delete
-        for snapshot_metadata_id in wrong_metadata:
-            log.info("-- snapshot_metadata id: %s - deleted snapshot id: %s", snapshot_metadata_id, wrong_metadata[snapshot_metadata_id])
+        log_findings(report, 'snapshot_metadata', 'snapshot_metadata', wrong_metadata,
+                     "-- snapshot_metadata id: %s - deleted snapshot id: %s", written=not orphan_children)
         if not args.dry_run:
             log.info("- removing snapshot_metadata inconsistencies found")
-            fix_wrong_snapshot_metadata(cinder_metadata, wrong_metadata)
+            fix_wrong_snapshot_metadata(meta, wrong_metadata, args.batch_size)
     else:
         log.info("- snapshot_metadata entries are consistent")
 
-    # fixing possible wrong group_volume_type_mappings entries
-    wrong_group_volume_type_mappings = get_wrong_group_volume_type_mappings(cinder_metadata)
+    return len(wrong_metadata)
+
+
+# check and fix possible wrong group_volume_type_mappings entries
+def check_group_volume_type_mappings(meta, args, finding_limit=None, report=None, unfixed=None):
+
+    wrong_group_volume_type_mappings = get_wrong_group_volume_type_mappings(meta, finding_limit,
+                                                                            get_finding_writer(report, 'group_volume_type_mappings', 'group_volume_type_mapping'))
     if len(wrong_group_volume_type_mappings) != 0:
         log.info("- group_volume_type_mappings inconsistencies found")
+        check_finding_limit(wrong_group_volume_type_mappings, finding_limit, 'group_volume_type_mappings inconsistencies')
         # print out what we would delete
-        for group_volume_type_mapping_id in wrong_group_volume_type_mappings:
-            log.info("-- group_volume_type_mapping id: %s - deleted group id: %s", group_volume_type_mapping_id, wrong_group_volume_type_mappings[group_volume_type_mapping_id])
+        log_findings(report, 'group_volume_type_mappings', 'group_volume_type_mapping', wrong_group_volume_type_mappings,
+                     "-- group_volume_type_mapping id: %s - deleted group id: %s", written=True)
         if not args.dry_run:
             log.info("- removing group_volume_type_mapping inconsistencies found")
-            fix_wrong_group_volume_type_mappings(cinder_metadata, wrong_group_volume_type_mappings, args.fix_limit)
+            if not fix_wrong_group_volume_type_mappings(meta, wrong_group_volume_type_mappings, args.fix_limit, args.batch_size) and unfixed is not None:
+                unfixed.append('group_volume_type_mappings')
     else:
         log.info("- group_volume_type_mappings are consistent")
 
-    # fixing possible missing deleted_at timestamps in some tables
-    # tables which sometimes have missing deleted_at values
-    table_names = ['snapshots', 'volume_attachment']
+    return len(wrong_group_volume_type_mappings)
+
 
-    missing_deleted_at = get_missing_deleted_at(cinder_metadata, table_names)
+# check and fix possible missing deleted_at timestamps in some tables
+def check_missing_deleted_at(meta, args, table_names, report=None):
+
+    missing_deleted_at = get_missing_deleted_at(meta, table_names, get_finding_writer(report, 'missing deleted_at'))
     if len(missing_deleted_at) != 0:
         log.info("- missing deleted_at values found:")
         # print out what we would delete
-        for missing_deleted_at_id in missing_deleted_at:
-            log.info("--- id %s of the %s table is missing deleted_at time", missing_deleted_at_id, missing_deleted_at[missing_deleted_at_id])
+        for table_name in table_names:
+            log_findings(report, 'missing deleted_at', table_name, [row_id for row_id, t in missing_deleted_at.items() if t == table_name],
+                         "--- id %s of the " + table_name + " table is missing deleted_at time", written=True)
         if not args.dry_run:
             log.info("- setting missing deleted_at values")
-            fix_missing_deleted_at(cinder_metadata, table_names)
+            fix_missing_deleted_at(meta, table_names)
     else:
         log.info("- no missing deleted_at values")
 
-    deleted_services_still_used_in_volumes = get_deleted_services_still_used_in_volumes(cinder_metadata)
+    return len(missing_deleted_at)
+
+
+# check and fix deleted services still used in volumes
+def check_deleted_services_still_used_in_volumes(meta, args, report=None):
+
+    deleted_services_still_used_in_volumes = get_deleted_services_still_used_in_volumes(meta, get_finding_writer(report, 'deleted services still used in volumes', 'services'))
     if len(deleted_services_still_used_in_volumes) != 0:
         log.info("- deleted services still used in volumes found:")
         # print out what we would delete
-        for deleted_services_still_used_in_volumes_id in deleted_services_still_used_in_volumes:
-            log.info("--- deleted service uuid %s still used in volumes table entry %s", deleted_services_still_used_in_volumes_id, deleted_services_still_used_in_volumes[deleted_services_still_used_in_volumes_id])
+        log_findings(report, 'deleted services still used in volumes', 'services', deleted_services_still_used_in_volumes,
+                     "--- deleted service uuid %s still used in volumes table entry %s", written=True)
         if not args.dry_run:
             log.info("- undeleting service uuid still used in volumes table")
-            fix_deleted_services_still_used_in_volumes(cinder_metadata, deleted_services_still_used_in_volumes)
+            fix_deleted_services_still_used_in_volumes(meta, deleted_services_still_used_in_volumes)
     else:
         log.info("- deleted services still used in volumes")
 
+    return len(deleted_services_still_used_in_volumes)
+
+
+# establish an openstack connection
+def makeOsConnection():
+    try:
+        conn = connection.Connection(auth_url=os.getenv('OS_AUTH_URL'),
+                                     project_name=os.getenv('OS_PROJECT_NAME'),
+                                     project_domain_name=os.getenv('OS_PROJECT_DOMAIN_NAME'),
+                                     username=os.getenv('OS_USERNAME'),
+                                     user_domain_name=os.getenv('OS_USER_DOMAIN_NAME'),
+                                     password=os.getenv('OS_PASSWORD'),
+                                     identity_api_version="3")
+    except Exception as e:
+        log.warn("- PLEASE CHECK MANUALLY - problems connecting to openstack: %s", str(e))
+        sys.exit(1)
+
+    return conn
+
+
+# establish a database connection and return the handle
+def makeConnection(db_url, schema_cache_dir=None, parallel=1):
+    # one pooled connection per check running in parallel and one spare for the main thread
+    engine = create_engine(db_url, pool_size=max(parallel + 1, 5))
+    engine.connect()
+    Session = sessionmaker(bind=engine)
+    thisSession = Session()
+    metadata = load_metadata(engine, schema_cache_dir)
+    Base = declarative_base()
+    return thisSession, metadata, Base
+
+
+# return the database connection string from the config file
+def get_db_url(config_file):
+    parser = configparser.ConfigParser()
+    try:
+        parser.read(config_file)
+        db_url = parser.get('database', 'connection', raw=True)
+    except Exception as e:
+        log.info("ERROR: Check Cinder configuration file - error %s", str(e))
+        sys.exit(2)
+    return db_url
+
+
+# cmdline handling
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config",
+                        default='./cinder.conf',
+                        help='configuration file')
+    parser.add_argument("--dry-run", action="store_true", help='print only what would be done without actually doing it')
+    parser.add_argument("--fix-limit", default=25, help='maximum number of inconsistencies to fix automatically - if there are more, automatic fixing is denied')
+    parser.add_argument("--count-first", action="store_true",
+                        help='fetch at most fix-limit + 1 findings for the checks limited by fix-limit - if there are more, only a sample is shown and fixing is denied')
+    parser.add_argument("--parallel", type=int, default=1, help='number of independent checks to run in parallel')
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help='maximum number of rows to soft delete per statement and transaction')
+    parser.add_argument("--schema-cache-dir", help='directory to cache the reflected db schema in between runs')
+    parser.add_argument("--inventory-page-size", type=int, default=DEFAULT_PAGE_SIZE, help='number of instances to request per page from the nova api')
+    parser.add_argument("--db-anti-join", action="store_true", help='find orphan volume attachments in the db against a temporary table of the nova instance uuids')
+    parser.add_argument("--nova-api-db-url", default=os.getenv('NOVA_API_DB_URL'),
+                        help='read-only connection string of the nova api db to read the nova instances from the cell dbs instead of the nova api')
+    parser.add_argument("--nova-cell-db-url-template", default=os.getenv('NOVA_CELL_DB_URL_TEMPLATE'),
+                        help='read-only connection string of the nova cell dbs with the variables of the cell mappings, e.g. '
+                        'mysql+pymysql://user:password@{hostname}:{port}/{path}?{query} - the read-write ones of the cell mappings otherwise')
+    parser.add_argument("--single-pass", action="store_true", help='find all orphan child rows of deleted volumes and snapshots in a single query')
+    parser.add_argument("--compare-single-pass", action="store_true", help='log the timings of the single pass orphan child scan compared to the separate checks')
+    parser.add_argument("--report-file", help='write the findings as JSON lines to this file instead of logging each of them')
+    parser.add_argument("--purge-older-than", type=int, help='purge the rows soft deleted more than this many days ago after the checks')
+    parser.add_argument("--purge-only", action="store_true", help='only purge the soft deleted rows without running the checks')
+    parser.add_argument("--purge-batch-size", type=int, default=DEFAULT_BATCH_SIZE, help='maximum number of rows to purge per statement and transaction')
+    parser.add_argument("--purge-pause", type=float, default=0.5, help='seconds to wait in between two purge chunks')
+    parser.add_argument("--stream-results", action="store_true", help='stream the metadata rows of deleted volumes and snapshots from the db in partitions of --batch-size rows and fix them partition by partition')
+    parser.add_argument("--incremental-state-file", help='file keeping the deleted volumes and snapshots high-water marks in between runs - only check the ones deleted since the last run')
+    parser.add_argument("--full-sweep-every", type=int, default=DEFAULT_FULL_SWEEP_EVERY, help='with --incremental-state-file check all deleted volumes and snapshots every this many runs')
+    parser.add_argument("--daemon", action="store_true", help='keep running and repeat the checks every interval seconds')
+    parser.add_argument("--interval", type=float, default=3600, help='seconds to wait between the runs in daemon mode')
+    parser.add_argument("--prom-port", type=int, default=9000, help='prometheus exporter port in daemon mode')
+    parser.add_argument("--pushgateway", default=os.getenv('PROMETHEUS_PUSHGATEWAY'),
+                        help='prometheus pushgateway to push the metrics of a run to when not in daemon mode')
+    return parser.parse_args()
+
+
+# purge the rows soft deleted more than --purge-older-than days ago in small chunks
+def purge_deleted_rows(purger, meta, args):
+
+    purger.purge(meta, args.purge_older_than, args.dry_run)
+
+
+# run all the checks once and return them with their results
+def run_consistency_checks(args, conn, cinder_metadata, purger=None):
+
+    # with --count-first the checks limited by fix_limit fetch at most one more finding than fix_limit
+    finding_limit = get_finding_limit(args.fix_limit, args.count_first)
+
+    # filled by the single pass orphan child scan with the results for the "child of deleted parent" checks
+    orphan_children = {}
+
+    # tables which sometimes have missing deleted_at values
+    table_names = ['snapshots', 'volume_attachment']
+
+    # the findings are written to the report file instead of being logged one by one
+    report = FindingsReport(args.report_file) if args.report_file else None
+
+    # filled with the names of the checks whose findings have not been fixed, because there were too many of them
+    unfixed = []
+
+    # in an incremental run the "child of deleted parent" checks only join against the parents deleted since the
+    # marks of the last successful run - the new marks are taken before the checks, so nothing deleted meanwhile is missed
+    watermarks = None
+    deleted_since = None
+    if args.incremental_state_file and not args.purge_only:
+        watermarks = WatermarkState(args.incremental_state_file, args.full_sweep_every)
+        full_sweep = watermarks.full_sweep_due()
+        deleted_since = watermarks.since()
+        new_marks = get_deleted_watermarks(cinder_metadata, ['volumes', 'snapshots'])
+        if full_sweep:
+            log.info("- incremental run: doing a full sweep of all deleted volumes and snapshots")
+        else:
+            log.info("- incremental run: only checking volumes and snapshots deleted since %s",
+                     ', '.join(f"{table_name} {since}" for table_name, since in sorted(deleted_since.items())))
+
+    # the checks in the order they run without --parallel - with the tables they read and (by their fixes) write,
+    # so that checks on the same tables keep this order when run in parallel
+    checks = [
+        Check('orphan volume attachments',
+              partial(check_orphan_volume_attachments, cinder_metadata, args, conn, finding_limit, report=report, unfixed=unfixed),
+              reads=['volume_attachment'], writes=['volume_attachment']),
+        Check('error_deleting volumes',
+              partial(check_error_deleting_volumes, cinder_metadata, args, report=report),
+              reads=['volumes'], writes=['volumes', 'volume_admin_metadata', 'volume_metadata', 'volume_attachment']),
+        Check('error_deleting snapshots',
+              partial(check_error_deleting_snapshots, cinder_metadata, args, report=report),
+              reads=['snapshots'], writes=['snapshots']),
+    ]
+    # the scan only reads, but the checks using its results have to wait for it - even in a dry run
+    orphan_child_scan = 'single pass orphan child scan'
+    if args.single_pass or args.compare_single_pass:
+        checks.append(Check(orphan_child_scan,
+                            partial(scan_orphan_children, cinder_metadata, args, orphan_children, deleted_since),
+                            reads=['volumes', 'snapshots'] + [child_table for (_, child_table, _, _) in ORPHAN_CHILD_CHECKS]))
+    checks += [
+        Check('volume_admin_metadata',
+              partial(check_volume_admin_metadata, cinder_metadata, args, orphan_children, report=report, deleted_since=deleted_since),
+              reads=['volumes'], writes=['volume_admin_metadata'], after=[orphan_child_scan]),
+        Check('volume_glance_metadata for volumes',
+              partial(check_volume_glance_metadata_volumes, cinder_metadata, args, orphan_children, report=report, deleted_since=deleted_since),
+              reads=['volumes'], writes=['volume_glance_metadata'], after=[orphan_child_scan]),
+        Check('volume_glance_metadata for snapshots',
+              partial(check_volume_glance_metadata_snapshots, cinder_metadata, args, orphan_children, report=report, deleted_since=deleted_since),
+              reads=['snapshots'], writes=['volume_glance_metadata'], after=[orphan_child_scan]),
+        Check('volume_metadata',
+              partial(check_volume_metadata, cinder_metadata, args, orphan_children, report=report, deleted_since=deleted_since),
+              reads=['volumes'], writes=['volume_metadata'], after=[orphan_child_scan]),
+        Check('volume attachments',
+              partial(check_volume_attachments, cinder_metadata, args, orphan_children, finding_limit, report=report,
+                      deleted_since=deleted_since, unfixed=unfixed),
+              reads=['volumes'], writes=['volume_attachment'], after=[orphan_child_scan]),
+        Check('snapshot_metadata',
+              partial(check_snapshot_metadata, cinder_metadata, args, orphan_children, report=report, deleted_since=deleted_since),
+              reads=['snapshots'], writes=['snapshot_metadata'], after=[orphan_child_scan]),
+        Check('group_volume_type_mappings',
+              partial(check_group_volume_type_mappings, cinder_metadata, args, finding_limit, report=report, unfixed=unfixed),
+              reads=['groups'], writes=['group_volume_type_mapping']),
+        Check('missing deleted_at',
+              partial(check_missing_deleted_at, cinder_metadata, args, table_names, report=report),
+              reads=table_names, writes=table_names),
+        Check('deleted services still used in volumes',
+              partial(check_deleted_services_still_used_in_volumes, cinder_metadata, args, report=report),
+              reads=['volumes'], writes=['services']),
+    ]
+    if args.purge_only:
+        checks = []
+    # the purge touches all tables, so it always runs after all the other checks
+    if args.purge_older_than:
+        checks.append(Check('purge', partial(purge_deleted_rows, purger, cinder_metadata, args),
+                            after=[check.name for check in checks]))
+    try:
+        run_checks(checks, args.parallel, read_only=args.dry_run)
+    finally:
+        if report:
+            report.close()
+
+    # a dry run fixes nothing and denied fixes leave findings behind, so the next run has to find the same
+    # inconsistencies again - the marks only advance once every check has fixed all its findings
+    if watermarks:
+        if args.dry_run or unfixed:
+            log.info("- incremental run: keeping the marks of the last run, as not all findings have been fixed (%s)",
+                     'dry run' if args.dry_run else ', '.join(unfixed))
+        else:
+            watermarks.advance(new_marks, full_sweep)
+            watermarks.save()
+
+    save_metadata(cinder_metadata)
+    return checks
+
+
+def main():
+    try:
+        args = parse_cmdline_args()
+    except Exception as e:
+        log.error("Check command line arguments (%s)", e.strerror)
+
+    # connect to openstack - only needed by the checks and not by the purge
+    conn = None if args.purge_only else makeOsConnection()
+
+    # connect to the DB
+    db_url = get_db_url(args.config)
+    cinder_session, cinder_metadata, cinder_Base = makeConnection(db_url, args.schema_cache_dir, args.parallel)
+
+    purger = DbPurger('cinder', args.purge_batch_size, args.purge_pause) if args.purge_older_than else None
+
+    if args.daemon:
+        # keep the openstack connection, the db engine and the reflected tables for all the runs
+        ConsistencyDaemon('cinder', partial(run_consistency_checks, args, conn, cinder_metadata, purger),
+                          args.interval, args.prom_port).run()
+    else:
+        try:
+            run_consistency_checks(args, conn, cinder_metadata, purger)
+        finally:
+            # the metrics of a one-shot run, e.g. the purge rates, would otherwise never be scraped
+            if args.pushgateway:
+                prometheus_push(args.pushgateway, 'cinder_nanny_purge' if args.purge_only else 'cinder_nanny_consistency')
+
 
 if __name__ == "__main__":
     main()
@@ -26,11 +26,51 @@ cp -vrL /cinder-etc/* /etc/cinder
 sed -i 's,raven\.handlers\.logging\.SentryHandler,logging.NullHandler,g' /etc/cinder/logging.ini
 
 DB_CONFIG="/etc/cinder/cinder.conf.d/secrets.conf"
+# the reflected db schema is cached here in between the loop runs
+SCHEMA_CACHE_DIR="/tmp/cinder-nanny-schema-cache"
+
+# in incremental mode the checks for children of deleted volumes and snapshots only look at the ones
+# deleted since the last run and only every CINDER_CONSISTENCY_FULL_SWEEP_EVERY runs at all of them
+if [ "$CINDER_CONSISTENCY_INCREMENTAL" = "True" ] || [ "$CINDER_CONSISTENCY_INCREMENTAL" = "true" ]; then
+    INCREMENTAL_ARGS="--incremental-state-file /tmp/cinder-nanny-watermarks.json --full-sweep-every ${CINDER_CONSISTENCY_FULL_SWEEP_EVERY:-24}"
+else
+    INCREMENTAL_ARGS=""
+fi
 
 # cinder is now using proxysql by default in its config - change that back to a normal
 # config for the nanny as we do not need it and do not have the proxy around by default
 sed -i 's,@/cinder?unix_socket=/run/proxysql/mysql.sock&,@cinder-mariadb/cinder?,g' "${DB_CONFIG}"
 
+# in daemon mode the consistency check is started only once and keeps its connections and
+# reflected tables in between its runs - the loop below then only takes care of the purge
+if [ "$CINDER_CONSISTENCY_ENABLED" = "True" ] || [ "$CINDER_CONSISTENCY_ENABLED" = "true" ]; then
+    if [ "$CINDER_CONSISTENCY_DAEMON" = "True" ] || [ "$CINDER_CONSISTENCY_DAEMON" = "true" ]; then
+        if [ "$CINDER_CONSISTENCY_DRY_RUN" = "False" ] || [ "$CINDER_CONSISTENCY_DRY_RUN" = "false" ]; then
+            if [ "$CINDER_CONSISTENCY_FIX_LIMIT" != "" ]; then
+                DAEMON_ARGS="--fix-limit $CINDER_CONSISTENCY_FIX_LIMIT"
+            else
+                DAEMON_ARGS=""
+            fi
+        else
+            DAEMON_ARGS="--dry-run"
+        fi
+        # the daemon purges right after its checks, so the loop does not have to
+        if [ "$CINDER_DB_PURGE_ENABLED" = "True" ] || [ "$CINDER_DB_PURGE_ENABLED" = "true" ]; then
+            DAEMON_ARGS="$DAEMON_ARGS --purge-older-than $CINDER_DB_PURGE_OLDER_THAN --purge-pause ${CINDER_DB_PURGE_PAUSE:-0.5}"
+            CINDER_DB_PURGE_ENABLED="false"
+        fi
+        echo "INFO: starting the cinder db consistency check daemon"
+        # restart the daemon should it ever exit - the loop below does not run the check anymore
+        while true; do
+            /var/lib/openstack/bin/python /scripts/cinder-consistency.py --config "${DB_CONFIG}" --schema-cache-dir "${SCHEMA_CACHE_DIR}" --parallel ${CINDER_CONSISTENCY_PARALLEL:-1} --daemon --interval $(( 60 * $CINDER_NANNY_INTERVAL )) --prom-port ${CINDER_CONSISTENCY_PROMETHEUS_PORT:-9000} $DAEMON_ARGS $INCREMENTAL_ARGS || true
+            echo -n "WARNING: the consistency check daemon exited - restarting it in a minute - "
+            date
+            sleep 60
+        done &
+        CINDER_CONSISTENCY_ENABLED="false"
+    fi
+fi
+
 # we run an endless loop to run the script periodically
 echo "INFO: starting a loop to periodically run the nanny job for the cinder db consistency check and purge"
 while true; do
@@ -43,17 +83,18 @@ while true; do
             fi
             echo -n "INFO: checking and fixing cinder db consistency - "
             date
-            /var/lib/openstack/bin/python /scripts/cinder-consistency.py --config "${DB_CONFIG}" $FIX_LIMIT
+            /var/lib/openstack/bin/python /scripts/cinder-consistency.py --config "${DB_CONFIG}" --schema-cache-dir "${SCHEMA_CACHE_DIR}" --parallel ${CINDER_CONSISTENCY_PARALLEL:-1} $FIX_LIMIT $INCREMENTAL_ARGS
         else
             echo -n "INFO: checking cinder db consistency - "
             date
-            /var/lib/openstack/bin/python /scripts/cinder-consistency.py --config "${DB_CONFIG}" --dry-run
+            /var/lib/openstack/bin/python /scripts/cinder-consistency.py --config "${DB_CONFIG}" --schema-cache-dir "${SCHEMA_CACHE_DIR}" --parallel ${CINDER_CONSISTENCY_PARALLEL:-1} --dry-run $INCREMENTAL_ARGS
         fi
     fi
     if [ "$CINDER_DB_PURGE_ENABLED" = "True" ] || [ "$CINDER_DB_PURGE_ENABLED" = "true" ]; then
         echo -n "INFO: purging deleted cinder entities older than $CINDER_DB_PURGE_OLDER_THAN days from the cinder db - "
         date
-        /var/lib/openstack/bin/cinder-manage db purge $CINDER_DB_PURGE_OLDER_THAN
+        # the purge metrics of this one-shot run are pushed to PROMETHEUS_PUSHGATEWAY if it is set
+        /var/lib/openstack/bin/python /scripts/cinder-consistency.py --config "${DB_CONFIG}" --schema-cache-dir "${SCHEMA_CACHE_DIR}" --purge-only --purge-older-than $CINDER_DB_PURGE_OLDER_THAN --purge-pause ${CINDER_DB_PURGE_PAUSE:-0.5}
     fi
     echo -n "INFO: waiting $CINDER_NANNY_INTERVAL minutes before starting the next loop run - "
     date
@@ -21,27 +21,35 @@
 import argparse
 import sys
 import configparser
-import datetime
+import time
 
 from prettytable import PrettyTable
+from prometheus_client import Counter, Gauge
 from sqlalchemy import and_
 from sqlalchemy import delete
 from sqlalchemy import func
-from sqlalchemy import MetaData
 from sqlalchemy import select
-from sqlalchemy import Table
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql.expression import false
 from sqlalchemy.ext.declarative import declarative_base
 
+from helper.db_schema import get_table, load_metadata, save_metadata
+from helper.project_pool import map_projects
+from helper.prometheus_exporter import LabelGauge, prometheus_http_start
+from helper.quota_usages import DEFAULT_PROJECT_BATCH_SIZE, QuotaUsagesWriter
+from helper.watermark import DEFAULT_FULL_SWEEP_EVERY, WatermarkState, get_changed_projects, get_changed_watermarks
+
+# the tables whose changes can make the quota usages of a project drift
+CHANGED_PROJECT_TABLES = ['volumes', 'snapshots']
+
 
 def get_projects(meta):
 
     """Return a list of all projects in the database"""
 
     projects = []
-    quota_usages_t = Table('quota_usages', meta, autoload=True)
+    quota_usages_t = get_table(meta, 'quota_usages')
     quota_usages_q = select(columns=[quota_usages_t.c.project_id]). group_by(quota_usages_t.c.project_id)
     for project in quota_usages_q.execute():
         projects.append(project[0])
@@ -67,44 +75,53 @@ def yn_choice():
             sys.stdout.write("Do you want to sync? [Yes/No/Abort]")
 
 
-def sync_quota_usages_project(meta, project_id, quota_usages_to_sync):
+def sync_quota_usages_project(writer, project_id, quota_usages_to_sync):
 
     """Sync the quota usages of a project from real usages"""
 
     print(("Syncing %s", project_id))
-    now = datetime.datetime.utcnow()
-    quota_usages_t = Table('quota_usages', meta, autoload=True)
-    for resource, quota in iter(list(quota_usages_to_sync.items())):
-        quota_usages_t.update().where(
-            and_(quota_usages_t.c.project_id == project_id,
-                 quota_usages_t.c.resource == resource)).values(
-            updated_at=now, in_use=quota).execute()
+    writer.add_project(project_id, ('resource',), quota_usages_to_sync)
+
+
+def sync_quota_usages(meta, quota_usages_to_sync, batch_size):
+
+    """Sync the quota usages of all given projects in batches of projects"""
+
+    quota_usages_t = get_table(meta, 'quota_usages')
+    with QuotaUsagesWriter(meta.bind, quota_usages_t, batch_size) as writer:
+        for project_id, project_quota_usages_to_sync in quota_usages_to_sync.items():
+            sync_quota_usages_project(writer, project_id,
+                                      project_quota_usages_to_sync)
+    print(("Synced %s projects: %s rows changed in %.2fs" %
+           (writer.projects_synced, writer.rows_changed, writer.duration)))
 
 
 def get_snapshot_usages_project(meta, project_id):
 
-    """Return the snapshot resource usages of a project"""
+    """Return the number and size of the snapshots of a project per volume type"""
 
-    snapshots_t = Table('snapshots', meta, autoload=True)
-    snapshots_q = select(columns=[snapshots_t.c.id,
-                                  snapshots_t.c.volume_size,
-                                  snapshots_t.c.volume_type_id],
+    snapshots_t = get_table(meta, 'snapshots')
+    snapshots_q = select(columns=[snapshots_t.c.volume_type_id,
+                                  func.count(),
+                                  func.coalesce(func.sum(snapshots_t.c.volume_size), 0)],
                          whereclause=and_(
                          snapshots_t.c.deleted == false(),
-                         snapshots_t.c.project_id == project_id))
+                         snapshots_t.c.project_id == project_id)).\
+        group_by(snapshots_t.c.volume_type_id)
     return snapshots_q.execute()
 
 
 def get_volume_usages_project(meta, project_id):
 
-    """Return the volume resource usages of a project"""
+    """Return the number and size of the volumes of a project per volume type"""
 
-    volumes_t = Table('volumes', meta, autoload=True)
-    volumes_q = select(columns=[volumes_t.c.id,
-                                volumes_t.c.size,
-                                volumes_t.c.volume_type_id],
+    volumes_t = get_table(meta, 'volumes')
+    volumes_q = select(columns=[volumes_t.c.volume_type_id,
+                                func.count(),
+                                func.coalesce(func.sum(volumes_t.c.size), 0)],
                        whereclause=and_(volumes_t.c.deleted == false(),
-                                        volumes_t.c.project_id == project_id))
+                                        volumes_t.c.project_id == project_id)).\
+        group_by(volumes_t.c.volume_type_id)
     return volumes_q.execute()
 
 
@@ -112,7 +129,7 @@ def get_quota_usages_project(meta, project_id):
 
     """Return the quota usages of a project"""
 
-    quota_usages_t = Table('quota_usages', meta, autoload=True)
+    quota_usages_t = get_table(meta, 'quota_usages')
     quota_usages_q = select(columns=[quota_usages_t.c.resource,
                                      quota_usages_t.c.in_use],
                             whereclause=and_(quota_usages_t.c.deleted == false(),
@@ -126,7 +143,7 @@ def get_resource_types(meta, project_id):
     """Return a list of all resource types"""
 
     types = []
-    quota_usages_t = Table('quota_usages', meta, autoload=True)
+    quota_usages_t = get_table(meta, 'quota_usages')
     resource_types_q = select(columns=[quota_usages_t.c.resource,
                                        func.count()],
                               whereclause=quota_usages_t.c.deleted == false(),
@@ -141,7 +158,7 @@ def get_volume_types(meta, project_id):
     """Return a dict with volume type id to name mapping"""
 
     types = {}
-    volume_types_t = Table('volume_types', meta, autoload=True)
+    volume_types_t = get_table(meta, 'volume_types')
     volume_types_q = select(columns=[volume_types_t.c.id,
                                      volume_types_t.c.name],
                             whereclause=volume_types_t.c.deleted == false())
@@ -150,16 +167,233 @@ def get_volume_types(meta, project_id):
     return types
 
 
-def makeConnection(db_url):
+def get_quota_usages_all(meta, projects=None):
+
+    """Return the quota usages of all (or the given) projects as dict of project to dict of resource to usage"""
+
+    quota_usages = {}
+    quota_usages_t = get_table(meta, 'quota_usages')
+    quota_usages_q = select(columns=[quota_usages_t.c.project_id,
+                                     quota_usages_t.c.resource,
+                                     quota_usages_t.c.in_use],
+                            whereclause=quota_usages_t.c.deleted == false())
+    if projects is not None:
+        quota_usages_q = quota_usages_q.where(quota_usages_t.c.project_id.in_(projects))
+    for (project_id, resource, in_use) in quota_usages_q.execute():
+        quota_usages.setdefault(project_id, {})[resource] = in_use
+    return quota_usages
+
+
+def get_volume_usages_all(meta, projects=None):
+
+    """Return the number and size of the volumes of all (or the given) projects per project and volume type"""
+
+    volumes_t = get_table(meta, 'volumes')
+    volumes_q = select(columns=[volumes_t.c.project_id,
+                                volumes_t.c.volume_type_id,
+                                func.count(),
+                                func.coalesce(func.sum(volumes_t.c.size), 0)],
+                       whereclause=volumes_t.c.deleted == false()).\
+        group_by(volumes_t.c.project_id, volumes_t.c.volume_type_id)
+    if projects is not None:
+        volumes_q = volumes_q.where(volumes_t.c.project_id.in_(projects))
+    return volumes_q.execute()
+
+
+def get_snapshot_usages_all(meta, projects=None):
+
+    """Return the number and size of the snapshots of all (or the given) projects per project and volume type"""
+
+    snapshots_t = get_table(meta, 'snapshots')
+    snapshots_q = select(columns=[snapshots_t.c.project_id,
+                                  snapshots_t.c.volume_type_id,
+                                  func.count(),
+                                  func.coalesce(func.sum(snapshots_t.c.volume_size), 0)],
+                         whereclause=snapshots_t.c.deleted == false()).\
+        group_by(snapshots_t.c.project_id, snapshots_t.c.volume_type_id)
+    if projects is not None:
+        snapshots_q = snapshots_q.where(snapshots_t.c.project_id.in_(projects))
+    return snapshots_q.execute()
+
+
+def get_real_usages_all(meta, projects, resource_types, volume_types, only_projects=None, rows_scanned=None):
+
+    """Return the real usages of the given projects as dict of project to dict of resource to usage"""
+
+    real_usages = {}
+    for project_id in projects:
+        real_usages[project_id] = dict.fromkeys(resource_types, 0)
+    for (usages_all, kind) in ((get_volume_usages_all(meta, only_projects), "volumes"),
+                               (get_snapshot_usages_all(meta, only_projects), "snapshots")):
+        for (project_id, type_id, count, size) in usages_all:
+            # the number of volumes and snapshots aggregated by the db
+            if rows_scanned is not None:
+                rows_scanned[kind] = rows_scanned.get(kind, 0) + count
+            if project_id not in real_usages:
+                continue
+            usages = real_usages[project_id]
+            resources = [(kind, count), ("gigabytes", size)]
+            if type_id in volume_types:
+                resources += [(kind + "_" + volume_types[type_id], count),
+                              ("gigabytes_" + volume_types[type_id], size)]
+            for (resource, value) in resources:
+                if resource in usages:
+                    usages[resource] += int(value)
+    return real_usages
+
+
+def get_quota_drifts(meta, resource_types, volume_types, projects=None, rows_scanned=None):
+
+    """Return the quota usages differing from the real usages of all (or the given) projects
+
+    The result is a dict of all projects checked to a dict of resource to a
+    tuple of quota usage and real usage. rows_scanned, if given, is filled
+    with the number of rows checked per table.
+    """
+
+    quota_usages = get_quota_usages_all(meta, projects)
+    real_usages = get_real_usages_all(meta, quota_usages.keys(),
+                                      resource_types, volume_types, projects,
+                                      rows_scanned)
+    if rows_scanned is not None:
+        rows_scanned["quota_usages"] = sum(len(usages) for usages in quota_usages.values())
+
+    drifts = {}
+    for project_id, project_quota_usages in quota_usages.items():
+        drifts[project_id] = {}
+        for resource, in_use in project_quota_usages.items():
+            if resource not in real_usages[project_id]:
+                continue
+            if real_usages[project_id][resource] != in_use:
+                drifts[project_id][resource] = (in_use, real_usages[project_id][resource])
+    return drifts
+
+
+def check_all_projects(meta, resource_types, volume_types, projects=None):
+
+    """Return the quota usages to sync of all (or the given) projects as dict of project to dict of resource to usage"""
+
+    drifts = get_quota_drifts(meta, resource_types, volume_types, projects)
+
+    # prepare the output - only the mismatches, as all projects would be too much
+    ptable = PrettyTable(["Project ID", "Resource", "Quota -> Real",
+                         "Sync Status"])
+
+    # find discrepancies between quota usage and real usage
+    quota_usages_to_sync = {}
+    for project_id, project_drifts in drifts.items():
+        for resource, (in_use, real_usage) in project_drifts.items():
+            quota_usages_to_sync.setdefault(project_id, {})[resource] = real_usage
+            ptable.add_row([project_id, resource,
+                           str(in_use) + ' -> ' + str(real_usage),
+                           '\033[1m\033[91mMISMATCH\033[0m'])
+
+    print(("Checked %s projects - %s of them with mismatches" %
+           (len(drifts), len(quota_usages_to_sync))))
+    if quota_usages_to_sync:
+        print(ptable)
+    return quota_usages_to_sync
+
+
+class QuotaDriftExporter:
+
+    """Export the quota usage drift of all projects as prometheus metrics
+
+    Every interval the usages of all projects are checked in one pass and
+    the difference of real usage and quota usage is exported per project and
+    resource. The series of drifts which are gone are removed again.
+    """
+
+    def __init__(self, meta, interval, prom_port):
+        self.meta = meta
+        self.interval = interval
+        self.drift_gauge = LabelGauge('cinder_nanny_quota_usage_drift',
+                                      'real usage minus quota usage of a resource of a project',
+                                      ['project_id', 'resource'])
+        self.projects_gauge = Gauge('cinder_nanny_quota_drift_projects',
+                                    'number of projects checked by the last run')
+        self.rows_scanned_gauge = Gauge('cinder_nanny_quota_drift_rows_scanned',
+                                        'number of rows of a table checked by the last run',
+                                        ['table'])
+        self.run_duration_gauge = Gauge('cinder_nanny_quota_drift_run_duration_seconds',
+                                        'duration of the last run')
+        self.run_failures_counter = Counter('cinder_nanny_quota_drift_run_failures',
+                                            'number of runs failed with an error')
+        prometheus_http_start(prom_port)
+
+    def _run(self):
+        start = time.monotonic()
+        # the types might have changed since the last run
+        volume_types = get_volume_types(self.meta, None)
+        resource_types = get_resource_types(self.meta, None)
+        rows_scanned = {}
+        drifts = get_quota_drifts(self.meta, resource_types, volume_types,
+                                  rows_scanned=rows_scanned)
+        self.drift_gauge.export_values(
+            ({'project_id': project_id, 'resource': resource}, real_usage - in_use)
+            for project_id, project_drifts in drifts.items()
+            for resource, (in_use, real_usage) in project_drifts.items())
+        self.projects_gauge.set(len(drifts))
+        for table, count in rows_scanned.items():
+            self.rows_scanned_gauge.labels(table=table).set(count)
+        duration = time.monotonic() - start
+        self.run_duration_gauge.set(duration)
+        print(("Checked %s projects in %.2fs - %s of them with drifts" %
+               (len(drifts), duration,
+                len([drift for drift in drifts.values() if drift]))))
+
+    def run(self):
+        while True:
+            try:
+                self._run()
+            except Exception as e:
+                print(("ERROR: quota drift run failed: %s" % str(e)))
+                self.run_failures_counter.inc()
+            time.sleep(self.interval)
+
+
+def check_project(meta, project_id, resource_types, volume_types):
+
+    """Return the quota usage and the real usage of a project per resource
+
+    Only the resources with a quota usage are returned - as a list of
+    (resource, quota usage, real usage) tuples in the order of resource_types.
+    """
+
+    # get the quota usage of a project
+    quota_usages = {}
+    for (resource, count) in get_quota_usages_project(meta, project_id):
+        quota_usages[resource] = count
+
+    # get the real usage of a project
+    real_usages = {}
+    for resource in resource_types:
+        real_usages[resource] = 0
+    for (type_id, count, size) in get_volume_usages_project(meta, project_id):
+        real_usages["volumes"] += count
+        real_usages["volumes_" + volume_types[type_id]] += count
+        real_usages["gigabytes"] += int(size)
+        real_usages["gigabytes_" + volume_types[type_id]] += int(size)
+    for (type_id, count, size) in get_snapshot_usages_project(meta, project_id):
+        real_usages["snapshots"] += count
+        real_usages["snapshots_" + volume_types[type_id]] += count
+        real_usages["gigabytes"] += int(size)
+        real_usages["gigabytes_" + volume_types[type_id]] += int(size)
+
+    return [(resource, quota_usages[resource], real_usages[resource])
+            for resource in resource_types if resource in quota_usages]
+
+
+def makeConnection(db_url, schema_cache_dir=None, workers=1):
 
     """Establish a database connection and return the handle"""
 
-    engine = create_engine(db_url)
+    # every worker needs its own connection from the pool
+    engine = create_engine(db_url, pool_size=max(workers, 5))
     engine.connect()
     Session = sessionmaker(bind=engine)
     thisSession = Session()
-    metadata = MetaData()
-    metadata.bind = engine
+    metadata = load_metadata(engine, schema_cache_dir)
     Base = declarative_base()
     tpl = thisSession, metadata, Base
     return tpl
@@ -190,6 +424,18 @@ def parse_cmdline_args():
     parser.add_argument("--sync",
                         action="store_true",
                         help="always sync resources (no interactive check)")
+    parser.add_argument("--sync-batch-size",
+                        type=int,
+                        default=DEFAULT_PROJECT_BATCH_SIZE,
+                        help="number of projects to sync per transaction")
+    parser.add_argument("--incremental-state-file",
+                        help="with --all-projects only check the projects changed since the last run and keep the high-water marks in this file")
+    parser.add_argument("--full-sweep-every",
+                        type=int,
+                        default=DEFAULT_FULL_SWEEP_EVERY,
+                        help="with --incremental-state-file check all projects every this many runs")
+    parser.add_argument("--schema-cache-dir",
+                        help="directory to cache the reflected db schema in between runs")
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--list_projects",
                        action="store_true",
@@ -197,6 +443,27 @@ def parse_cmdline_args():
     group.add_argument("--project_id",
                        type=str,
                        help="project to check")
+    group.add_argument("--all-projects",
+                       action="store_true",
+                       help="check all projects in one run with a few aggregates")
+    group.add_argument("--each-project",
+                       action="store_true",
+                       help="check all projects in one run project by project")
+    group.add_argument("--exporter",
+                       action="store_true",
+                       help="keep running and export the quota usage drift of all projects as prometheus metrics")
+    parser.add_argument("--interval",
+                        type=float,
+                        default=3600,
+                        help="seconds to wait between the runs in exporter mode")
+    parser.add_argument("--prom-port",
+                        type=int,
+                        default=9000,
+                        help="prometheus exporter port in exporter mode")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=1,
+                        help="with --each-project check this many projects in parallel - also the maximum number of db connections used")
     return parser.parse_args()
 
 
@@ -208,7 +475,14 @@ def main():
 
     # connect to the DB
     db_url = get_db_url(args.config)
-    cinder_session, cinder_metadata, cinder_Base = makeConnection(db_url)
+    cinder_session, cinder_metadata, cinder_Base = makeConnection(db_url, args.schema_cache_dir,
+                                                                  args.workers)
+
+    # export the quota usage drift of all projects periodically
+    #
+    if args.exporter:
+        save_metadata(cinder_metadata)
+        QuotaDriftExporter(cinder_metadata, args.interval, args.prom_port).run()
 
     # get the volume types
     volume_types = get_volume_types(cinder_metadata,
@@ -223,64 +497,116 @@ def main():
     if args.list_projects:
         for p in get_projects(cinder_metadata):
             print(p)
+        save_metadata(cinder_metadata)
         sys.exit(0)
 
-    # check a single project
+    # check/sync all projects in one run
     #
-    print(("Checking " + args.project_id + " ..."))
+    if args.all_projects:
+        # in delta mode only the projects with volume or snapshot changes
+        # since the last successful run are checked
+        watermarks = None
+        projects = None
+        if args.incremental_state_file:
+            watermarks = WatermarkState(args.incremental_state_file,
+                                        args.full_sweep_every)
+            full_sweep = watermarks.full_sweep_due()
+            new_marks = get_changed_watermarks(cinder_metadata,
+                                               CHANGED_PROJECT_TABLES)
+            if full_sweep:
+                print("Checking all projects (full sweep)")
+            else:
+                changed_since = watermarks.since()
+                projects = get_changed_projects(cinder_metadata,
+                                                {table_name: changed_since.get(table_name)
+                                                 for table_name in CHANGED_PROJECT_TABLES})
+                print(("Checking the %s projects changed since the last run" %
+                       len(projects)))
+        quota_usages_to_sync = check_all_projects(cinder_metadata,
+                                                  resource_types,
+                                                  volume_types,
+                                                  projects)
+        synced = bool(quota_usages_to_sync) and not args.nosync and (args.sync or yn_choice())
+        if synced:
+            sync_quota_usages(cinder_metadata, quota_usages_to_sync,
+                              args.sync_batch_size)
+        # projects with mismatches left have to be checked again next time
+        if watermarks and (synced or not quota_usages_to_sync):
+            watermarks.advance(new_marks, full_sweep)
+            watermarks.save()
+        save_metadata(cinder_metadata)
+        sys.exit(0)
 
-    # get the quota usage of a project
-    quota_usages = {}
-    for (resource, count) in get_quota_usages_project(cinder_metadata,
-                                                      args.project_id):
-        quota_usages[resource] = count
+    # check/sync all projects one by one on up to args.workers threads
+    #
+    if args.each_project:
+        projects = get_projects(cinder_metadata)
+        print(("Checking %s projects on %s workers ..." %
+               (len(projects), args.workers)))
+        results, failed_projects = map_projects(lambda project_id: check_project(cinder_metadata,
+                                                                                 project_id,
+                                                                                 resource_types,
+                                                                                 volume_types),
+                                                projects, args.workers)
+
+        # the results are merged in project order, so the output does not
+        # depend on which worker finished first
+        ptable = PrettyTable(["Project ID", "Resource", "Quota -> Real",
+                             "Sync Status"])
+        quota_usages_to_sync = {}
+        for project_id, usages in results:
+            for resource, quota, real in usages:
+                if quota != real:
+                    quota_usages_to_sync.setdefault(project_id, {})[resource] = real
+                    ptable.add_row([project_id, resource,
+                                   str(quota) + ' -> ' + str(real),
+                                   '\033[1m\033[91mMISMATCH\033[0m'])
+        if quota_usages_to_sync:
+            print(ptable)
+        print(("%s of %s projects with quota usage mismatches" %
+               (len(quota_usages_to_sync), len(results))))
+        if failed_projects:
+            print(("%s projects could not be checked: %s" %
+                   (len(failed_projects), ', '.join(failed_projects))))
+        if quota_usages_to_sync and not args.nosync and (args.sync or yn_choice()):
+            sync_quota_usages(cinder_metadata, quota_usages_to_sync,
+                              args.sync_batch_size)
+        save_metadata(cinder_metadata)
+        sys.exit(0)
 
-    # get the real usage of a project
-    real_usages = {}
-    for resource in resource_types:
-        real_usages[resource] = 0
-    for (_, size, type_id) in get_volume_usages_project(cinder_metadata,
-                                                        args.project_id):
-        real_usages["volumes"] += 1
-        real_usages["volumes_" + volume_types[type_id]] += 1
-        real_usages["gigabytes"] += size
-        real_usages["gigabytes_" + volume_types[type_id]] += size
-    for (_, size, type_id) in get_snapshot_usages_project(cinder_metadata,
-                                                          args.project_id):
-        real_usages["snapshots"] += 1
-        real_usages["snapshots_" + volume_types[type_id]] += 1
-        real_usages["gigabytes"] += size
-        real_usages["gigabytes_" + volume_types[type_id]] += size
+    # check a single project
+    #
+    print(("Checking " + args.project_id + " ..."))
 
     # prepare the output
     ptable = PrettyTable(["Project ID", "Resource", "Quota -> Real",
                          "Sync Status"])
 
     # find discrepancies between quota usage and real usage
+    usages = check_project(cinder_metadata, args.project_id, resource_types,
+                           volume_types)
     quota_usages_to_sync = {}
-    for resource in resource_types:
-        try:
-            if real_usages[resource] != quota_usages[resource]:
-                quota_usages_to_sync[resource] = real_usages[resource]
-                ptable.add_row([args.project_id, resource,
-                               str(quota_usages[resource]) + ' -> ' +
-                               str(real_usages[resource]),
-                               '\033[1m\033[91mMISMATCH\033[0m'])
-            else:
-                ptable.add_row([args.project_id, resource,
-                               str(quota_usages[resource]) + ' -> ' +
-                               str(real_usages[resource]),
-                               '\033[1m\033[92mOK\033[0m'])
-        except KeyError:
-            pass
-
-    if len(quota_usages):
+    for resource, quota, real in usages:
+        if real != quota:
+            quota_usages_to_sync[resource] = real
+            ptable.add_row([args.project_id, resource,
+                           str(quota) + ' -> ' + str(real),
+                           '\033[1m\033[91mMISMATCH\033[0m'])
+        else:
+            ptable.add_row([args.project_id, resource,
+                           str(quota) + ' -> ' + str(real),
+                           '\033[1m\033[92mOK\033[0m'])
+
+    if len(usages):
         print(ptable)
 
     # sync the quota with the real usage
     if quota_usages_to_sync and not args.nosync and (args.sync or yn_choice()):
-        sync_quota_usages_project(cinder_metadata, args.project_id,
-                                  quota_usages_to_sync)
+        sync_quota_usages(cinder_metadata,
+                          {args.project_id: quota_usages_to_sync},
+                          args.sync_batch_size)
+
+    save_metadata(cinder_metadata)
 
 
 if __name__ == "__main__":
@@ -26,11 +26,19 @@ cp -vrL /cinder-etc/* /etc/cinder
 sed -i 's,raven\.handlers\.logging\.SentryHandler,logging.NullHandler,g' /etc/cinder/logging.ini
 
 DB_CONFIG="/etc/cinder/cinder.conf.d/secrets.conf"
+# the reflected db schema is cached here, so that the per project runs do not have to reflect it again
+SCHEMA_CACHE_DIR="/tmp/cinder-nanny-schema-cache"
 
 # cinder is now using proxysql by default in its config - change that back to a normal
 # config for the nanny as we do not need it and do not have the proxy around by default
 sed -i 's,@/cinder?unix_socket=/run/proxysql/mysql.sock&,@cinder-mariadb/cinder?,g' "${DB_CONFIG}"
 
+# the quota drift exporter is started only once and checks all projects every interval on its own
+if [ "$CINDER_QUOTA_DRIFT_EXPORTER_ENABLED" = "True" ] || [ "$CINDER_QUOTA_DRIFT_EXPORTER_ENABLED" = "true" ]; then
+    echo "INFO: starting the cinder quota drift exporter"
+    /var/lib/openstack/bin/python /scripts/cinder-quota-sync.py --config "${DB_CONFIG}" --schema-cache-dir "${SCHEMA_CACHE_DIR}" --exporter --interval $(( 60 * $CINDER_NANNY_INTERVAL )) --prom-port ${CINDER_QUOTA_DRIFT_PROMETHEUS_PORT:-9000} &
+fi
+
 # we run an endless loop to run the script periodically
 echo "INFO: starting a loop to periodically run the nanny jobs for the cinder db"
 while true; do
@@ -43,10 +51,25 @@ while true; do
             SYNC_MODE="--nosync"
             echo "INFO: running in dry-run mode only!"
         fi
-        for i in `/var/lib/openstack/bin/python /scripts/cinder-quota-sync.py --config "${DB_CONFIG}" --list_projects`; do
-            echo project: $i
-            /var/lib/openstack/bin/python /scripts/cinder-quota-sync.py --config "${DB_CONFIG}" $SYNC_MODE --project_id $i
-        done
+        if [ "$CINDER_QUOTA_SYNC_ALL_PROJECTS" = "True" ] || [ "$CINDER_QUOTA_SYNC_ALL_PROJECTS" = "true" ]; then
+            # in delta mode only the projects changed since the last run are checked and only
+            # every CINDER_QUOTA_SYNC_FULL_SWEEP_EVERY runs all of them
+            if [ "$CINDER_QUOTA_SYNC_INCREMENTAL" = "True" ] || [ "$CINDER_QUOTA_SYNC_INCREMENTAL" = "true" ]; then
+                INCREMENTAL_ARGS="--incremental-state-file /tmp/cinder-quota-sync-watermarks.json --full-sweep-every ${CINDER_QUOTA_SYNC_FULL_SWEEP_EVERY:-24}"
+            else
+                INCREMENTAL_ARGS=""
+            fi
+            # check all projects in one process with a few aggregates instead of one process per project
+            /var/lib/openstack/bin/python /scripts/cinder-quota-sync.py --config "${DB_CONFIG}" --schema-cache-dir "${SCHEMA_CACHE_DIR}" $SYNC_MODE --all-projects $INCREMENTAL_ARGS
+        elif [ -n "$CINDER_QUOTA_SYNC_WORKERS" ]; then
+            # check the projects one by one, but in one process on up to CINDER_QUOTA_SYNC_WORKERS threads
+            /var/lib/openstack/bin/python /scripts/cinder-quota-sync.py --config "${DB_CONFIG}" --schema-cache-dir "${SCHEMA_CACHE_DIR}" $SYNC_MODE --each-project --workers $CINDER_QUOTA_SYNC_WORKERS
+        else
+            for i in `/var/lib/openstack/bin/python /scripts/cinder-quota-sync.py --config "${DB_CONFIG}" --schema-cache-dir "${SCHEMA_CACHE_DIR}" --list_projects`; do
+                echo project: $i
+                /var/lib/openstack/bin/python /scripts/cinder-quota-sync.py --config "${DB_CONFIG}" --schema-cache-dir "${SCHEMA_CACHE_DIR}" $SYNC_MODE --project_id $i
+            done
+        fi
     fi
     echo -n "INFO: waiting $CINDER_NANNY_INTERVAL minutes before starting the next loop run - "
     date
@@ -0,0 +1,160 @@
+#
+# Copyright (c) 2026 SAP SE
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import concurrent.futures
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Check:
+    """A named consistency check together with the db tables it reads and writes
+
+    Once the check has run, result holds the return value of func (e.g. the
+    number of inconsistencies found) and duration its runtime in seconds.
+
+    :param string name: name of the check for logging
+    :param func: callable without arguments running the check and its fix
+    :param reads: names of the tables the check reads
+    :param writes: names of the tables the check (or its fix) writes
+    :param after: names of earlier checks whose results the check uses
+    """
+
+    def __init__(self, name, func, reads=(), writes=(), after=()):
+        self.name = name
+        self.func = func
+        self.reads = set(reads) | set(writes)
+        self.writes = set(writes)
+        self.after = set(after)
+        self.result = None
+        self.duration = None
+
+    def conflicts(self, other):
+        """Return True if the check must not run concurrently with the other check"""
+        return bool(self.writes & other.reads or other.writes & self.reads)
+
+
+class _LogBuffer(logging.Filter):
+    """Hold back the log records of a thread running a check until the check is finished
+
+    The filter is added to the handlers of the root logger. Records of threads
+    which have not started buffering pass through unchanged.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._local = threading.local()
+        self._flush_lock = threading.Lock()
+
+    def start(self):
+        self._local.records = []
+
+    def flush(self):
+        records = self._local.records
+        self._local.records = None
+        # keep the output of a check together even if other checks finish at the same time
+        with self._flush_lock:
+            for record in records:
+                logging.getLogger(record.name).handle(record)
+
+    def filter(self, record):
+        records = getattr(self._local, 'records', None)
+        if records is None:
+            return True
+        # the filter is called once per handler for the same record
+        if not records or records[-1] is not record:
+            records.append(record)
+        return False
+
+
+def _run_check(check):
+    start = time.monotonic()
+    check.result = check.func()
+    check.duration = time.monotonic() - start
+    log.info("- check %s took %.1fs", check.name, check.duration)
+    return check.duration
+
+
+def _run_check_buffered(check, depends_on, log_buffer):
+    concurrent.futures.wait(depends_on)
+    for future in depends_on:
+        if future.exception() is not None:
+            raise RuntimeError("skipped, as an earlier check it has to run after failed")
+    log_buffer.start()
+    try:
+        return _run_check(check)
+    finally:
+        log_buffer.flush()
+
+
+def run_checks(checks, parallel=1, read_only=False):
+    """Run the checks, independent ones concurrently on up to parallel threads
+
+    A check only starts after all earlier checks in the list it conflicts
+    with or has to run after are finished, i.e. checks touching the same
+    tables keep their order as long as one of them writes. With read_only
+    (e.g. in a dry run) no check writes, so only the after dependencies are
+    kept. The log output of
+    each check is held back and written in one piece once it is finished.
+
+    The callables of the checks share one sqlalchemy engine, which has to
+    have a connection pool of at least parallel connections.
+
+    :param checks: list of Check objects
+    :param int parallel: maximum number of checks running at the same time
+    :param bool read_only: the checks will not write anything
+    :return dict: duration in seconds per check name
+    """
+    start = time.monotonic()
+    durations = {}
+
+    if parallel <= 1:
+        for check in checks:
+            durations[check.name] = _run_check(check)
+    else:
+        log_buffer = _LogBuffer()
+        handlers = list(logging.getLogger().handlers)
+        for handler in handlers:
+            handler.addFilter(log_buffer)
+        futures = []
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=parallel, thread_name_prefix='check') as executor:
+                # the executor starts the checks in the order they were submitted, so all the checks
+                # one depends on are already running when it starts waiting for them
+                for i, check in enumerate(checks):
+                    depends_on = [futures[j] for j in range(i) if checks[j].name in check.after or
+                                  (not read_only and check.conflicts(checks[j]))]
+                    futures.append(executor.submit(_run_check_buffered, check, depends_on, log_buffer))
+        finally:
+            for handler in handlers:
+                handler.removeFilter(log_buffer)
+
+        failed = []
+        for check, future in zip(checks, futures):
+            if future.exception() is not None:
+                log.error("- check %s failed: %s", check.name, str(future.exception()))
+                failed.append(future.exception())
+            else:
+                durations[check.name] = future.result()
+        if failed:
+            raise failed[0]
+
+    log.info("- finished %s checks in %.1fs with up to %s of them running in parallel",
+             len(checks), time.monotonic() - start, max(parallel, 1))
+    return durations
@@ -0,0 +1,84 @@
+#
+# Copyright (c) 2026 SAP SE
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import logging
+import time
+
+from prometheus_client import Counter, Gauge
+
+from .prometheus_exporter import prometheus_http_start
+
+log = logging.getLogger(__name__)
+
+
+class ConsistencyDaemon:
+    """Run the consistency checks of a nanny periodically in one long running process
+
+    Compared to starting a fresh interpreter for every run, the db engine
+    with its connection pool, the reflected tables and the openstack
+    connection stay around between the runs. The finding counts and
+    durations of the checks are exported as prometheus metrics.
+
+    :param string service: name of the service, used as metric name prefix
+    :param run_once: callable without arguments running all the checks once
+        and returning the list of Check objects which were run
+    :param float interval: seconds to wait between the end of a run and the
+        start of the next one
+    :param int prom_port: port of the prometheus exporter
+    """
+
+    def __init__(self, service, run_once, interval, prom_port):
+        self.run_once = run_once
+        self.interval = interval
+
+        self.findings_gauge = Gauge(f'{service}_nanny_consistency_findings',
+                                    'number of inconsistencies found by the last run of a check', ['check'])
+        self.check_duration_gauge = Gauge(f'{service}_nanny_consistency_check_duration_seconds',
+                                          'duration of the last run of a check', ['check'])
+        self.run_duration_gauge = Gauge(f'{service}_nanny_consistency_run_duration_seconds',
+                                        'duration of the last run of all checks')
+        self.last_success_gauge = Gauge(f'{service}_nanny_consistency_last_success_timestamp_seconds',
+                                        'time of the last run of all checks without errors')
+        self.run_failures_counter = Counter(f'{service}_nanny_consistency_run_failures',
+                                            'number of runs of all checks failed with an error')
+
+        prometheus_http_start(prom_port)
+
+    def _run(self):
+        start = time.monotonic()
+        try:
+            checks = self.run_once()
+        # the helpers of the one-shot runs exit on api errors - which must not end the daemon
+        except (Exception, SystemExit) as e:
+            log.exception("- PLEASE CHECK MANUALLY - consistency run failed: %s", str(e))
+            self.run_failures_counter.inc()
+            return
+        for check in checks:
+            if check.duration is None:
+                continue
+            self.check_duration_gauge.labels(check=check.name).set(check.duration)
+            # checks which only purge or scan do not report a number of findings
+            if check.result is not None:
+                self.findings_gauge.labels(check=check.name).set(check.result)
+        self.run_duration_gauge.set(time.monotonic() - start)
+        self.last_success_gauge.set_to_current_time()
+
+    def run(self):
+        while True:
+            self._run()
+            log.info("- waiting %s seconds before the next consistency run", self.interval)
+            time.sleep(self.interval)
@@ -0,0 +1,137 @@
+#
+# Copyright (c) 2026 SAP SE
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import datetime
+import itertools
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def chunks(items, size):
+    """Yield successive lists of at most size items
+
+    The items are consumed lazily, so only one chunk of them exists as a
+    list at a time - e.g. the uuid strings of a UUIDSet.
+    """
+    items = iter(items)
+    size = max(int(size), 1)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def soft_delete_q(table, column, ids, now, deleted_as_id=False):
+    """Return the statement soft deleting the rows of a table where column is in ids"""
+    deleted = table.c.id if deleted_as_id else 1
+    return table.update().where(column.in_(ids)).values(updated_at=now, deleted_at=now, deleted=deleted)
+
+
+def soft_delete_rows(engine, table, ids, batch_size=DEFAULT_BATCH_SIZE, column=None, deleted_as_id=False):
+    """Soft delete the rows of a table matching the given ids in chunks
+
+    Each chunk is a single ``UPDATE ... WHERE <column> IN (...)`` running in its
+    own transaction with one timestamp for all of its rows. By default the rows
+    are matched by their id column and deleted is set to 1 - manila and nova
+    store the row id in deleted instead, which deleted_as_id takes care of.
+
+    :param engine: sqlalchemy engine (or bound metadata.bind)
+    :param table: reflected sqlalchemy table
+    :param ids: iterable of values to match against column
+    :param int batch_size: maximum number of ids per statement
+    :param column: column to match the ids against, defaults to table.c.id
+    :param bool deleted_as_id: set deleted to the row id instead of 1
+    :return int: total number of rows affected
+    """
+    if column is None:
+        column = table.c.id
+
+    total = 0
+    for chunk_number, chunk in enumerate(chunks(ids, batch_size), start=1):
+        now = datetime.datetime.utcnow()
+        with engine.begin() as conn:
+            affected = conn.execute(soft_delete_q(table, column, chunk, now, deleted_as_id)).rowcount
+        total += affected
+        log.info("-- action: soft deleted %s rows in %s (chunk %s with %s ids)",
+                 affected, table.name, chunk_number, len(chunk))
+    return total
+
+
+def soft_delete_cascade(engine, steps, ids, batch_size=DEFAULT_BATCH_SIZE):
+    """Soft delete parent rows together with their children in chunks
+
+    The steps are run in the given order, children first and the parent
+    last, with one ``UPDATE ... WHERE <column> IN (...)`` per step and chunk.
+    All steps of a chunk share one transaction and one timestamp, so a
+    failure rolls back the whole chunk instead of leaving parents half
+    deleted. Chunks committed before the failure stay committed.
+
+    :param engine: sqlalchemy engine (or bound metadata.bind)
+    :param steps: list of (table, column) tuples, the column being matched
+        against the ids - e.g. (volume_metadata_t, volume_metadata_t.c.volume_id)
+    :param ids: iterable of parent ids
+    :param int batch_size: maximum number of parent ids per chunk
+    :return dict: total number of rows affected per table name
+    """
+    totals = {table.name: 0 for (table, _) in steps}
+    for chunk_number, chunk in enumerate(chunks(ids, batch_size), start=1):
+        now = datetime.datetime.utcnow()
+        affected = {}
+        try:
+            with engine.begin() as conn:
+                for (table, column) in steps:
+                    affected[table.name] = conn.execute(soft_delete_q(table, column, chunk, now)).rowcount
+        except Exception:
+            log.error("- soft deleting chunk %s with %s ids failed - rolled back", chunk_number, len(chunk))
+            raise
+        for table_name, count in affected.items():
+            totals[table_name] += count
+        log.info("-- action: soft deleted chunk %s with %s ids: %s", chunk_number, len(chunk),
+                 ", ".join(f"{count} rows in {table_name}" for table_name, count in affected.items()))
+    return totals
+
+
+def iter_partitions(engine, query, partition_size=DEFAULT_BATCH_SIZE, stream=False):
+    """Yield the result rows of a query in lists of at most partition_size rows
+
+    With stream the rows are fetched through a server side (unbuffered)
+    cursor, so only about one partition of rows is held in memory at a time
+    instead of the whole result set, and the caller can start working on the
+    first partition before the db has sent the last one. The connection is
+    busy until the generator is exhausted or closed, so anything written in
+    between has to go through another connection of the engine.
+
+    :param engine: sqlalchemy engine (or bound metadata.bind)
+    :param query: select statement to run
+    :param int partition_size: maximum number of rows per partition
+    :param bool stream: use a server side cursor
+    """
+    partition_size = max(int(partition_size), 1)
+    with engine.connect() as conn:
+        if stream:
+            conn = conn.execution_options(stream_results=True, max_row_buffer=partition_size)
+        # fetchmany instead of Result.partitions(), which only sqlalchemy 1.4 has
+        result = conn.execute(query)
+        while True:
+            partition = result.fetchmany(partition_size)
+            if not partition:
+                break
+            yield partition
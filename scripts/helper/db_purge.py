@@ -0,0 +1,340 @@
+#
+# Copyright (c) 2026 SAP SE
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import copy
+import datetime
+import logging
+import threading
+import time
+
+from prometheus_client import Counter, Gauge
+from sqlalchemy import and_, false, func, or_, select, text
+from sqlalchemy.exc import IntegrityError
+
+from .db_batch import DEFAULT_BATCH_SIZE
+from .db_schema import reflect_tables
+
+log = logging.getLogger(__name__)
+
+# age buckets in days of the purge estimates
+DEFAULT_ESTIMATE_DAYS = (30, 90, 365)
+
+
+def get_purge_tables(meta):
+    """Return the soft deleting tables of the database, children before their parents
+
+    Only tables with deleted and deleted_at columns and a single column
+    primary key are returned.
+    """
+    tables = []
+    for table in reversed(reflect_tables(meta)):
+        if 'deleted' in table.c and 'deleted_at' in table.c and len(table.primary_key.columns) == 1:
+            tables.append(table)
+    return tables
+
+
+def purge_condition(table, cutoff):
+    """Return the condition matching the rows of a table soft deleted before cutoff"""
+    return and_(table.c.deleted != false(), table.c.deleted_at < cutoff)
+
+
+class DbPurger:
+    """Purge soft deleted rows in small primary key ordered chunks
+
+    Instead of one huge DELETE per table, which keeps a long transaction
+    open, stalls galera replication and locks hot tables, the rows are
+    deleted in chunks of at most batch_size rows, each in its own short
+    transaction, with a pause in between. The tables are walked in foreign
+    key dependency order, children first. With max_rows at most that many
+    rows are purged per run - the rest is left for the next runs (tables
+    purged in parallel might each overrun it by up to one chunk).
+
+    The purge rate, the rows left to purge, the rows and chunks purged per
+    table and the runs stopped by the row budget are exported as prometheus
+    metrics with the service as name prefix - with cells also per cell. The
+    tables are not counted up front, which would scan them completely, so
+    the rows left to purge are only known once a run has walked through the
+    whole table.
+
+    :param string service: name of the service, used as metric name prefix
+    :param int batch_size: maximum number of rows to delete per chunk
+    :param float pause: seconds to wait in between two chunks
+    :param int max_rows: maximum number of rows to purge per run - None for no limit
+    :param bool cells: purge several cell dbs with purgers from for_cell()
+    """
+
+    def __init__(self, service, batch_size=DEFAULT_BATCH_SIZE, pause=0.0, max_rows=None, cells=False):
+        self.batch_size = max(int(batch_size), 1)
+        self.pause = pause
+        self.max_rows = max_rows
+        self.rows_left = max_rows
+        self.cell = None
+        # tables can be purged in parallel with one row budget
+        self._budget_lock = threading.Lock()
+
+        cell_label = ['cell'] if cells else []
+        self.rows_per_second_gauge = Gauge(f'{service}_nanny_purge_rows_per_second',
+                                           'rows purged per second by the last purge of a table', cell_label + ['table'])
+        self.remaining_rows_gauge = Gauge(f'{service}_nanny_purge_remaining_rows',
+                                          'rows left to purge in a table after the last complete purge of it',
+                                          cell_label + ['table'])
+        self.purged_rows_counter = Counter(f'{service}_nanny_purge_purged_rows',
+                                           'rows purged from a table', cell_label + ['table'])
+        self.purged_chunks_counter = Counter(f'{service}_nanny_purge_purged_chunks',
+                                             'chunks of rows purged from a table', cell_label + ['table'])
+        self.budget_exhausted_counter = Counter(f'{service}_nanny_purge_budget_exhausted',
+                                                'purge runs stopped by the maximum number of rows to purge per run',
+                                                cell_label)
+        self.estimated_rows_gauge = Gauge(f'{service}_nanny_purge_estimated_rows',
+                                          'estimated rows of a table soft deleted more than older_than_days ago',
+                                          cell_label + ['table', 'older_than_days'])
+        self.estimated_deleted_rows_gauge = Gauge(f'{service}_nanny_purge_estimated_deleted_rows',
+                                                  'estimated soft deleted rows of a table of any age - only for tables '
+                                                  'without an index to break them down by age',
+                                                  cell_label + ['table'])
+        self.estimated_table_rows_gauge = Gauge(f'{service}_nanny_purge_estimated_table_rows',
+                                                'estimated rows of the whole table, deleted or not, from the db statistics - '
+                                                'not an estimate of the rows to purge',
+                                                cell_label + ['table'])
+
+    def for_cell(self, cell):
+        """Return a purger for the db of a cell with its own row budget, sharing the metrics of this one"""
+        purger = copy.copy(self)
+        purger.cell = cell
+        purger.rows_left = self.max_rows
+        purger._budget_lock = threading.Lock()
+        return purger
+
+    def _labels(self, table, **labels):
+        labels['table'] = table.name
+        if self.cell is not None:
+            labels['cell'] = self.cell
+        return labels
+
+    def start_run(self):
+        """Start a new run with the full row budget"""
+        self.rows_left = self.max_rows
+
+    def budget_exhausted(self):
+        return self.rows_left is not None and self.rows_left <= 0
+
+    def _use_budget(self, rows):
+        if self.rows_left is None:
+            return
+        with self._budget_lock:
+            was_left = self.rows_left > 0
+            self.rows_left -= rows
+            if not was_left or self.rows_left > 0:
+                return
+        log.info("- maximum number of %s rows to purge per run reached", self.max_rows)
+        if self.cell is None:
+            self.budget_exhausted_counter.inc()
+        else:
+            self.budget_exhausted_counter.labels(cell=self.cell).inc()
+
+    def _archive_q(self, table, shadow_table, condition):
+        # the shadow tables of nova might lack columns added to the table later on
+        columns = [column for column in table.c if column.name in shadow_table.c]
+        return shadow_table.insert().from_select([column.name for column in columns],
+                                                 select(columns=columns).where(condition))
+
+    def _purge_rows(self, engine, table, shadow_table, condition):
+        # with a shadow table the rows are copied there and deleted in the same transaction
+        with engine.begin() as conn:
+            if shadow_table is not None:
+                conn.execute(self._archive_q(table, shadow_table, condition))
+            return conn.execute(table.delete().where(condition)).rowcount
+
+    def _purge_chunks(self, engine, table, condition, shadow_table=None):
+        # return the rows purged, the rows which could not be purged and whether all the matching rows have been walked
+        pk = list(table.primary_key.columns)[0]
+        purged = 0
+        failed = 0
+        done = False
+        last_id = None
+        while not self.budget_exhausted():
+            limit = self.batch_size if self.rows_left is None else min(self.batch_size, self.rows_left)
+            chunk_q = select(columns=[pk]).where(condition).order_by(pk).limit(limit)
+            # continue after the last chunk, so that rows which could not be deleted are not selected again
+            if last_id is not None:
+                chunk_q = chunk_q.where(pk > last_id)
+            with engine.connect() as conn:
+                ids = [row[0] for row in conn.execute(chunk_q)]
+            if not ids:
+                done = True
+                break
+            last_id = ids[-1]
+            try:
+                affected = self._purge_rows(engine, table, shadow_table, and_(pk.in_(ids), condition))
+            except IntegrityError:
+                # most likely rows of a child table which are not deleted yet still reference some of these
+                # rows - purge the chunk row by row to keep only those
+                affected = 0
+                for row_id in ids:
+                    try:
+                        affected += self._purge_rows(engine, table, shadow_table, and_(pk == row_id, condition))
+                    except IntegrityError as e:
+                        log.warn("- PLEASE CHECK MANUALLY - could not purge row %s from %s: %s", row_id, table.name, str(e.orig))
+                        failed += 1
+            purged += affected
+            self._use_budget(affected)
+            self.purged_chunks_counter.labels(**self._labels(table)).inc()
+            self.purged_rows_counter.labels(**self._labels(table)).inc(affected)
+            # a short chunk is the last one - no need for another query to find that out
+            if len(ids) < limit:
+                done = True
+                break
+            if self.pause:
+                time.sleep(self.pause)
+        return purged, failed, done
+
+    def purge_table(self, engine, table, cutoff, dry_run=False, shadow_table=None):
+        """Purge the rows of a table which were soft deleted before cutoff
+
+        With a shadow table the rows are archived, i.e. moved to the shadow
+        table chunk by chunk, instead of only being deleted. Only a dry run
+        counts the rows up front - a purge just walks the chunks until there
+        are none left or the row budget is used up.
+
+        :return int: number of rows purged (or to be purged in a dry run)
+        """
+        action = 'purge' if shadow_table is None else 'archive'
+
+        condition = purge_condition(table, cutoff)
+        if dry_run:
+            with engine.connect() as conn:
+                remaining = conn.execute(select(columns=[func.count()]).select_from(table).where(condition)).scalar()
+            self.remaining_rows_gauge.labels(**self._labels(table)).set(remaining)
+            if remaining:
+                log.info("- dry run: would %s %s rows from %s", action, remaining, table.name)
+            return remaining
+        if self.budget_exhausted():
+            log.info("- maximum number of rows to %s per run reached - leaving the rows in %s for the next run",
+                     action, table.name)
+            return 0
+
+        start = time.monotonic()
+        purged = 0
+        failed = 0
+        # rows referencing other rows of the same table have to go before the rows they reference
+        self_references = [fk.parent for fk in table.foreign_keys if fk.column.table is table]
+        if self_references:
+            children_condition = and_(condition, or_(*[column.isnot(None) for column in self_references]))
+            chunk_purged, chunk_failed, _ = self._purge_chunks(engine, table, children_condition, shadow_table)
+            purged += chunk_purged
+            failed += chunk_failed
+        chunk_purged, chunk_failed, done = self._purge_chunks(engine, table, condition, shadow_table)
+        purged += chunk_purged
+        failed += chunk_failed
+
+        if done:
+            # after walking the whole table only the rows which could not be purged are left
+            self.remaining_rows_gauge.labels(**self._labels(table)).set(failed)
+        if purged or failed:
+            duration = time.monotonic() - start
+            rows_per_second = purged / duration if duration > 0 else 0
+            self.rows_per_second_gauge.labels(**self._labels(table)).set(rows_per_second)
+            log.info("- %sd %s rows from %s in %.1fs (%.0f rows/s)%s%s", action, purged, table.name, duration, rows_per_second,
+                     f" - {failed} rows could not be {action}d" if failed else "",
+                     "" if done else " - leaving the rest for the next run")
+        return purged
+
+    def _explain_deleted_rows(self, conn, table):
+        # the optimizer's estimate of the soft deleted rows of any age from a range of the index on deleted,
+        # without reading the rows - EXPLAIN rows does not depend on a condition on deleted_at without an index on it
+        quote = conn.dialect.identifier_preparer.quote
+        result = conn.execute(text(f"EXPLAIN SELECT {quote(list(table.primary_key.columns)[0].name)} "
+                                   f"FROM {quote(table.name)} WHERE deleted != 0"))
+        keys = list(result.keys())
+        row = result.first()
+        if row is None or 'rows' not in keys or row[keys.index('rows')] is None:
+            return None
+        return int(row[keys.index('rows')])
+
+    def estimate_table(self, engine, table, days=DEFAULT_ESTIMATE_DAYS):
+        """Estimate the rows of a table to purge per age without scanning the table
+
+        With an index starting with deleted_at, or with deleted and deleted_at,
+        the rows soft deleted more than each of the given days ago are counted
+        via that index only. Without one there is no per age breakdown: with an
+        index starting with deleted only the soft deleted rows of any age are
+        estimated from EXPLAIN on that index (mysql only). The size of the
+        whole table from the db statistics is exported as well and is not an
+        estimate of the rows to purge.
+
+        :return dict: estimated rows per days - empty without a per age breakdown
+        """
+        estimates = {}
+        deleted_rows = None
+        table_rows = None
+        now = datetime.datetime.utcnow()
+        leading_columns = [[column.name for column in index.columns] for index in table.indexes]
+        with engine.connect() as conn:
+            if conn.dialect.name == 'mysql':
+                table_rows = conn.execute(text("SELECT table_rows FROM information_schema.tables "
+                                               "WHERE table_schema = DATABASE() AND table_name = :table_name"),
+                                          table_name=table.name).scalar()
+            if any(columns[:1] == ['deleted_at'] for columns in leading_columns):
+                for older_than in sorted(days):
+                    # only soft deleted rows have a deleted_at, so the range alone is enough
+                    estimate_q = select(columns=[func.count()]).select_from(table).\
+                        where(table.c.deleted_at < now - datetime.timedelta(days=older_than))
+                    estimates[older_than] = conn.execute(estimate_q).scalar()
+            elif any(columns[:2] == ['deleted', 'deleted_at'] for columns in leading_columns):
+                for older_than in sorted(days):
+                    # the index covers the purge condition, so only the index entries of the deleted rows are read
+                    estimate_q = select(columns=[func.count()]).select_from(table).\
+                        where(purge_condition(table, now - datetime.timedelta(days=older_than)))
+                    estimates[older_than] = conn.execute(estimate_q).scalar()
+            elif conn.dialect.name == 'mysql' and any(columns[:1] == ['deleted'] for columns in leading_columns):
+                deleted_rows = self._explain_deleted_rows(conn, table)
+
+        if table_rows is not None:
+            self.estimated_table_rows_gauge.labels(**self._labels(table)).set(table_rows)
+        if deleted_rows is not None:
+            self.estimated_deleted_rows_gauge.labels(**self._labels(table)).set(deleted_rows)
+        for older_than, rows in estimates.items():
+            self.estimated_rows_gauge.labels(**self._labels(table, older_than_days=older_than)).set(rows)
+        if estimates:
+            log.info("- dry run: estimated rows to purge from %s - %s", table.name,
+                     ", ".join(f"{rows} deleted more than {older_than} days ago" for older_than, rows in estimates.items()))
+        elif deleted_rows is not None:
+            log.info("- dry run: no index on deleted_at to break down the rows to purge from %s by age - "
+                     "about %s soft deleted rows of any age", table.name, deleted_rows)
+        else:
+            log.info("- dry run: no index on deleted_at to break down the rows to purge from %s by age%s", table.name,
+                     f" - the whole table has about {table_rows} rows, deleted or not" if table_rows is not None else "")
+        return estimates
+
+    def purge(self, meta, older_than, dry_run=False):
+        """Purge the rows of all tables which were soft deleted more than older_than days ago
+
+        :param meta: bound metadata
+        :param int older_than: age in days of the soft deleted rows to purge
+        :param bool dry_run: only count and log the rows to purge
+        :return int: total number of rows purged (or to be purged in a dry run)
+        """
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=older_than)
+        log.info("- purging rows deleted before %s in chunks of %s rows with a pause of %ss in between",
+                 cutoff, self.batch_size, self.pause)
+        self.start_run()
+        total = 0
+        for table in get_purge_tables(meta):
+            total += self.purge_table(meta.bind, table, cutoff, dry_run)
+            if self.budget_exhausted() and not dry_run:
+                break
+        return total
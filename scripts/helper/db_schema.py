@@ -0,0 +1,151 @@
+#
+# Copyright (c) 2026 SAP SE
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import logging
+import os
+import pickle
+import re
+import stat
+import tempfile
+import threading
+
+from sqlalchemy import MetaData, Table, text
+from sqlalchemy.exc import SQLAlchemyError
+
+log = logging.getLogger(__name__)
+
+# reflection is not thread safe on a shared MetaData object
+_reflect_lock = threading.RLock()
+
+# queries returning the schema version of the database, newest migration tool first
+SCHEMA_VERSION_QUERIES = [
+    "SELECT version_num FROM alembic_version",
+    "SELECT version FROM migrate_version",
+]
+
+
+def get_table(meta, table_name):
+    """Return a table of the bound metadata, reflecting it only on first use"""
+    table = meta.tables.get(table_name)
+    if table is not None:
+        return table
+    with _reflect_lock:
+        table = meta.tables.get(table_name)
+        if table is None:
+            log.debug("reflecting table %s", table_name)
+            table = Table(table_name, meta, autoload=True)
+            meta.info['schema_reflected'] = True
+    return table
+
+
+def reflect_tables(meta):
+    """Reflect all the tables of the database which are not in the bound metadata yet"""
+    with _reflect_lock:
+        known_tables = set(meta.tables)
+        meta.reflect()
+        if set(meta.tables) - known_tables:
+            meta.info['schema_reflected'] = True
+    return meta.sorted_tables
+
+
+def get_schema_version(engine):
+    """Return the schema version of the database or None if it is unknown"""
+    for query in SCHEMA_VERSION_QUERIES:
+        try:
+            with engine.connect() as conn:
+                row = conn.execute(text(query)).first()
+        except SQLAlchemyError:
+            continue
+        if row:
+            return str(row[0])
+    return None
+
+
+def _is_private(st):
+    # owned by the user of the nanny and not writable by anyone else - anything else could have been
+    # planted by another local user and unpickling it would run their code
+    return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def _private_cache_dir(cache_dir):
+    # create the cache dir readable and writable only by the user of the nanny and refuse an existing one
+    # which is not private, e.g. one created in advance by another user in a world writable /tmp
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    st = os.lstat(cache_dir)
+    if not stat.S_ISDIR(st.st_mode) or not _is_private(st):
+        raise PermissionError(f"schema cache dir {cache_dir} is not a private directory of uid {os.getuid()}")
+
+
+def _read_cache_file(cache_file):
+    # the checks are done on the opened file, so it cannot be swapped in between
+    fd = os.open(cache_file, os.O_RDONLY | os.O_NOFOLLOW)
+    with os.fdopen(fd, 'rb') as f:
+        if not _is_private(os.fstat(fd)):
+            raise PermissionError(f"schema cache file {cache_file} is not a private file of uid {os.getuid()}")
+        return pickle.load(f)
+
+
+def load_metadata(engine, cache_dir=None):
+    """Return a metadata object bound to the engine
+
+    If cache_dir is given, the metadata is loaded from the cache file of the
+    current schema version of the database, so that tables already reflected
+    by an earlier run do not have to be reflected again. Use save_metadata()
+    to write newly reflected tables back to the cache. The cache is pickled,
+    so only a cache dir and file owned by the user of the nanny and writable
+    by no one else are used.
+    """
+    meta = None
+    cache_file = None
+    if cache_dir:
+        version = get_schema_version(engine)
+        if version:
+            name = re.sub(r'[^A-Za-z0-9_.-]', '_', f'{engine.url.database}-{version}')
+            cache_file = os.path.join(cache_dir, f'{name}.schema')
+        if cache_file and os.path.exists(cache_file):
+            try:
+                _private_cache_dir(cache_dir)
+                meta = _read_cache_file(cache_file)
+                log.info("- loaded %s reflected tables from schema cache %s", len(meta.tables), cache_file)
+            except Exception as e:
+                log.warning("- ignoring unreadable schema cache %s: %s", cache_file, str(e))
+                meta = None
+    if meta is None:
+        meta = MetaData()
+    meta.bind = engine
+    meta.info['schema_cache_file'] = cache_file
+    meta.info['schema_reflected'] = False
+    return meta
+
+
+def save_metadata(meta):
+    """Write the metadata to its cache file if tables were reflected since loading it"""
+    cache_file = meta.info.get('schema_cache_file')
+    if not cache_file or not meta.info.get('schema_reflected'):
+        return
+    cache_dir = os.path.dirname(cache_file)
+    try:
+        _private_cache_dir(cache_dir)
+        # write to a temporary file first, so that concurrent runs never read a partial cache
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(meta, f)
+        os.replace(tmp_file, cache_file)
+        meta.info['schema_reflected'] = False
+        log.info("- saved %s reflected tables to schema cache %s", len(meta.tables), cache_file)
+    except Exception as e:
+        log.warning("- could not write schema cache %s: %s", cache_file, str(e))
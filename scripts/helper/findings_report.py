@@ -0,0 +1,118 @@
+#
+# Copyright (c) 2026 SAP SE
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import json
+import logging
+import threading
+from functools import partial
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+
+class FindingsReport:
+    """Write the findings of the consistency checks to a file as JSON Lines
+
+    Each finding becomes one line like
+    {"check": "volume attachments", "table": "volume_attachment", "id": "...", "parent_id": "..."}
+    written through a large write buffer. Every line is written under a lock,
+    so that the lines of checks running in parallel do not mix.
+
+    :param string path: file to write the report to - it is truncated first
+    :param int buffer_size: size of the write buffer in bytes
+    """
+
+    def __init__(self, path, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.path = path
+        self._file = open(path, 'w', buffering=buffer_size)
+        self._encoder = json.JSONEncoder(default=str)
+        self._lock = threading.Lock()
+
+    def write_finding(self, check, table, row_id, parent_id=None):
+        """Write a single finding of a check while the rows are still fetched
+
+        :param string check: name of the check
+        :param string table: table of the row found
+        :param row_id: id of the row found
+        :param parent_id: id of the parent of the row found if any
+        """
+        line = self._encoder.encode({'check': check, 'table': table, 'id': row_id, 'parent_id': parent_id})
+        with self._lock:
+            self._file.write(line)
+            self._file.write('\n')
+
+    def write_findings(self, check, table, findings):
+        """Write the findings of a check
+
+        :param string check: name of the check
+        :param string table: table of the rows found
+        :param findings: dict of row id to parent id or list of row ids
+        :return int: number of findings written
+        """
+        items = findings.items() if isinstance(findings, dict) else ((row_id, None) for row_id in findings)
+        count = 0
+        with self._lock:
+            for row_id, parent_id in items:
+                self._file.write(self._encoder.encode({'check': check, 'table': table, 'id': row_id, 'parent_id': parent_id}))
+                self._file.write('\n')
+                count += 1
+        return count
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_finding_writer(report, check, table=None):
+    """Return a callable writing the single findings of a check to the report while they are fetched
+
+    :param report: FindingsReport or None - without a report None is returned
+    :param string table: table of the findings - without one the callable
+        takes the table of each finding as its first argument
+    """
+    if report is None:
+        return None
+    if table is None:
+        return partial(report.write_finding, check)
+    return partial(report.write_finding, check, table)
+
+
+def log_findings(report, check, table, findings, message, written=False):
+    """Write the findings of a check to the report or log them one by one without a report
+
+    :param report: FindingsReport or None
+    :param string message: log format for a single finding taking the row id
+        and, for dict findings, the parent id as arguments
+    :param bool written: the findings have already been written to the report
+        one by one while they were fetched, so only their number is logged
+    """
+    if report is None:
+        if isinstance(findings, dict):
+            for row_id, parent_id in findings.items():
+                log.info(message, row_id, parent_id)
+        else:
+            for row_id in findings:
+                log.info(message, row_id)
+        return
+    count = len(findings) if written else report.write_findings(check, table, findings)
+    log.info("-- %s %s findings written to %s", count, check, report.path)
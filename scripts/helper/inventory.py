@@ -0,0 +1,230 @@
+#
+# Copyright (c) 2026 SAP SE
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import datetime
+import logging
+import sys
+import time
+import urllib.parse
+import uuid
+
+from sqlalchemy import Column, MetaData, String, Table, create_engine, text
+
+from .db_batch import DEFAULT_BATCH_SIZE, chunks
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 1000
+
+
+def pack_uuid(value):
+    """Return the 16 byte binary form of a uuid string
+
+    Values which are not a valid uuid are kept as their utf-8 encoding, so
+    that they still compare equal to themselves.
+    """
+    try:
+        return uuid.UUID(value).bytes
+    except (ValueError, TypeError, AttributeError):
+        return str(value).encode('utf-8')
+
+
+def unpack_uuid(value):
+    """Return the string form of a value packed by pack_uuid()"""
+    if len(value) == 16:
+        return str(uuid.UUID(bytes=value))
+    return value.decode('utf-8')
+
+
+class UUIDSet:
+    """Set of uuids kept in their packed 16 byte binary form
+
+    Only supports what the consistency checks need: adding ids, membership
+    tests with uuid strings, iteration and length.
+    """
+
+    def __init__(self, values=()):
+        self._uuids = set()
+        self.pages = 0
+        self.duration = 0.0
+        # utc time the inventory was taken at - db rows created later may not be in it yet
+        self.fetched_at = datetime.datetime.utcnow()
+        for value in values:
+            self.add(value)
+
+    def add(self, value):
+        self._uuids.add(pack_uuid(value))
+
+    def __contains__(self, value):
+        if value is None:
+            return False
+        return pack_uuid(value) in self._uuids
+
+    def __len__(self):
+        return len(self._uuids)
+
+    def __iter__(self):
+        for value in self._uuids:
+            yield unpack_uuid(value)
+
+    def nbytes(self):
+        """Return the approximate number of bytes retained by the set"""
+        return sys.getsizeof(self._uuids) + sum(sys.getsizeof(value) for value in self._uuids)
+
+
+def fetch_uuid_inventory(list_page, name, page_size=DEFAULT_PAGE_SIZE):
+    """Fetch the ids of all resources of a paginated api into a UUIDSet
+
+    :param list_page: callable(marker, limit) returning a single page of
+        resources having an id attribute, the marker being the id of the last
+        resource of the previous page or None for the first page
+    :param string name: name of the resources for logging
+    :param int page_size: number of resources to request per page
+    :return UUIDSet: the ids of all resources
+    """
+    inventory = UUIDSet()
+    inventory.fetched_at = datetime.datetime.utcnow()
+    start = time.monotonic()
+    marker = None
+    while True:
+        page = list(list_page(marker, page_size))
+        # the api may cap the page size below the requested limit, so only
+        # an empty page reliably marks the end of the listing
+        if not page:
+            break
+        inventory.pages += 1
+        for resource in page:
+            inventory.add(resource.id)
+        marker = page[-1].id
+        # only the ids are kept - drop the full resource objects of this page
+        del page
+    inventory.duration = time.monotonic() - start
+    log.info("- fetched %s %s ids in %s pages and %.1fs - %s bytes retained",
+             len(inventory), name, inventory.pages, inventory.duration, inventory.nbytes())
+    return inventory
+
+
+def fetch_uuid_inventory_db(sources, name):
+    """Fetch the ids of all resources straight from the service databases into a UUIDSet
+
+    This is meant to be used with read-only db credentials as a much faster
+    alternative to listing everything via the api.
+
+    :param sources: list of (db_url, query) tuples, each query selecting a
+        single column with the ids
+    :param string name: name of the resources for logging
+    :return UUIDSet: the ids of all resources found in all sources
+    """
+    inventory = UUIDSet()
+    inventory.fetched_at = datetime.datetime.utcnow()
+    start = time.monotonic()
+    for db_url, query in sources:
+        engine = create_engine(db_url)
+        try:
+            with engine.connect() as conn:
+                for (value,) in conn.execution_options(stream_results=True).execute(text(query)):
+                    inventory.add(value)
+        finally:
+            engine.dispose()
+        inventory.pages += 1
+    inventory.duration = time.monotonic() - start
+    log.info("- fetched %s %s ids from %s databases in %.1fs - %s bytes retained",
+             len(inventory), name, inventory.pages, inventory.duration, inventory.nbytes())
+    return inventory
+
+
+def format_db_url(url, base_url):
+    """Expand the variables of a templated database connection string like nova does for its cell mappings
+
+    The variables {scheme}, {username}, {password}, {hostname}, {port},
+    {path}, {query} and {fragment} are replaced by the corresponding parts
+    of base_url - nova takes them from its own [database] connection.
+    Connection strings without variables are returned unchanged.
+    """
+    if '{' not in url:
+        return url
+    base = urllib.parse.urlparse(base_url)
+    variables = {
+        'scheme': base.scheme,
+        'username': base.username,
+        'password': base.password,
+        'hostname': base.hostname,
+        'port': base.port,
+        'path': base.path.lstrip('/'),
+        'query': base.query,
+        'fragment': base.fragment,
+    }
+    for name, value in variables.items():
+        url = url.replace('{%s}' % name, '' if value is None else str(value))
+    return url
+
+
+def get_nova_cell_db_urls(api_db_url, cell_db_url_template=None):
+    """Return a dict of cell name to database connection string from the nova api db cell_mappings
+
+    Templated cell mappings are expanded with format_db_url() against
+    api_db_url. The cell mappings hold the read-write credentials of nova
+    itself - for read-only access pass cell_db_url_template, e.g.
+    mysql+pymysql://nanny:secret@{hostname}:{port}/{path}?{query}, which is
+    expanded against each cell mapping, with {cell} as the cell name.
+    """
+    engine = create_engine(api_db_url)
+    try:
+        with engine.connect() as conn:
+            cell_mappings = conn.execute(text("SELECT name, database_connection FROM cell_mappings")).fetchall()
+    finally:
+        engine.dispose()
+
+    cell_db_urls = {}
+    for (name, db_url) in cell_mappings:
+        db_url = format_db_url(db_url, api_db_url)
+        if cell_db_url_template:
+            db_url = format_db_url(cell_db_url_template, db_url).replace('{cell}', str(name))
+        cell_db_urls[name] = db_url
+    return cell_db_urls
+
+
+def load_uuid_temp_table(conn, table_name, uuids, batch_size=DEFAULT_BATCH_SIZE):
+    """Bulk load uuids into a temporary table with the uuid as primary key
+
+    The table only exists for the session of the given connection, so all
+    queries joining against it have to run on that same connection. Pooled
+    connections outlive the session of the caller - call drop_temp_table()
+    when done.
+
+    :return Table: the temporary table with its single uuid column
+    """
+    temp_t = Table(table_name, MetaData(),
+                   Column('uuid', String(36), primary_key=True),
+                   prefixes=['TEMPORARY'])
+    drop_temp_table(conn, temp_t)
+    temp_t.create(conn)
+    loaded = 0
+    for chunk in chunks(uuids, batch_size):
+        conn.execute(temp_t.insert(), [{'uuid': value} for value in chunk])
+        loaded += len(chunk)
+    log.info("- loaded %s uuids into temporary table %s", loaded, table_name)
+    return temp_t
+
+
+def drop_temp_table(conn, temp_t):
+    """Drop a temporary table created by load_uuid_temp_table()"""
+    if conn.dialect.name == 'mysql':
+        # never drop a permanent table which happens to have the same name
+        conn.execute(text(f'DROP TEMPORARY TABLE IF EXISTS {temp_t.name}'))
+    else:
+        temp_t.drop(conn, checkfirst=True)
@@ -0,0 +1,68 @@
+#
+# Copyright (c) 2026 SAP SE
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import concurrent.futures
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def _check_project(func, project_id):
+    try:
+        return func(project_id), None
+    except Exception as e:
+        return None, e
+
+
+def map_projects(func, projects, workers=1):
+    """Run func for every project on up to workers threads
+
+    The results are returned in the order of the projects, no matter in which
+    order the workers finish, so that output and metrics built from them are
+    the same as with a single worker. A project for which func raised an
+    exception is logged and left out of the results, like a failed run for a
+    single project, and returned with the failed projects instead, so that
+    the caller can tell a complete run from one with failures.
+
+    The workers share the sqlalchemy engine of func, which has to have a
+    connection pool of at least workers connections - the number of workers
+    is also the maximum number of queries running against the db at a time.
+
+    :param func: callable taking a project id
+    :param projects: iterable of project ids
+    :param int workers: maximum number of projects checked at the same time
+    :return tuple: list of (project id, result) tuples of the projects checked
+        and list of the ids of the projects which failed
+    """
+    projects = list(projects)
+    workers = max(int(workers), 1)
+
+    if workers == 1:
+        outcomes = [_check_project(func, project_id) for project_id in projects]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='project') as executor:
+            outcomes = list(executor.map(lambda project_id: _check_project(func, project_id), projects))
+
+    results = []
+    failed = []
+    for project_id, (result, error) in zip(projects, outcomes):
+        if error is not None:
+            log.error("- checking project %s failed: %s", project_id, str(error))
+            failed.append(project_id)
+            continue
+        results.append((project_id, result))
+    return results, failed
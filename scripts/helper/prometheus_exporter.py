@@ -17,7 +17,7 @@
 
 import logging
 
-from prometheus_client import start_http_server
+from prometheus_client import REGISTRY, push_to_gateway, start_http_server
 from prometheus_client.core import Gauge, GaugeMetricFamily
 
 log = logging.getLogger(__name__)
@@ -109,10 +109,20 @@ class LabelGauge:
         and export them as gauge labels. Gauge with labels that are not in the
         input data are removed.
         """
+        self.export_values((labels_input, 1) for labels_input in data)
+
+    def export_values(self, data):
+        """
+        Like export(), but with a value per gauge instead of 1:
+            [
+                ({ "id": "xxx", "server": "xxx" }, 3),
+                ({ "id": "yyy", "server": "yyy" }, -1),
+            ]
+        """
         _labelkey_cache = {}
 
         # process labels and set gauge
-        for labels_input in data:
+        for labels_input, value in data:
             # remove invalid gauge labels from input
             labels = {}
             for labelname in self._gauge._labelnames:
@@ -124,8 +134,8 @@ class LabelGauge:
             # generate gauge label key and cache them
             # the key is built from concatenated {label_name} and {label_value}
             _labelkey_cache[self.serialize_labels(labels)] = labels
-            self._gauge.labels(**labels).set(1)
-            log.debug(f'set gauge {labels} to 1')
+            self._gauge.labels(**labels).set(value)
+            log.debug(f'set gauge {labels} to {value}')
 
         # remove gauge with unfound labels
         for labelkey, labels in self._labelkey_cache.items():
@@ -152,3 +162,13 @@ def prometheus_http_start(prometheus_port):
     except Exception as e:
         log.error("- ERROR - failed to start prometheus exporter http server: %s",
                   str(e))
+
+
+# push the metrics of a one-shot run to a prometheus pushgateway - there is no exporter left to scrape afterwards
+def prometheus_push(gateway, job):
+    try:
+        push_to_gateway(gateway, job=job, registry=REGISTRY)
+        log.info("INFO: pushed the prometheus metrics to %s", gateway)
+    except Exception as e:
+        log.error("- ERROR - failed to push the prometheus metrics to %s: %s",
+                  gateway, str(e))
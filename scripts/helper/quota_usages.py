@@ -0,0 +1,116 @@
+#
+# Copyright (c) 2026 SAP SE
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import datetime
+import logging
+import time
+
+from sqlalchemy import and_, bindparam
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PROJECT_BATCH_SIZE = 100
+
+
+class QuotaUsagesWriter:
+    """Write corrected quota usages back in bulk
+
+    The corrections are queued per project and written once batch_size
+    projects are queued - with one executemany UPDATE per kind of key
+    (e.g. per resource or per resource and user) and one transaction and
+    timestamp per batch of projects instead of one UPDATE and commit per
+    quota usage.
+
+    :param engine: sqlalchemy engine (or bound metadata.bind)
+    :param table: reflected quota_usages table
+    :param int batch_size: number of projects to write per transaction
+    """
+
+    def __init__(self, engine, table, batch_size=DEFAULT_PROJECT_BATCH_SIZE):
+        self.engine = engine
+        self.table = table
+        self.batch_size = max(int(batch_size), 1)
+        self.rows_changed = 0
+        self.projects_synced = 0
+        self.duration = 0.0
+        self._pending = {}
+        self._pending_projects = set()
+
+    def _update_q(self, key_columns):
+        # the bind parameters must not be named like the columns, as those are reserved for the values set
+        where = [self.table.c.project_id == bindparam('b_project_id')]
+        where += [self.table.c[column] == bindparam('b_' + column) for column in key_columns]
+        return self.table.update().where(and_(*where)).values(in_use=bindparam('b_in_use'),
+                                                              updated_at=bindparam('b_updated_at'))
+
+    def add_project(self, project_id, key_columns, quota_usages_to_sync):
+        """Queue the corrected quota usages of a project
+
+        :param string project_id: project of the quota usages
+        :param key_columns: names of the columns identifying a quota usage of
+            the project beside project_id, e.g. ('resource', 'user_id')
+        :param dict quota_usages_to_sync: corrected in_use per tuple of values
+            for key_columns (or per value with a single key column)
+        """
+        params = self._pending.setdefault(tuple(key_columns), [])
+        for key, in_use in quota_usages_to_sync.items():
+            key = key if isinstance(key, tuple) else (key,)
+            param = {'b_project_id': project_id, 'b_in_use': in_use}
+            param.update({'b_' + column: value for column, value in zip(key_columns, key)})
+            params.append(param)
+        self._pending_projects.add(project_id)
+        if len(self._pending_projects) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write all queued quota usages in one transaction"""
+        if not self._pending_projects:
+            return
+        start = time.monotonic()
+        now = datetime.datetime.utcnow()
+        rows_changed = 0
+        with self.engine.begin() as conn:
+            for key_columns, params in self._pending.items():
+                if not params:
+                    continue
+                for param in params:
+                    param['b_updated_at'] = now
+                rows_changed += conn.execute(self._update_q(key_columns), params).rowcount
+        duration = time.monotonic() - start
+        log.info("- synced the quota usages of %s projects: %s rows changed in %.2fs",
+                 len(self._pending_projects), rows_changed, duration)
+        self.rows_changed += rows_changed
+        self.projects_synced += len(self._pending_projects)
+        self.duration += duration
+        self._pending = {}
+        self._pending_projects = set()
+
+    def close(self):
+        """Write the remaining queued quota usages
+
+        :return tuple: total number of rows changed and seconds spent writing
+        """
+        self.flush()
+        return self.rows_changed, self.duration
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        # do not write a partial batch if the caller failed
+        if exc_type is None:
+            self.close()
@@ -0,0 +1,152 @@
+#
+# Copyright (c) 2026 SAP SE
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import datetime
+import json
+import logging
+import os
+import tempfile
+
+from sqlalchemy import func, or_, select
+
+from .db_schema import get_table
+
+log = logging.getLogger(__name__)
+
+DEFAULT_FULL_SWEEP_EVERY = 24
+
+# rows soft deleted by transactions which were not committed yet when the
+# watermark was taken can carry an older deleted_at - look back a bit further
+WATERMARK_OVERLAP = datetime.timedelta(hours=1)
+
+TIMESTAMP_COLUMNS = ('created_at', 'updated_at', 'deleted_at')
+
+
+def deleted_since_condition(table, since):
+    """Return the condition matching the rows of a table soft deleted (or updated) since the given time"""
+    return or_(table.c.deleted_at >= since, table.c.updated_at >= since)
+
+
+def changed_since_condition(table, since):
+    """Return the condition matching the rows of a table created, updated or deleted since the given time"""
+    return or_(*[table.c[column] >= since for column in TIMESTAMP_COLUMNS if column in table.c])
+
+
+def get_changed_watermarks(meta, table_names):
+    """Return the latest created_at, updated_at or deleted_at of the rows per table
+
+    Tables without any rows are returned with None.
+    """
+    watermarks = {}
+    for table_name in table_names:
+        table_t = get_table(meta, table_name)
+        columns = [func.max(table_t.c[column]) for column in TIMESTAMP_COLUMNS if column in table_t.c]
+        marks = [mark for mark in select(columns=columns).execute().first() if mark is not None]
+        watermarks[table_name] = max(marks) if marks else None
+    return watermarks
+
+
+def get_changed_projects(meta, changed_since):
+    """Return the ids of the projects with rows created, updated or deleted since the given times
+
+    :param dict changed_since: time per name of a table with a project_id column - None for
+        a table without a mark, i.e. a table without rows at the last run, takes all its rows
+    :return set: project ids
+    """
+    projects = set()
+    for table_name, since in changed_since.items():
+        table_t = get_table(meta, table_name)
+        changed_projects_q = select(columns=[table_t.c.project_id]).distinct()
+        if since is not None:
+            changed_projects_q = changed_projects_q.where(changed_since_condition(table_t, since))
+        projects.update(project_id for (project_id,) in changed_projects_q.execute())
+    return projects
+
+
+def get_deleted_watermarks(meta, table_names):
+    """Return the latest deleted_at (or updated_at) of the soft deleted rows per table
+
+    Tables without any soft deleted rows are returned with None.
+    """
+    watermarks = {}
+    for table_name in table_names:
+        table_t = get_table(meta, table_name)
+        watermark_q = select(columns=[func.max(func.coalesce(table_t.c.deleted_at, table_t.c.updated_at))]).\
+            where(table_t.c.deleted != 0)
+        watermarks[table_name] = watermark_q.execute().scalar()
+    return watermarks
+
+
+class WatermarkState:
+    """High-water marks of tables kept in a state file in between runs
+
+    The marks allow a nanny to only look at the rows changed since its last
+    successful run - e.g. the checks for rows with an already deleted parent
+    only join against the parents deleted since then. As this might miss
+    something (e.g. a child row added to an already deleted parent), every
+    full_sweep_every runs - and whenever there are no marks yet - everything
+    is looked at again.
+
+    :param string path: state file, created on save() if it does not exist
+    :param int full_sweep_every: number of runs after which a full sweep is done
+    """
+
+    def __init__(self, path, full_sweep_every=DEFAULT_FULL_SWEEP_EVERY):
+        self.path = path
+        self.full_sweep_every = max(int(full_sweep_every), 1)
+        self.marks = {}
+        self.runs_since_full_sweep = 0
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    state = json.load(f)
+                self.marks = {table_name: datetime.datetime.fromisoformat(mark)
+                              for table_name, mark in state.get('marks', {}).items()}
+                self.runs_since_full_sweep = int(state.get('runs_since_full_sweep', 0))
+            except Exception as e:
+                log.warning("- ignoring unreadable watermark state file %s - doing a full sweep: %s", path, str(e))
+                self.marks = {}
+
+    def full_sweep_due(self):
+        return not self.marks or self.runs_since_full_sweep + 1 >= self.full_sweep_every
+
+    def since(self):
+        """Return the time per table since when rows have to be looked at - empty for a full sweep"""
+        if self.full_sweep_due():
+            return {}
+        return {table_name: mark - WATERMARK_OVERLAP for table_name, mark in self.marks.items()}
+
+    def advance(self, marks, full_sweep):
+        """Take the marks taken before a successful run as the new marks"""
+        self.marks.update({table_name: mark for table_name, mark in marks.items() if mark is not None})
+        self.runs_since_full_sweep = 0 if full_sweep else self.runs_since_full_sweep + 1
+
+    def save(self):
+        state = {
+            'marks': {table_name: mark.isoformat() for table_name, mark in self.marks.items()},
+            'runs_since_full_sweep': self.runs_since_full_sweep,
+        }
+        state_dir = os.path.dirname(os.path.abspath(self.path))
+        try:
+            os.makedirs(state_dir, exist_ok=True)
+            # write to a temporary file first, so that an interrupted run never leaves a partial state file
+            fd, tmp_file = tempfile.mkstemp(dir=state_dir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_file, self.path)
+        except Exception as e:
+            log.warning("- could not write watermark state file %s: %s", self.path, str(e))
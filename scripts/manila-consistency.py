@@ -22,11 +22,17 @@ import datetime
 import logging
 import sys
 
+from functools import partial
+
 from openstack import connection, exceptions
-from sqlalchemy import (MetaData, Table, and_, create_engine, select, update)
+from sqlalchemy import (and_, create_engine, select)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from helper.check_runner import Check, run_checks
+from helper.db_batch import DEFAULT_BATCH_SIZE, soft_delete_rows
+from helper.db_schema import get_table, load_metadata, save_metadata
+from helper.findings_report import FindingsReport, get_finding_writer, log_findings
 from helper.manilananny import base_command_parser
 
 log = logging.getLogger(__name__)
@@ -35,11 +41,11 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)-15s %(message)s')
 
 # get all the rows with a share_network_security_service_association still defined where the
 # corresponding share_network is already deleted
-def get_wrong_share_network_ssas(meta):
+def get_wrong_share_network_ssas(meta, on_finding=None):
 
     wrong_share_network_ssas = {}
-    share_network_ssa_t = Table('share_network_security_service_association', meta, autoload=True)
-    share_networks_t = Table('share_networks', meta, autoload=True)
+    share_network_ssa_t = get_table(meta, 'share_network_security_service_association')
+    share_networks_t = get_table(meta, 'share_networks')
     share_network_ssa_join = share_network_ssa_t.join(share_networks_t,share_network_ssa_t.c.share_network_id == share_networks_t.c.id)
     wrong_share_network_ssa_q = select(
         columns=[
@@ -57,28 +63,25 @@ def get_wrong_share_network_ssas(meta):
     # return a dict indexed by share_network_security_service_association id and with the value share_network_id for non deleted ssas
     for (share_network_id, share_network_deleted, share_network_ssa_id, share_network_ssa_deleted) in wrong_share_network_ssa_q.execute():
         wrong_share_network_ssas[share_network_ssa_id] = share_network_id
+        if on_finding:
+            on_finding(share_network_ssa_id, share_network_id)
     return wrong_share_network_ssas
 
 # delete share_network_security_service_association still defined where the corresponding share_network is already deleted
-def fix_wrong_share_network_ssas(meta, wrong_share_network_ssas):
+def fix_wrong_share_network_ssas(meta, wrong_share_network_ssas, batch_size=DEFAULT_BATCH_SIZE):
 
-    share_network_ssa_t = Table('share_network_security_service_association', meta, autoload=True)
+    share_network_ssa_t = get_table(meta, 'share_network_security_service_association')
 
-    now = datetime.datetime.utcnow()
-    for share_network_ssa_id in wrong_share_network_ssas:
-        log.info("-- action: deleting share network security service association id: %s", share_network_ssa_id)
-        delete_share_network_ssa_q = share_network_ssa_t.update().\
-            where(share_network_ssa_t.c.id == share_network_ssa_id).\
-            values(updated_at=now, deleted_at=now, deleted=share_network_ssa_id)
-        delete_share_network_ssa_q.execute()
+    log.info("-- action: deleting %s share network security service associations", len(wrong_share_network_ssas))
+    soft_delete_rows(meta.bind, share_network_ssa_t, wrong_share_network_ssas, batch_size, deleted_as_id=True)
 
 # get all the rows with a network_allocations still defined where the corresponding share_server is already deleted
-def get_wrong_network_allocations(meta, older_than):
+def get_wrong_network_allocations(meta, older_than, on_finding=None):
 
     older_than_date = datetime.datetime.utcnow() - datetime.timedelta(hours=older_than)
     wrong_network_allocations = {}
-    network_allocations_t = Table('network_allocations', meta, autoload=True)
-    share_servers_t = Table('share_servers', meta, autoload=True)
+    network_allocations_t = get_table(meta, 'network_allocations')
+    share_servers_t = get_table(meta, 'share_servers')
     network_allocations_join = network_allocations_t.join(share_servers_t,network_allocations_t.c.share_server_id == share_servers_t.c.id)
     wrong_network_allocations_q = select(
         columns=[
@@ -97,26 +100,23 @@ def get_wrong_network_allocations(meta, older_than):
     # return a dict indexed by share_network_security_service_association id and with the value share_server_id for non deleted ssas
     for (share_server_id, share_network_deleted, network_allocations_id, network_allocations_deleted) in wrong_network_allocations_q.execute():
         wrong_network_allocations[network_allocations_id] = share_server_id
+        if on_finding:
+            on_finding(network_allocations_id, share_server_id)
     return wrong_network_allocations
 
 # soft delete network_allocations still defined where the corresponding share_server is already deleted
-def fix_wrong_network_allocations(meta, wrong_network_allocations):
-    network_allocations_t = Table('network_allocations', meta, autoload=True)
+def fix_wrong_network_allocations(meta, wrong_network_allocations, batch_size=DEFAULT_BATCH_SIZE):
+    network_allocations_t = get_table(meta, 'network_allocations')
 
-    now = datetime.datetime.utcnow()
-    for network_allocations_id in wrong_network_allocations:
-        log.info("-- action: deleting network allocation id: %s", network_allocations_id)
-        delete_network_allocations_q = network_allocations_t.update().\
-            where(network_allocations_t.c.id == network_allocations_id).\
-            values(updated_at=now, deleted_at=now, deleted=network_allocations_id)
-        delete_network_allocations_q.execute()
+    log.info("-- action: deleting %s network allocations", len(wrong_network_allocations))
+    soft_delete_rows(meta.bind, network_allocations_t, wrong_network_allocations, batch_size, deleted_as_id=True)
 
 # get all the rows with a share_metadata still defined where the corresponding share is already deleted
-def get_wrong_share_metadata(meta):
+def get_wrong_share_metadata(meta, on_finding=None):
 
     wrong_share_metadata = {}
-    share_metadata_t = Table('share_metadata', meta, autoload=True)
-    shares_t = Table('shares', meta, autoload=True)
+    share_metadata_t = get_table(meta, 'share_metadata')
+    shares_t = get_table(meta, 'shares')
     share_metadata_join = share_metadata_t.join(shares_t,share_metadata_t.c.share_id == shares_t.c.id)
     wrong_share_metadata_q = select(
         columns=[
@@ -134,26 +134,23 @@ def get_wrong_share_metadata(meta):
     # return a dict indexed by share_network_security_service_association id and with the value share_id for non deleted ssas
     for (share_id, share_deleted, share_metadata_id, share_metadata_deleted) in wrong_share_metadata_q.execute():
         wrong_share_metadata[share_metadata_id] = share_id
+        if on_finding:
+            on_finding(share_metadata_id, share_id)
     return wrong_share_metadata
 
 # delete share_metadata still defined where the corresponding share is already deleted
-def fix_wrong_share_metadata(meta, wrong_share_metadata):
-    share_metadata_t = Table('share_metadata', meta, autoload=True)
+def fix_wrong_share_metadata(meta, wrong_share_metadata, batch_size=DEFAULT_BATCH_SIZE):
+    share_metadata_t = get_table(meta, 'share_metadata')
 
-    now = datetime.datetime.utcnow()
-    for share_metadata_id in wrong_share_metadata:
-        log.info("-- action: deleting share metadata id: %s", share_metadata_id)
-        delete_share_metadata_q = share_metadata_t.update().\
-            where(share_metadata_t.c.id == share_metadata_id).\
-            values(updated_at=now, deleted_at=now, deleted=share_metadata_id)
-        delete_share_metadata_q.execute()
+    log.info("-- action: deleting %s share metadata entries", len(wrong_share_metadata))
+    soft_delete_rows(meta.bind, share_metadata_t, wrong_share_metadata, batch_size, deleted_as_id=True)
 
 # get all the rows with a share_group_type_share_type_mapping still defined where the corresponding share_group_type is already deleted
-def get_wrong_share_gtstm(meta):
+def get_wrong_share_gtstm(meta, on_finding=None):
 
     wrong_share_gtstm = {}
-    share_gtstm_t = Table('share_group_type_share_type_mappings', meta, autoload=True)
-    share_group_types_t = Table('share_group_types', meta, autoload=True)
+    share_gtstm_t = get_table(meta, 'share_group_type_share_type_mappings')
+    share_group_types_t = get_table(meta, 'share_group_types')
     share_gtstm_join = share_gtstm_t.join(share_group_types_t,share_gtstm_t.c.share_group_type_id == share_group_types_t.c.id)
     wrong_share_gtstm_q = select(
         columns=[
@@ -171,25 +168,22 @@ def get_wrong_share_gtstm(meta):
     # return a dict indexed by share_network_security_service_association id and with the value share_id for non deleted ssas
     for (share_group_type_id, share_group_type_deleted, share_gtstm_id, share_gtstm_deleted) in wrong_share_gtstm_q.execute():
         wrong_share_gtstm[share_gtstm_id] = share_group_type_id
+        if on_finding:
+            on_finding(share_gtstm_id, share_group_type_id)
     return wrong_share_gtstm
 
 # delete share_group_type_share_type_mapping still defined where the corresponding share_group_type is already deleted
-def fix_wrong_share_gtstm(meta, wrong_share_gtstm):
-    share_gtstm_t = Table('share_group_type_share_type_mappings', meta, autoload=True)
+def fix_wrong_share_gtstm(meta, wrong_share_gtstm, batch_size=DEFAULT_BATCH_SIZE):
+    share_gtstm_t = get_table(meta, 'share_group_type_share_type_mappings')
 
-    now = datetime.datetime.utcnow()
-    for share_gtstm_id in wrong_share_gtstm:
-        log.info("-- action: deleting share group type id: %s", share_gtstm_id)
-        delete_share_gtstm_q = update(share_gtstm_t).\
-            where(share_gtstm_t.c.id == share_gtstm_id).\
-            values(updated_at=now, deleted_at=now, deleted=share_gtstm_id)
-        delete_share_gtstm_q.execute()
+    log.info("-- action: deleting %s share group type share type mappings", len(wrong_share_gtstm))
+    soft_delete_rows(meta.bind, share_gtstm_t, wrong_share_gtstm, batch_size, deleted_as_id=True)
 
 # get all the rows with a share_instance_access_map still defined where the corresponding share_instance is already deleted
-def get_wrong_share_instance_access_mapping(meta):
+def get_wrong_share_instance_access_mapping(meta, on_finding=None):
     wrong_share_instance_access_mapping = {}
-    share_instance_access_mapping_t = Table('share_instance_access_map', meta, autoload=True)
-    share_instances_t = Table('share_instances', meta, autoload=True)
+    share_instance_access_mapping_t = get_table(meta, 'share_instance_access_map')
+    share_instances_t = get_table(meta, 'share_instances')
     share_instance_access_mapping_join = share_instance_access_mapping_t.join(
         share_instances_t,
         share_instance_access_mapping_t.c.share_instance_id == share_instances_t.c.id)
@@ -209,26 +203,23 @@ def get_wrong_share_instance_access_mapping(meta):
     # return a dict indexed by share_instance_access_mapping id and with the value share_instance_id for non deleted mappings
     for (share_instance_id, _, share_instance_access_mapping_id, _) in wrong_share_instance_access_mapping_q.execute():
         wrong_share_instance_access_mapping[share_instance_access_mapping_id] = share_instance_id
+        if on_finding:
+            on_finding(share_instance_access_mapping_id, share_instance_id)
     return wrong_share_instance_access_mapping
 
 # delete share_instance_access_mapping still defined where the corresponding share_instance is already deleted
-def fix_wrong_share_instance_access_mapping(meta, wrong_share_instance_access_mapping):
-    share_instance_access_mapping_t = Table('share_instance_access_map', meta, autoload=True)
+def fix_wrong_share_instance_access_mapping(meta, wrong_share_instance_access_mapping, batch_size=DEFAULT_BATCH_SIZE):
+    share_instance_access_mapping_t = get_table(meta, 'share_instance_access_map')
 
-    now = datetime.datetime.utcnow()
-    for share_instance_access_mapping_id in wrong_share_instance_access_mapping:
-        log.info("-- action: deleting share instance access mapping id: %s", share_instance_access_mapping_id)
-        delete_share_instance_access_mapping_q = update(share_instance_access_mapping_t).\
-            where(share_instance_access_mapping_t.c.id == share_instance_access_mapping_id).\
-            values(updated_at=now, deleted_at=now, deleted=share_instance_access_mapping_id)
-        delete_share_instance_access_mapping_q.execute()
+    log.info("-- action: deleting %s share instance access mappings", len(wrong_share_instance_access_mapping))
+    soft_delete_rows(meta.bind, share_instance_access_mapping_t, wrong_share_instance_access_mapping, batch_size, deleted_as_id=True)
 
 # get all the rows with a share_instance_export_locations_metadata still defined where the corresponding share_instance_export_location is already deleted
-def get_wrong_si_el_metadata(meta):
+def get_wrong_si_el_metadata(meta, on_finding=None):
 
     wrong_si_el_metadata = {}
-    si_el_metadata_t = Table('share_instance_export_locations_metadata', meta, autoload=True)
-    si_el_t = Table('share_instance_export_locations', meta, autoload=True)
+    si_el_metadata_t = get_table(meta, 'share_instance_export_locations_metadata')
+    si_el_t = get_table(meta, 'share_instance_export_locations')
     si_el_metadata_join = si_el_metadata_t.join(si_el_t,si_el_metadata_t.c.export_location_id == si_el_t.c.id)
     wrong_si_el_metadata_q = select(
         columns=[
@@ -246,29 +237,124 @@ def get_wrong_si_el_metadata(meta):
     # return a dict indexed by share_instance_export_locations_metadata id and with the value share_instance_export_location id for non deleted si_el_metadata
     for (si_el_id, si_el_deleted, si_el_metadata_id, si_el_metadata_deleted) in wrong_si_el_metadata_q.execute():
         wrong_si_el_metadata[si_el_metadata_id] = si_el_id
+        if on_finding:
+            on_finding(si_el_metadata_id, si_el_id)
     return wrong_si_el_metadata
 
 # delete share_instance_export_locations_metadata still defined where the corresponding share_instance_export_location is already deleted
-def fix_wrong_si_el_metadata(meta, wrong_si_el_metadata):
-    si_el_metadata_t = Table('share_instance_export_locations_metadata', meta, autoload=True)
+def fix_wrong_si_el_metadata(meta, wrong_si_el_metadata, batch_size=DEFAULT_BATCH_SIZE):
+    si_el_metadata_t = get_table(meta, 'share_instance_export_locations_metadata')
+
+    log.info("-- action: deleting %s share instance export location metadata entries", len(wrong_si_el_metadata))
+    soft_delete_rows(meta.bind, si_el_metadata_t, wrong_si_el_metadata, batch_size, deleted_as_id=True)
 
-    now = datetime.datetime.utcnow()
-    for si_el_metadata_id in wrong_si_el_metadata:
-        log.info("-- action: deleting share instance export location metadata id: %s", si_el_metadata_id)
-        delete_si_el_metadata_q = si_el_metadata_t.update().\
-            where(si_el_metadata_t.c.id == si_el_metadata_id).\
-            values(updated_at=now, deleted_at=now, deleted=si_el_metadata_id)
-        delete_si_el_metadata_q.execute()
+# check and fix share network security service associations of deleted share networks
+def check_share_network_ssas(meta, args, report=None):
+    wrong_share_network_ssas = get_wrong_share_network_ssas(meta, get_finding_writer(report, 'share network security service associations', 'share_network_security_service_association'))
+    if len(wrong_share_network_ssas) != 0:
+        log.info("- share network security service association inconsistencies found")
+        # print out what we would delete
+        log_findings(report, 'share network security service associations', 'share_network_security_service_association', wrong_share_network_ssas,
+                     "-- share network security service association id: %s - deleted share network id: %s", written=True)
+        if not args.dry_run:
+            log.info("- deleting share network security service association inconsistencies found")
+            fix_wrong_share_network_ssas(meta, wrong_share_network_ssas, args.batch_size)
+    else:
+        log.info("- share network security service associations are consistent")
+
+# check and fix network allocations of deleted share servers together with their orphan neutron ports
+def check_network_allocations(meta, args, neutron, report=None):
+    wrong_network_allocations = get_wrong_network_allocations(meta, args.older_than, get_finding_writer(report, 'network allocations', 'network_allocations'))
+    if len(wrong_network_allocations) != 0:
+        log.info("- network allocation inconsistencies found")
+        # print out what we would delete
+        log_findings(report, 'network allocations', 'network_allocations', wrong_network_allocations,
+                     "-- network allocation id: %s - deleted share server id: %s", written=True)
+        for network_allocation_id in wrong_network_allocations:
+            try:
+                port = neutron.get_port(network_allocation_id)
+            except exceptions.ResourceNotFound:
+                pass
+            else:
+                log.warning("-- network allocation id: %s - orphan neutron port will be deleted for share server id: %s",
+                            network_allocation_id, wrong_network_allocations[network_allocation_id])
+                if port.device_id == wrong_network_allocations[network_allocation_id]:
+                    if not args.dry_run:
+                        neutron.delete_port(network_allocation_id)
+                else:
+                    log.warning("-- network allocation id: %s - orphan neutron port device id: %s not matching share server id: %",
+                                network_allocation_id, port.device_id, wrong_network_allocations[network_allocation_id])
+        if not args.dry_run:
+            log.info("- deleting network allocation inconsistencies found")
+            fix_wrong_network_allocations(meta, wrong_network_allocations, args.batch_size)
+    else:
+        log.info("- network allocations are consistent")
+
+# check and fix share metadata of deleted shares
+def check_share_metadata(meta, args, report=None):
+    wrong_share_metadata = get_wrong_share_metadata(meta, get_finding_writer(report, 'share metadata', 'share_metadata'))
+    if len(wrong_share_metadata) != 0:
+        log.info("- share metadata inconsistencies found")
+        # print out what we would delete
+        log_findings(report, 'share metadata', 'share_metadata', wrong_share_metadata,
+                     "-- share metadata id: %s - deleted share id: %s", written=True)
+        if not args.dry_run:
+            log.info("- deleting share metadata inconsistencies found")
+            fix_wrong_share_metadata(meta, wrong_share_metadata, args.batch_size)
+    else:
+        log.info("- share metadata is consistent")
+
+# check and fix share group type share type mappings of deleted share group types
+def check_share_gtstm(meta, args, report=None):
+    wrong_share_gtstm = get_wrong_share_gtstm(meta, get_finding_writer(report, 'share group type share type mappings', 'share_group_type_share_type_mappings'))
+    if len(wrong_share_gtstm) != 0:
+        log.info("- share group type share type mapping inconsistencies found")
+        # print out what we would delete
+        log_findings(report, 'share group type share type mappings', 'share_group_type_share_type_mappings', wrong_share_gtstm,
+                     "-- share group type share type mapping id: %s - deleted share group type id: %s", written=True)
+        if not args.dry_run:
+            log.info("- deleting share group type share type mapping inconsistencies found")
+            fix_wrong_share_gtstm(meta, wrong_share_gtstm, args.batch_size)
+    else:
+        log.info("- share group type share type mapping is consistent")
+
+# check and fix share instance access mappings of deleted share instances
+def check_share_instance_access_mapping(meta, args, report=None):
+    wrong_share_instance_access_mapping = get_wrong_share_instance_access_mapping(meta, get_finding_writer(report, 'share instance access mappings', 'share_instance_access_map'))
+    if len(wrong_share_instance_access_mapping) != 0:
+        log.info("- share instance access mapping inconsistencies found")
+        # print out what we would delete
+        log_findings(report, 'share instance access mappings', 'share_instance_access_map', wrong_share_instance_access_mapping,
+                     "-- share group type share type mapping id: %s - deleted share instance id: %s", written=True)
+        if not args.dry_run:
+            log.info("- deleting share group type share type mapping inconsistencies found")
+            fix_wrong_share_instance_access_mapping(meta, wrong_share_instance_access_mapping, args.batch_size)
+    else:
+        log.info("- share instance access mapping is consistent")
+
+# check and fix share instance export location metadata of deleted share instance export locations
+def check_si_el_metadata(meta, args, report=None):
+    wrong_si_el_metadata = get_wrong_si_el_metadata(meta, get_finding_writer(report, 'share instance export location metadata', 'share_instance_export_locations_metadata'))
+    if len(wrong_si_el_metadata) != 0:
+        log.info("- share instance export location metadata inconsistencies found")
+        # print out what we would delete
+        log_findings(report, 'share instance export location metadata', 'share_instance_export_locations_metadata', wrong_si_el_metadata,
+                     "-- share instance export location metadata id: %s - deleted share instance export location id: %s", written=True)
+        if not args.dry_run:
+            log.info("- deleting share instance export location metadata inconsistencies found")
+            fix_wrong_si_el_metadata(meta, wrong_si_el_metadata, args.batch_size)
+    else:
+        log.info("- share instance export location metadata is consistent")
 
 # establish a database connection and return the handle
-def makeConnection(db_url):
+def makeConnection(db_url, schema_cache_dir=None, parallel=1):
 
-    engine = create_engine(db_url)
+    # one pooled connection per check running in parallel and one spare for the main thread
+    engine = create_engine(db_url, pool_size=max(parallel + 1, 5))
     engine.connect()
     Session = sessionmaker(bind=engine)
     thisSession = Session()
-    metadata = MetaData()
-    metadata.bind = engine
+    metadata = load_metadata(engine, schema_cache_dir)
     Base = declarative_base()
     return thisSession, metadata, Base
 
@@ -319,6 +405,18 @@ def parse_cmdline_args():
                         type=int,
                         default=2,
                         help="how many hours of marked as deleted entries to keep")
+    parser.add_argument("--parallel",
+                        type=int,
+                        default=1,
+                        help="number of independent checks to run in parallel")
+    parser.add_argument("--report-file",
+                        help="write the findings as JSON lines to this file instead of logging each of them")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=DEFAULT_BATCH_SIZE,
+                        help="maximum number of rows to soft delete per statement and transaction")
+    parser.add_argument("--schema-cache-dir",
+                        help="directory to cache the reflected db schema in between runs")
     return parser.parse_args()
 
 def main():
@@ -329,102 +427,42 @@ def main():
 
     # connect to the DB
     db_url = get_db_url(args.config)
-    _, manila_metadata, _ = makeConnection(db_url)
+    _, manila_metadata, _ = makeConnection(db_url, args.schema_cache_dir, args.parallel)
     # build neutron client
     neutron = get_neutronclient(args.config)
 
-    wrong_share_network_ssas = get_wrong_share_network_ssas(manila_metadata)
-    if len(wrong_share_network_ssas) != 0:
-        log.info("- share network security service association inconsistencies found")
-        # print out what we would delete
-        for share_network_ssa_id in wrong_share_network_ssas:
-            log.info("-- share network security service association id: %s - deleted share network id: %s", share_network_ssa_id, wrong_share_network_ssas[share_network_ssa_id])
-        if not args.dry_run:
-            log.info("- deleting share network security service association inconsistencies found")
-            fix_wrong_share_network_ssas(manila_metadata, wrong_share_network_ssas)
-    else:
-        log.info("- share network security service associations are consistent")
-
-
-    wrong_network_allocations = get_wrong_network_allocations(manila_metadata, args.older_than)
-    if len(wrong_network_allocations) != 0:
-        log.info("- network allocation inconsistencies found")
-        # print out what we would delete
-        for network_allocation_id in wrong_network_allocations:
-            log.info("-- network allocation id: %s - deleted share server id: %s", network_allocation_id, wrong_network_allocations[network_allocation_id])
-            try:
-                port = neutron.get_port(network_allocation_id)
-            except exceptions.ResourceNotFound:
-                pass
-            else:
-                log.warning("-- network allocation id: %s - orphan neutron port will be deleted for share server id: %s",
-                            network_allocation_id, wrong_network_allocations[network_allocation_id])
-                if port.device_id == wrong_network_allocations[network_allocation_id]:
-                    if not args.dry_run:
-                        neutron.delete_port(network_allocation_id)
-                else:
-                    log.warning("-- network allocation id: %s - orphan neutron port device id: %s not matching share server id: %",
-                                network_allocation_id, port.device_id, wrong_network_allocations[network_allocation_id])
-        if not args.dry_run:
-            log.info("- deleting network allocation inconsistencies found")
-            fix_wrong_network_allocations(manila_metadata, wrong_network_allocations)
-    else:
-        log.info("- network allocations are consistent")
-
-
-    wrong_share_metadata = get_wrong_share_metadata(manila_metadata)
-    if len(wrong_share_metadata) != 0:
-        log.info("- share metadata inconsistencies found")
-        # print out what we would delete
-        for share_metadata_id in wrong_share_metadata:
-            log.info("-- share metadata id: %s - deleted share id: %s", share_metadata_id, wrong_share_metadata[share_metadata_id])
-        if not args.dry_run:
-            log.info("- deleting share metadata inconsistencies found")
-            fix_wrong_share_metadata(manila_metadata, wrong_share_metadata)
-    else:
-        log.info("- share metadata is consistent")
-
-
-    wrong_share_gtstm = get_wrong_share_gtstm(manila_metadata)
-    if len(wrong_share_gtstm) != 0:
-        log.info("- share group type share type mapping inconsistencies found")
-        # print out what we would delete
-        for share_gtstm_id in wrong_share_gtstm:
-            log.info("-- share group type share type mapping id: %s - deleted share group type id: %s", share_gtstm_id, wrong_share_gtstm[share_gtstm_id])
-        if not args.dry_run:
-            log.info("- deleting share group type share type mapping inconsistencies found")
-            fix_wrong_share_gtstm(manila_metadata, wrong_share_gtstm)
-    else:
-        log.info("- share group type share type mapping is consistent")
-
-
-    wrong_share_instance_access_mapping = get_wrong_share_instance_access_mapping(manila_metadata)
-    if len(wrong_share_instance_access_mapping) != 0:
-        log.info("- share instance access mapping inconsistencies found")
-        # print out what we would delete
-        for share_instance_access_mapping_id, share_instance_id in wrong_share_instance_access_mapping.items():
-            log.info("-- share group type share type mapping id: %s - deleted share instance id: %s",
-                     share_instance_access_mapping_id,
-                     share_instance_id)
-        if not args.dry_run:
-            log.info("- deleting share group type share type mapping inconsistencies found")
-            fix_wrong_share_instance_access_mapping(manila_metadata, wrong_share_instance_access_mapping)
-    else:
-        log.info("- share instance access mapping is consistent")
+    # the findings are written to the report file instead of being logged one by one
+    report = FindingsReport(args.report_file) if args.report_file else None
+
+    # the checks in the order they run without --parallel - with the tables they read and (by their fixes) write,
+    # so that checks on the same tables keep this order when run in parallel
+    checks = [
+        Check('share network security service associations',
+              partial(check_share_network_ssas, manila_metadata, args, report=report),
+              reads=['share_networks'], writes=['share_network_security_service_association']),
+        Check('network allocations',
+              partial(check_network_allocations, manila_metadata, args, neutron, report=report),
+              reads=['share_servers'], writes=['network_allocations']),
+        Check('share metadata',
+              partial(check_share_metadata, manila_metadata, args, report=report),
+              reads=['shares'], writes=['share_metadata']),
+        Check('share group type share type mappings',
+              partial(check_share_gtstm, manila_metadata, args, report=report),
+              reads=['share_group_types'], writes=['share_group_type_share_type_mappings']),
+        Check('share instance access mappings',
+              partial(check_share_instance_access_mapping, manila_metadata, args, report=report),
+              reads=['share_instances'], writes=['share_instance_access_map']),
+        Check('share instance export location metadata',
+              partial(check_si_el_metadata, manila_metadata, args, report=report),
+              reads=['share_instance_export_locations'], writes=['share_instance_export_locations_metadata']),
+    ]
+    try:
+        run_checks(checks, args.parallel, read_only=args.dry_run)
+    finally:
+        if report:
+            report.close()
 
-    wrong_si_el_metadata = get_wrong_si_el_metadata(manila_metadata)
-    if len(wrong_si_el_metadata) != 0:
-        log.info("- share instance export location metadata inconsistencies found")
-        # print out what we would delete
-        for si_el_metadata_id, si_el_id in wrong_si_el_metadata.items():
-            log.info("-- share instance export location metadata id: %s - deleted share instance export location id: %s",
-                     si_el_metadata_id,
-                     si_el_id)
-        if not args.dry_run:
-            log.info("- deleting share instance export location metadata inconsistencies found")
-            fix_wrong_si_el_metadata(manila_metadata, wrong_si_el_metadata)
-    else:
-        log.info("- share instance export location metadata is consistent")
+    save_metadata(manila_metadata)
 
 
 if __name__ == "__main__":
@@ -25,9 +25,13 @@ import sys
 import sqlalchemy
 from prettytable import PrettyTable
 from prometheus_client import Counter, start_http_server
-from sqlalchemy import Table, and_, func, select, update
+from sqlalchemy import and_, func, select, update
 
 from helper.manilananny import base_command_parser
+from helper.project_pool import map_projects
+from helper.quota_usages import DEFAULT_PROJECT_BATCH_SIZE, QuotaUsagesWriter
+from helper.watermark import DEFAULT_FULL_SWEEP_EVERY, WatermarkState, changed_since_condition, get_changed_projects, \
+    get_changed_watermarks
 from manilananny import ManilaNanny
 
 logHandler = logging.StreamHandler()
@@ -37,26 +41,37 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 logger.addHandler(logHandler)
 
+# the tables whose changes can make the quota usages of a project drift
+CHANGED_PROJECT_TABLES = ['shares', 'share_snapshots', 'share_networks', 'share_instances']
+
 
 class ManilaQuotaSyncNanny(ManilaNanny):
-    def __init__(self, config_file, interval, dry_run):
+    def __init__(self, config_file, interval, dry_run, sync_batch_size=DEFAULT_PROJECT_BATCH_SIZE,
+                 incremental_state_file=None, full_sweep_every=DEFAULT_FULL_SWEEP_EVERY, workers=1):
+        # every worker needs its own connection from the pool
+        self.workers = max(workers, 1)
+        self.db_pool_size = max(self.workers, self.db_pool_size)
         super(ManilaQuotaSyncNanny, self).__init__(config_file, interval, dry_run)
+        self.sync_batch_size = sync_batch_size
+        self.incremental_state_file = incremental_state_file
+        self.full_sweep_every = full_sweep_every
         self.MANILA_QUOTA_BY_USER_SYNCED = Counter('manila_nanny_user_quota_synced', '')
         self.MANILA_QUOTA_BY_TYPE_SYNCED = Counter('manila_nanny_share_type_quota_synced', '')
 
     def get_share_networks_usages_project(self, project_id):
-        """Return the share_networks resource usages of a project"""
-        networks_t = Table('share_networks', self.db_metadata, autoload=True)
-        networks_q = select(columns=[networks_t.c.id,
-                                     networks_t.c.user_id],
+        """Return the number of share_networks of a project per user"""
+        networks_t = self.db_table('share_networks')
+        networks_q = select(columns=[networks_t.c.user_id,
+                                     func.count()],
                             whereclause=and_(networks_t.c.deleted == "False",
-                                             networks_t.c.project_id == project_id))
+                                             networks_t.c.project_id == project_id)
+                            ).group_by(networks_t.c.user_id)
         return networks_q.execute()
 
     def get_snapshot_usages_project(self, project_id):
-        """Return the snapshots resource usages of a project"""
-        snapshots_t = Table('share_snapshots', self.db_metadata, autoload=True)
-        share_instances_t = Table('share_instances', self.db_metadata, autoload=True)
+        """Return the number and size of the snapshots of a project per user and share type"""
+        snapshots_t = self.db_table('share_snapshots')
+        share_instances_t = self.db_table('share_instances')
         q = snapshots_t.join(share_instances_t,
                              snapshots_t.c.share_id == share_instances_t.c.share_id)
         snapshots_q = select(columns=[snapshots_t.c.id,
@@ -66,43 +81,49 @@ class ManilaQuotaSyncNanny(ManilaNanny):
                              whereclause=and_(snapshots_t.c.deleted == "False",
                                               snapshots_t.c.project_id == project_id,
                                               share_instances_t.c.deleted == "False")
-                             ).select_from(q).group_by(snapshots_t.c.id)
+                             ).select_from(q).group_by(snapshots_t.c.id).subquery()
+        # one row per snapshot above, which are then counted per user and share type
+        snapshots_q = select(columns=[snapshots_q.c.user_id,
+                                      snapshots_q.c.share_type_id,
+                                      func.count(),
+                                      func.coalesce(func.sum(snapshots_q.c.share_size), 0)]
+                             ).group_by(snapshots_q.c.user_id, snapshots_q.c.share_type_id)
         return snapshots_q.execute()
 
     def get_share_usages_project(self, project_id):
-        """Return the share resource usages of a project"""
-        shares_t = Table('shares', self.db_metadata, autoload=True)
-        share_instances_t = Table('share_instances', self.db_metadata, autoload=True)
+        """Return the number and size of the shares of a project per user and share type"""
+        shares_t = self.db_table('shares')
+        share_instances_t = self.db_table('share_instances')
         q = shares_t.join(share_instances_t, shares_t.c.id == share_instances_t.c.share_id)
-        shares_q = select(columns=[shares_t.c.id,
-                                   shares_t.c.user_id,
-                                   shares_t.c.size,
-                                   share_instances_t.c.share_type_id],
+        shares_q = select(columns=[shares_t.c.user_id,
+                                   share_instances_t.c.share_type_id,
+                                   func.count(),
+                                   func.coalesce(func.sum(shares_t.c.size), 0)],
                           whereclause=and_(shares_t.c.deleted == "False",
                                            shares_t.c.project_id == project_id,
                                            share_instances_t.c.deleted == "False")
-                          ).select_from(q)
+                          ).select_from(q).group_by(shares_t.c.user_id, share_instances_t.c.share_type_id)
         return shares_q.execute()
 
     def get_project_replica_usages(self, project_id):
-        """ Return the replica usage of a project """
-        shares_t = Table('shares', self.db_metadata, autoload=True)
-        share_instances_t = Table('share_instances', self.db_metadata, autoload=True)
+        """ Return the number and size of the replicas of a project per user and share type """
+        shares_t = self.db_table('shares')
+        share_instances_t = self.db_table('share_instances')
         q = shares_t.join(share_instances_t, shares_t.c.id == share_instances_t.c.share_id)
-        shares_q = select(columns=[shares_t.c.id,
-                                   shares_t.c.user_id,
-                                   shares_t.c.size,
-                                   share_instances_t.c.share_type_id],
+        shares_q = select(columns=[shares_t.c.user_id,
+                                   share_instances_t.c.share_type_id,
+                                   func.count(),
+                                   func.coalesce(func.sum(shares_t.c.size), 0)],
                           whereclause=and_(shares_t.c.deleted == "False",
                                            shares_t.c.project_id == project_id,
                                            share_instances_t.c.deleted == "False",
                                            share_instances_t.c.replica_state != None)   # noqa: E711
-                          ).select_from(q)
+                          ).select_from(q).group_by(shares_t.c.user_id, share_instances_t.c.share_type_id)
         return shares_q.execute()
 
     def get_quota_usages_project(self, project_id):
         """Return the quota usages of a project"""
-        quota_usages_t = Table('quota_usages', self.db_metadata, autoload=True)
+        quota_usages_t = self.db_table('quota_usages')
         quota_usages_q = select(columns=[quota_usages_t.c.resource,
                                          quota_usages_t.c.user_id,
                                          quota_usages_t.c.share_type_id,
@@ -113,7 +134,7 @@ class ManilaQuotaSyncNanny(ManilaNanny):
 
     def get_resource_types(self, project_id):
         """Return a list of all resource types"""
-        quota_usages_t = Table('quota_usages', self.db_metadata, autoload=True)
+        quota_usages_t = self.db_table('quota_usages')
         resource_types_q = select(columns=[quota_usages_t.c.resource,
                                            func.count()],
                                   whereclause=quota_usages_t.c.deleted == 0,
@@ -122,34 +143,96 @@ class ManilaQuotaSyncNanny(ManilaNanny):
 
     def get_projects(self):
         """Return a list of all projects in the database"""
-        quota_usages_t = Table('quota_usages', self.db_metadata, autoload=True)
+        quota_usages_t = self.db_table('quota_usages')
         quota_usages_q = select(columns=[quota_usages_t.c.project_id]).group_by(quota_usages_t.c.project_id)
         return [project[0] for project in quota_usages_q.execute()]
 
-    def sync_quota_usages_project(self, project_id, quota_to_sync_by_user, quota_to_sync_by_type):
-        """Sync the quota usages of a project from real usages"""
+    def get_projects_changed_since(self, changed_since):
+        """Return the projects with shares, snapshots, share networks or replicas changed since the given times
+
+        A time of None takes all rows of a table, as it had no rows at the last run.
+        """
+        changed_since = dict(changed_since)
+        share_instances_since = changed_since.pop('share_instances')
+        projects = get_changed_projects(self.db_metadata, changed_since)
+        # the share instances (and thus the replicas) only get their project from their share
+        shares_t = self.db_table('shares')
+        share_instances_t = self.db_table('share_instances')
+        q = shares_t.join(share_instances_t, shares_t.c.id == share_instances_t.c.share_id)
+        projects_q = select(columns=[shares_t.c.project_id]).select_from(q).distinct()
+        if share_instances_since is not None:
+            projects_q = projects_q.where(changed_since_condition(share_instances_t, share_instances_since))
+        projects.update(project_id for (project_id,) in projects_q.execute())
+        return projects
+
+    def sync_quota_usages_project(self, writer, project_id, quota_to_sync_by_user, quota_to_sync_by_type):
+        """Queue the quota usages of a project to sync from real usages with the writer"""
         print("Syncing %s" % (project_id))
-        now = datetime.datetime.utcnow()
-        quota_usages_t = Table('quota_usages', self.db_metadata, autoload=True)
         # a tuple is used here to have a dict value per project and user
-        for resource_tuple, quota in quota_to_sync_by_user.items():
-            quota_usages_t.update().values(updated_at=now, in_use=quota).where(and_(
-                quota_usages_t.c.project_id == project_id,
-                quota_usages_t.c.resource == resource_tuple[0],
-                quota_usages_t.c.user_id == resource_tuple[1])).execute()
-        for (resource, share_type_id), quota in quota_to_sync_by_type.items():
-            quota_usages_t.update().values(updated_at=now, in_use=quota).where(and_(
-                quota_usages_t.c.project_id == project_id,
-                quota_usages_t.c.resource == resource,
-                quota_usages_t.c.share_type_id == share_type_id,
-            )).execute()
+        writer.add_project(project_id, ('resource', 'user_id'), quota_to_sync_by_user)
+        writer.add_project(project_id, ('resource', 'share_type_id'), quota_to_sync_by_type)
 
     def sync_quota_usages_by_type(self, project_id, quota_to_sync):
         # print("Syncing %s" % (project_id))
         # now = datetime.datetime.utcnow()
-        # quota_usages_t = Table('quota_usages', self.db_metadata, autoload=True)
+        # quota_usages_t = self.db_table('quota_usages')
         pass
 
+    def check_project(self, project_id):
+        """Return the quota usages of a project differing from its real usages
+
+        The mismatches are returned as two lists of (user, resource, quota usage, real usage)
+        and (share type, resource, quota usage, real usage) tuples.
+        """
+        # get the quota usage of a project
+        quota_usages = {}
+        for (resource, user, share_type, count) in self.get_quota_usages_project(project_id):
+            quota_usages[(resource, user, share_type)] = quota_usages.get((resource, user, share_type), 0) + count
+
+        # get the real usage of a project - already counted and summed up per user and share type by the db
+        real_usages = {}
+        for (user, share_type_id, count, size) in self.get_share_usages_project(project_id):
+            real_usages[("shares", user, share_type_id)] = int(count)
+            real_usages[("gigabytes", user, share_type_id)] = int(size)
+        for (user, share_type_id, count, size) in self.get_snapshot_usages_project(project_id):
+            real_usages[("snapshots", user, share_type_id)] = int(count)
+            real_usages[("snapshot_gigabytes", user, share_type_id)] = int(size)
+        for (user, count) in self.get_share_networks_usages_project(project_id):
+            real_usages[("share_networks", user, None)] = int(count)
+        for (user, share_type_id, count, size) in self.get_project_replica_usages(project_id):
+            real_usages[("share_replicas", user, share_type_id)] = int(count)
+            real_usages[("replica_gigabytes", user, share_type_id)] = int(size)
+
+        # find discrepancies between quota usage and real usage
+        quota_usages_by_user = {(r, u): q for (r, u, _), q in quota_usages.items() if u is not None}
+        quota_usages_by_type = {(r, t): q for (r, _, t), q in quota_usages.items() if t is not None}
+        quota_usages_by_user_sorted_keys = sorted(list(quota_usages_by_user.keys()), key=lambda k: k[1])
+        quota_usages_by_type_sorted_keys = sorted(list(quota_usages_by_type.keys()), key=lambda k: k[1])
+
+        real_usages_by_user = {}
+        for (r, u, t), q in real_usages.items():
+            real_usages_by_user[(r, u)] = real_usages_by_user.get((r, u), 0) + q
+        real_usages_by_type = {}
+        for (r, u, t), q in real_usages.items():
+            if t is not None:
+                real_usages_by_type[(r, t)] = real_usages_by_type.get((r, t), 0) + q
+
+        mismatches_by_user = []
+        for resource, user in quota_usages_by_user_sorted_keys:
+            quota = quota_usages_by_user[(resource, user)]
+            real_quota = real_usages_by_user.get((resource, user), 0)
+            if quota != real_quota:
+                mismatches_by_user.append((user, resource, quota, real_quota))
+
+        mismatches_by_type = []
+        for resource, type in quota_usages_by_type_sorted_keys:
+            quota = quota_usages_by_type[(resource, type)]
+            real_quota = real_usages_by_type.get((resource, type), 0)
+            if quota != real_quota:
+                mismatches_by_type.append((type, resource, quota, real_quota))
+
+        return mismatches_by_user, mismatches_by_type
+
     def _run(self):
         # prepare the output
         ptable_user = PrettyTable(["Project ID", "User ID", "Resource", "Quota -> Real", "Sync Status"])
@@ -161,72 +244,67 @@ class ManilaQuotaSyncNanny(ManilaNanny):
             self.init_db_connection()
             projects = self.get_projects()
 
-        for project_id in projects:
-            # get the quota usage of a project
-            quota_usages = {}
-            for (resource, user, share_type, count) in self.get_quota_usages_project(project_id):
-                quota_usages[(resource, user, share_type)] = quota_usages.get((resource, user, share_type), 0) + count
-
-            # get the real usage of a project
-            real_usages = {}
-            for (_, user, size, share_type_id) in self.get_share_usages_project(project_id):
-                real_usages[("shares", user, share_type_id)] = real_usages.get(("shares", user, share_type_id), 0) + 1
-                real_usages[("gigabytes", user, share_type_id)] = real_usages.get(("gigabytes", user, share_type_id), 0) + size
-            for (_, user, size, share_type_id) in self.get_snapshot_usages_project(project_id):
-                real_usages[("snapshots", user, share_type_id)] = real_usages.get(("snapshots", user, share_type_id), 0) + 1
-                real_usages[("snapshot_gigabytes", user, share_type_id)] = real_usages.get(("snapshot_gigabytes", user, share_type_id), 0) + size
-            for (_, user) in self.get_share_networks_usages_project(project_id):
-                real_usages[("share_networks", user, None)] = real_usages.get(("share_networks", user, None), 0) + 1
-            for (_, user, size, share_type_id) in self.get_project_replica_usages(project_id):
-                real_usages[("share_replicas", user, share_type_id)] = real_usages.get(("share_replicas", user, share_type_id), 0) + 1
-                real_usages[("replica_gigabytes", user, share_type_id)] = real_usages.get(("replica_gigabytes", user, share_type_id), 0) + size
-
-            # find discrepancies between quota usage and real usage
+        # in delta mode only the projects with changes since the last successful run are reconciled
+        watermarks = None
+        if self.incremental_state_file:
+            watermarks = WatermarkState(self.incremental_state_file, self.full_sweep_every)
+            full_sweep = watermarks.full_sweep_due()
+            new_marks = get_changed_watermarks(self.db_metadata, CHANGED_PROJECT_TABLES)
+            if full_sweep:
+                print("Reconciling all %s projects (full sweep)" % len(projects))
+            else:
+                changed_since = watermarks.since()
+                changed_projects = self.get_projects_changed_since(
+                    {table_name: changed_since.get(table_name) for table_name in CHANGED_PROJECT_TABLES})
+                projects = [project_id for project_id in projects if project_id in changed_projects]
+                print("Reconciling the %s projects changed since the last run" % len(projects))
+
+        # the projects are checked on up to self.workers threads, but the mismatches are merged in project order
+        results, failed_projects = map_projects(self.check_project, projects, self.workers)
+
+        # the corrections are written in bulk per batch of projects
+        writer = QuotaUsagesWriter(self.engine, self.db_table('quota_usages'), self.sync_batch_size)
+        for project_id, (mismatches_by_user, mismatches_by_type) in results:
             quota_usages_by_user_to_sync = {}
             quota_usages_by_type_to_sync = {}
 
-            quota_usages_by_user = {(r, u): q for (r, u, _), q in quota_usages.items() if u is not None}
-            quota_usages_by_type = {(r, t): q for (r, _, t), q in quota_usages.items() if t is not None}
-            quota_usages_by_user_sorted_keys = sorted(list(quota_usages_by_user.keys()), key=lambda k: k[1])
-            quota_usages_by_type_sorted_keys = sorted(list(quota_usages_by_type.keys()), key=lambda k: k[1])
-
-            real_usages_by_user = {}
-            for (r, u, t), q in real_usages.items():
-                real_usages_by_user[(r, u)] = real_usages_by_user.get((r, u), 0) + q
-            real_usages_by_type = {}
-            for (r, u, t), q in real_usages.items():
-                if t is not None:
-                    real_usages_by_type[(r, t)] = real_usages_by_type.get((r, t), 0) + q
-
-            for resource, user in quota_usages_by_user_sorted_keys:
-                quota = quota_usages_by_user[(resource, user)]
-                real_quota = real_usages_by_user.get((resource, user), 0)
-                if quota != real_quota:
-                    quota_usages_by_user_to_sync[(resource, user)] = real_quota
-                    ptable_user.add_row([project_id, user, resource,
-                                         str(quota) + ' -> ' + str(real_quota),
-                                         '\033[1m\033[91mMISMATCH\033[0m'])
-                    if not self.dry_run:
-                        self.MANILA_QUOTA_BY_USER_SYNCED.inc()
-
-            for resource, type in quota_usages_by_type_sorted_keys:
-                quota = quota_usages_by_type[(resource, type)]
-                real_quota = real_usages_by_type.get((resource, type), 0)
-                if quota != real_quota:
-                    quota_usages_by_type_to_sync[(resource, type)] = real_quota
-                    ptable_type.add_row([project_id, type, resource,
-                                         str(quota) + ' -> ' + str(real_quota),
-                                         '\033[1m\033[91mMISMATCH\033[0m'])
-                    if not self.dry_run:
-                        self.MANILA_QUOTA_BY_TYPE_SYNCED.inc()
+            for user, resource, quota, real_quota in mismatches_by_user:
+                quota_usages_by_user_to_sync[(resource, user)] = real_quota
+                ptable_user.add_row([project_id, user, resource,
+                                     str(quota) + ' -> ' + str(real_quota),
+                                     '\033[1m\033[91mMISMATCH\033[0m'])
+                if not self.dry_run:
+                    self.MANILA_QUOTA_BY_USER_SYNCED.inc()
+
+            for type, resource, quota, real_quota in mismatches_by_type:
+                quota_usages_by_type_to_sync[(resource, type)] = real_quota
+                ptable_type.add_row([project_id, type, resource,
+                                     str(quota) + ' -> ' + str(real_quota),
+                                     '\033[1m\033[91mMISMATCH\033[0m'])
+                if not self.dry_run:
+                    self.MANILA_QUOTA_BY_TYPE_SYNCED.inc()
 
             # sync the quota with the real usage
             if not self.dry_run:
                 if len(quota_usages_by_type_to_sync) > 0 or len(quota_usages_by_user_to_sync) > 0:
-                    self.sync_quota_usages_project(project_id,
+                    self.sync_quota_usages_project(writer,
+                                                   project_id,
                                                    quota_usages_by_user_to_sync,
                                                    quota_usages_by_type_to_sync)
 
+        rows_changed, duration = writer.close()
+        if writer.projects_synced:
+            print("Synced %s projects: %s rows changed in %.2fs" % (writer.projects_synced, rows_changed, duration))
+
+        if failed_projects:
+            print("Failed to reconcile %s projects: %s" % (len(failed_projects), ', '.join(failed_projects)))
+
+        # in a dry run the mismatches found are left and failed projects have not been reconciled at all,
+        # so the same projects have to be reconciled again - the marks only advance once all of them are
+        if watermarks and not self.dry_run and not failed_projects:
+            watermarks.advance(new_marks, full_sweep)
+            watermarks.save()
+
         # format output
         print(ptable_user)
         print(ptable_type)
@@ -235,9 +313,9 @@ class ManilaQuotaSyncNanny(ManilaNanny):
         self.reset_snapshot_reserved_quota()
 
     def reset_share_reserved_quota(self):
-        Shares = Table("shares", self.db_metadata, autoload=True)
-        ShareInstances = Table("share_instances", self.db_metadata, autoload=True)
-        QuotaUsages = Table("quota_usages", self.db_metadata, autoload=True)
+        Shares = self.db_table('shares')
+        ShareInstances = self.db_table('share_instances')
+        QuotaUsages = self.db_table('quota_usages')
 
         log = logging.LoggerAdapter(logger, {"nanny": "share-reserved-quota"})
 
@@ -329,9 +407,9 @@ class ManilaQuotaSyncNanny(ManilaNanny):
                 conn.execute(stmt_u)
 
     def reset_snapshot_reserved_quota(self):
-        Snapshots = Table("share_snapshots", self.db_metadata, autoload=True)
-        SnapshotInstances = Table("share_snapshot_instances", self.db_metadata, autoload=True)
-        QuotaUsages = Table("quota_usages", self.db_metadata, autoload=True)
+        Snapshots = self.db_table('share_snapshots')
+        SnapshotInstances = self.db_table('share_snapshot_instances')
+        QuotaUsages = self.db_table('quota_usages')
 
         log = logging.LoggerAdapter(logger, {"nanny": "snapshot-reserved-quota"})
 
@@ -423,6 +501,20 @@ def main():
         parser.add_argument("--dry-run",
                             action="store_true",
                             help="never sync resources (no interactive check)")
+        parser.add_argument("--sync-batch-size",
+                            type=int,
+                            default=DEFAULT_PROJECT_BATCH_SIZE,
+                            help="number of projects to sync per transaction")
+        parser.add_argument("--incremental-state-file",
+                            help="only reconcile the projects changed since the last run and keep the high-water marks in this file")
+        parser.add_argument("--full-sweep-every",
+                            type=int,
+                            default=DEFAULT_FULL_SWEEP_EVERY,
+                            help="with --incremental-state-file reconcile all projects every this many runs")
+        parser.add_argument("--workers",
+                            type=int,
+                            default=1,
+                            help="number of projects to check in parallel - also the maximum number of db connections used")
         args = parser.parse_args()
     except Exception as e:
         sys.stdout.write("Check command line arguments (%s)" % e)
@@ -436,7 +528,8 @@ def main():
         sys.exit(-1)
 
     # args.dry_run = True
-    ManilaQuotaSyncNanny(args.config, args.interval, args.dry_run).run()
+    ManilaQuotaSyncNanny(args.config, args.interval, args.dry_run, args.sync_batch_size,
+                         args.incremental_state_file, args.full_sweep_every, args.workers).run()
 
 
 if __name__ == "__main__":
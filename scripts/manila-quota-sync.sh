@@ -20,13 +20,24 @@ set -e
 
 unset http_proxy https_proxy all_proxy no_proxy
 
+# in delta mode only the projects changed since the last run are reconciled and only
+# every MANILA_QUOTA_SYNC_FULL_SWEEP_EVERY runs all of them
+if [ "$MANILA_QUOTA_SYNC_INCREMENTAL" = "True" ] || [ "$MANILA_QUOTA_SYNC_INCREMENTAL" = "true" ]; then
+    INCREMENTAL_ARGS="--incremental-state-file /tmp/manila-quota-sync-watermarks.json --full-sweep-every ${MANILA_QUOTA_SYNC_FULL_SWEEP_EVERY:-24}"
+else
+    INCREMENTAL_ARGS=""
+fi
+
+# check up to MANILA_QUOTA_SYNC_WORKERS projects in parallel
+WORKERS_ARGS="--workers ${MANILA_QUOTA_SYNC_WORKERS:-1}"
+
 # we run an endless loop to run the script periodically
 if [ "$MANILA_QUOTA_SYNC_ENABLED" = "True" ] || [ "$MANILA_QUOTA_SYNC_ENABLED" = "true" ]; then
     if [ "$MANILA_QUOTA_SYNC_DRY_RUN" = "False" ] || [ "$MANILA_QUOTA_SYNC_DRY_RUN" = "false" ]; then
         echo "INFO: run nanny job for the manila quota sync"
-        /var/lib/openstack/bin/python /scripts/manila-quota-sync.py
+        /var/lib/openstack/bin/python /scripts/manila-quota-sync.py $INCREMENTAL_ARGS $WORKERS_ARGS
     else
         echo "INFO: run nanny job for the manila quota sync in dry-run mode only!"
-        /var/lib/openstack/bin/python /scripts/manila-quota-sync.py --dry-run
+        /var/lib/openstack/bin/python /scripts/manila-quota-sync.py --dry-run $INCREMENTAL_ARGS $WORKERS_ARGS
     fi
 fi
@@ -20,7 +20,7 @@ from threading import Lock
 from typing import Dict, List, Tuple
 
 from prometheus_client import Gauge
-from sqlalchemy import Table, and_, func, select
+from sqlalchemy import and_, func, select
 
 from helper.manilananny import base_command_parser
 from manilananny import ManilaNanny, response, update_records
@@ -71,8 +71,8 @@ class ManilaShareServerNanny(ManilaNanny):
 
     def query_share_server_count_share_instance(self) -> List[Tuple[str, int]]:
         """ share servers and count of undeleted share instances """
-        instances_t = Table('share_instances', self.db_metadata, autoload=True)
-        s_servers_t = Table('share_servers', self.db_metadata, autoload=True)
+        instances_t = self.db_table('share_instances')
+        s_servers_t = self.db_table('share_servers')
 
         q = select([s_servers_t.c.id.label('ssid'),
                     func.count(instances_t.c.id)])\
@@ -28,7 +28,7 @@ from threading import Lock
 
 import requests
 from prometheus_client import Counter, Gauge
-from sqlalchemy import Table, select, update
+from sqlalchemy import select, update
 
 from helper.manilananny import base_command_parser
 from manilananny import CustomAdapter, ManilaNanny, is_utcts_recent, response, update_records
@@ -567,8 +567,8 @@ class ManilaShareSyncNanny(ManilaNanny):
         Share: Dict[Keys['share_id', 'instance_id', 'created_at', 'updated_at', 'deleted_at',
                          'deleted', 'status', 'host'], Any]
         """
-        shares_t = Table('shares', self.db_metadata, autoload=True)
-        instances_t = Table('share_instances', self.db_metadata, autoload=True)
+        shares_t = self.db_table('shares')
+        instances_t = self.db_table('share_instances')
         q = select([shares_t.c.id.label('share_id'),
                     shares_t.c.created_at,
                     shares_t.c.updated_at,
@@ -586,8 +586,8 @@ class ManilaShareSyncNanny(ManilaNanny):
     def _query_shares(self):
         """ Get shares that are not deleted """
 
-        shares = Table('shares', self.db_metadata, autoload=True)
-        instances = Table('share_instances', self.db_metadata, autoload=True)
+        shares = self.db_table('shares')
+        instances = self.db_table('share_instances')
         stmt = select([shares.c.id,
                        shares.c.display_name,
                        shares.c.size,
@@ -621,7 +621,7 @@ class ManilaShareSyncNanny(ManilaNanny):
     def _query_share_instances(self, share_id):
         """ Get share instances for given share and that are not deleted """
 
-        instances = Table('share_instances', self.db_metadata, autoload=True)
+        instances = self.db_table('share_instances')
         stmt = select([instances.c.id,
                        instances.c.share_id,
                        instances.c.status,
@@ -680,8 +680,8 @@ class ManilaShareSyncNanny(ManilaNanny):
 
     def set_share_size(self, share_id, share_size):
         now = datetime.utcnow()
-        shares_t = Table('shares', self.db_metadata, autoload=True)
-        share_instances_t = Table('share_instances', self.db_metadata, autoload=True)
+        shares_t = self.db_table('shares')
+        share_instances_t = self.db_table('share_instances')
         update(shares_t) \
             .values(updated_at=now, size=share_size) \
             .where(shares_t.c.id == share_instances_t.c.share_id) \
@@ -15,16 +15,21 @@ from keystoneauth1 import session
 from keystoneauth1.identity import v3
 from manilaclient import client
 from prometheus_client import start_http_server
-from sqlalchemy import MetaData, Table, create_engine
+from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql import select
 
+from helper.db_schema import get_table, load_metadata
+
 log = logging.getLogger(__name__)
 
 
 class ManilaNanny(http.server.HTTPServer):
     ''' Manila Nanny '''
+    # size of the db connection pool - nannies using more threads raise it before calling __init__()
+    db_pool_size = 5
+
     def __init__(self, config, interval, dry_run=False, prom_port=0, address="", http_port=8000, handler=None, version="2.81", **extra_args):
         self.config_file = config
         self.interval = interval
@@ -67,12 +72,11 @@ class ManilaNanny(http.server.HTTPServer):
     def init_db_connection(self):
         """Establish a database connection"""
         db_url = self.get_db_url()
-        engine = create_engine(db_url, pool_recycle=3600)
+        engine = create_engine(db_url, pool_recycle=3600, pool_size=self.db_pool_size)
         engine.connect()
         Session = sessionmaker(bind=engine)
         self.db_session = Session()
-        self.db_metadata = MetaData()
-        self.db_metadata.bind = engine
+        self.db_metadata = load_metadata(engine)
         self.db_base = declarative_base()
         self.engine = engine
 
@@ -88,8 +92,8 @@ class ManilaNanny(http.server.HTTPServer):
         return db_url
 
     def db_table(self, table_name):
-        """Return the database table"""
-        return Table(table_name, self.db_metadata, autoload=True)
+        """Return the database table, reflected at most once per connection"""
+        return get_table(self.db_metadata, table_name)
 
     def renew_manila_client(self):
         self.manilaclient = create_manila_client(self.config_file, self.microversion)
@@ -18,38 +18,67 @@
 # this script checks for block_device_mappings in the nova db for already deleted volumes in cinder
 
 import argparse
+import concurrent.futures
 import sys
 import configparser
 import logging
 import os
 import datetime
 
+from functools import partial
+
 from openstack import connection, exceptions, utils
 
 from sqlalchemy import and_
 from sqlalchemy import func
-from sqlalchemy import MetaData
 from sqlalchemy import select
 from sqlalchemy import join
-from sqlalchemy import Table
 from sqlalchemy import create_engine
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql.expression import false
 from sqlalchemy.ext.declarative import declarative_base
 
+from helper.check_runner import Check, run_checks
+from helper.consistency_daemon import ConsistencyDaemon
+from helper.db_schema import get_table, load_metadata, save_metadata
+from helper.db_batch import DEFAULT_BATCH_SIZE, iter_partitions
+from helper.db_purge import DEFAULT_ESTIMATE_DAYS, DbPurger
+from helper.inventory import DEFAULT_PAGE_SIZE, drop_temp_table, fetch_uuid_inventory, fetch_uuid_inventory_db, get_nova_cell_db_urls, \
+    load_uuid_temp_table
+from helper.prometheus_exporter import prometheus_push
+
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)-15s %(message)s')
 
+# tables with deleted rows the nova db purge does not clean up properly
+ARCHIVE_TABLES = ['block_device_mapping', 'reservations', 'instance_id_mappings']
+
+
+# get the uuids of all volumes straight from the cinder db
+def get_cinder_volumes_db(cinder_db_url):
+
+    return fetch_uuid_inventory_db([(cinder_db_url, "SELECT id FROM volumes WHERE deleted = 0")], 'cinder volume')
 
-# get all volumes from cinder
-def get_cinder_volumes(conn):
 
-    cinder_volumes = dict()
+# get the uuids of all volumes from cinder - from the cinder db if a cinder db url is given and from the api otherwise
+def get_cinder_volumes(conn, page_size=DEFAULT_PAGE_SIZE, cinder_db_url=None):
+
+    if cinder_db_url:
+        try:
+            cinder_volumes = get_cinder_volumes_db(cinder_db_url)
+            if cinder_volumes:
+                return cinder_volumes
+            log.warn("- did not get any cinder volumes back from the cinder db - falling back to the cinder api")
+        except SQLAlchemyError as e:
+            log.warn("- could not read the cinder volumes from the cinder db - falling back to the cinder api: %s", str(e))
+
+    # get all volumes from cinder page by page, only keeping their uuids
+    def list_page(marker, limit):
+        return conn.block_store.volumes(details=False, all_projects=1, limit=limit, marker=marker, paginated=False)
 
-    # get all volumes from cinder
     try:
-        for cinder_volume in conn.block_store.volumes(details=False, all_projects=1):
-            cinder_volumes[cinder_volume.id] = cinder_volume
+        cinder_volumes = fetch_uuid_inventory(list_page, 'cinder volume', page_size)
         if not cinder_volumes:
             raise RuntimeError("- PLEASE CHECK MANUALLY - did not get any cinder volumes back from "
                                "the cinder api - this should in theory never happen ...")
@@ -62,9 +91,6 @@ def get_cinder_volumes(conn):
         log.warn("- PLEASE CHECK MANUALLY - got an sdk exception connecting to openstack: %s", str(e))
         sys.exit(1)
 
-    # for i in cinder_volumes:
-    #     print cinder_volumes[i].id
-
     return cinder_volumes
 
 
@@ -72,7 +98,7 @@ def get_cinder_volumes(conn):
 def get_block_device_mappings(meta):
 
     block_device_mappings = {}
-    block_device_mapping_t = Table('block_device_mapping', meta, autoload=True)
+    block_device_mapping_t = get_table(meta, 'block_device_mapping')
     block_device_mapping_q = select(columns=[block_device_mapping_t.c.id, block_device_mapping_t.c.volume_id],
                                     whereclause=and_(block_device_mapping_t.c.deleted == 0,
                                                      block_device_mapping_t.c.volume_id.isnot(None),
@@ -87,13 +113,48 @@ def get_block_device_mappings(meta):
 
 
 # get all the block_device_mappings in the nova db for already deleted volumes in cinder
-def get_wrong_block_device_mappings(cinder_volumes, block_device_mappings):
+def get_wrong_block_device_mappings(cinder_volumes, block_device_mappings, limit=None):
 
     wrong_block_device_mappings = {}
 
     for block_device_mapping_id in block_device_mappings:
-        if cinder_volumes.get(block_device_mappings[block_device_mapping_id]) is None:
+        if block_device_mappings[block_device_mapping_id] not in cinder_volumes:
             wrong_block_device_mappings[block_device_mapping_id] = block_device_mappings[block_device_mapping_id]
+            if limit and len(wrong_block_device_mappings) >= limit:
+                break
+
+    return wrong_block_device_mappings
+
+
+# get all the block_device_mappings in the nova db for already deleted volumes in cinder via an anti-join in
+# the db against the cinder volume uuids loaded into a temporary table - only the orphans are returned
+def get_wrong_block_device_mappings_db(meta, cinder_volumes, batch_size=DEFAULT_BATCH_SIZE, limit=None):
+
+    wrong_block_device_mappings = {}
+    block_device_mapping_t = get_table(meta, 'block_device_mapping')
+
+    with meta.bind.connect() as conn:
+        cinder_volumes_t = load_uuid_temp_table(conn, 'nanny_cinder_volumes', cinder_volumes, batch_size)
+        try:
+            block_device_mapping_join = block_device_mapping_t.outerjoin(
+                cinder_volumes_t, block_device_mapping_t.c.volume_id == cinder_volumes_t.c.uuid)
+            # block device mappings created after the cinder volumes were listed might belong to volumes not in the list yet
+            wrong_block_device_mapping_q = select(columns=[block_device_mapping_t.c.id, block_device_mapping_t.c.volume_id]).\
+                select_from(block_device_mapping_join).\
+                where(and_(block_device_mapping_t.c.deleted == 0,
+                           block_device_mapping_t.c.volume_id.isnot(None),
+                           block_device_mapping_t.c.destination_type == "volume",
+                           cinder_volumes_t.c.uuid.is_(None),
+                           block_device_mapping_t.c.created_at < cinder_volumes.fetched_at))
+            if limit:
+                wrong_block_device_mapping_q = wrong_block_device_mapping_q.limit(limit)
+
+            # return a dict indexed by block_device_mapping_id and with the value
+            # cinder_volume_id for non deleted block_device_mappings
+            for (block_device_mapping_id, cinder_volume_id) in conn.execute(wrong_block_device_mapping_q):
+                wrong_block_device_mappings[block_device_mapping_id] = cinder_volume_id
+        finally:
+            drop_temp_table(conn, cinder_volumes_t)
 
     return wrong_block_device_mappings
 
@@ -102,7 +163,7 @@ def get_wrong_block_device_mappings(cinder_volumes, block_device_mappings):
 def fix_wrong_block_device_mappings(meta, wrong_block_device_mappings, fix_limit):
 
     if len(wrong_block_device_mappings) <= int(fix_limit):
-        block_device_mapping_t = Table('block_device_mapping', meta, autoload=True)
+        block_device_mapping_t = get_table(meta, 'block_device_mapping')
 
         for block_device_mapping_id in wrong_block_device_mappings:
             log.info("-- action: deleting block device mapping id: %s", block_device_mapping_id)
@@ -119,42 +180,63 @@ def fix_wrong_block_device_mappings(meta, wrong_block_device_mappings, fix_limit
 
 # delete block_device_mappings in the nova db with the deleted flag set and older than a certain time
 # looks like the nova db purge does not clean those up properly
-def purge_block_device_mappings(meta, older_than):
+def purge_block_device_mappings(purger, meta, older_than):
 
-    block_device_mapping_t = Table('block_device_mapping', meta, autoload=True)
+    block_device_mapping_t = get_table(meta, 'block_device_mapping')
 
     log.info("- action: purging deleted block device mappings older than %s days", older_than)
     older_than_date = datetime.datetime.utcnow() - datetime.timedelta(days=older_than)
-    purge_block_device_mapping_q = block_device_mapping_t.delete().\
-        where(and_(block_device_mapping_t.c.deleted != 0,
-                   block_device_mapping_t.c.deleted_at < older_than_date))
-    purge_block_device_mapping_q.execute()
+    purger.purge_table(meta.bind, block_device_mapping_t, older_than_date)
 
 
 # delete reservations in the nova db with the deleted flag set and older than a certain time
 # looks like the nova db purge does not clean those up properly
-def purge_reservations(meta, older_than):
+def purge_reservations(purger, meta, older_than):
 
-    reservations_t = Table('reservations', meta, autoload=True)
+    reservations_t = get_table(meta, 'reservations')
 
     log.info("- action: purging deleted reservations older than %s days", older_than)
     older_than_date = datetime.datetime.utcnow() - datetime.timedelta(days=older_than)
-    purge_reservations_q = reservations_t.delete().\
-        where(and_(reservations_t.c.deleted != 0, reservations_t.c.deleted_at < older_than_date))
-    purge_reservations_q.execute()
+    purger.purge_table(meta.bind, reservations_t, older_than_date)
 
 
 # delete instance_id_mappings in the nova db with the deleted flag set and older than a certain time
 # looks like the nova db purge does not clean those up properly
-def purge_instance_id_mappings(meta, older_than):
+def purge_instance_id_mappings(purger, meta, older_than):
 
-    instance_id_mappings_t = Table('instance_id_mappings', meta, autoload=True)
+    instance_id_mappings_t = get_table(meta, 'instance_id_mappings')
 
     log.info("- action: purging deleted instance_id_mappings older than %s days", older_than)
     older_than_date = datetime.datetime.utcnow() - datetime.timedelta(days=older_than)
-    purge_instance_id_mappings_q = instance_id_mappings_t.delete().\
-        where(and_(instance_id_mappings_t.c.deleted != 0, instance_id_mappings_t.c.deleted_at < older_than_date))
-    purge_instance_id_mappings_q.execute()
+    purger.purge_table(meta.bind, instance_id_mappings_t, older_than_date)
+
+
+# estimate the rows of the tables above with the deleted flag set - per age only where an index on deleted_at allows it,
+# so that it stays cheap enough for every dry run
+def estimate_deleted_rows(purger, meta, days):
+
+    for table_name in ARCHIVE_TABLES:
+        purger.estimate_table(meta.bind, get_table(meta, table_name), days)
+
+
+# move the rows of the tables above with the deleted flag set and older than a certain time to their shadow
+# tables instead of deleting them - the tables without foreign keys between them in parallel
+def archive_deleted_rows(purger, meta, older_than, parallel=1):
+
+    log.info("- action: archiving deleted %s older than %s days to their shadow tables",
+             ", ".join(ARCHIVE_TABLES), older_than)
+    older_than_date = datetime.datetime.utcnow() - datetime.timedelta(days=older_than)
+    checks = []
+    for table_name in ARCHIVE_TABLES:
+        table_t = get_table(meta, table_name)
+        shadow_t = get_table(meta, 'shadow_' + table_name)
+        # tables referencing each other are archived one after the other
+        referenced = [fk.column.table.name for fk in table_t.foreign_keys]
+        checks.append(Check('archive ' + table_name,
+                            partial(purger.purge_table, meta.bind, table_t, older_than_date, shadow_table=shadow_t),
+                            writes=[table_name] + referenced))
+    run_checks(checks, parallel)
+    return sum(check.result for check in checks)
 
 
 # it looks like this is not required as the purging is already done properly via the instance purging
@@ -162,7 +244,7 @@ def purge_instance_id_mappings(meta, older_than):
 # # looks like the nova db purge does not clean those up properly
 # def purge_instance_system_metadata(meta, older_than):
 #
-#     instance_system_metadata_t = Table('instance_system_metadata', meta, autoload=True)
+#     instance_system_metadata_t = get_table(meta, 'instance_system_metadata')
 #
 #     log.info("- action: purging deleted instance_system_metadata older than %s days", older_than)
 #     older_than_date = datetime.datetime.utcnow() - datetime.timedelta(days=older_than)
@@ -175,7 +257,7 @@ def purge_instance_id_mappings(meta, older_than):
 # delete old instance fault entries in the nova db
 def purge_instance_faults(session, meta, max_instance_faults):
 
-    instance_faults_t = Table('instance_faults', meta, autoload=True)
+    instance_faults_t = get_table(meta, 'instance_faults')
 
     log.info("- purging instance faults to at maximum %s per instance", max_instance_faults)
     # get the max_instance_faults latest oinstance fault entries per instance and delete all others
@@ -192,6 +274,62 @@ def purge_instance_faults(session, meta, max_instance_faults):
         purge_instance_faults_q.execute()
 
 
+# delete old instance fault entries in the nova db set based - for a page of instances with too many faults
+# at a time only the ids of their surplus faults are selected and deleted in batches
+def purge_instance_faults_set_based(meta, max_instance_faults, batch_size=DEFAULT_BATCH_SIZE):
+
+    instance_faults_t = get_table(meta, 'instance_faults')
+    engine = meta.bind
+
+    log.info("- purging instance faults to at maximum %s per instance in batches of %s", max_instance_faults, batch_size)
+    last_instance_uuid = None
+    purged = 0
+    while True:
+        instances_q = select(columns=[instance_faults_t.c.instance_uuid]).\
+            group_by(instance_faults_t.c.instance_uuid).\
+            having(func.count() > max_instance_faults).\
+            order_by(instance_faults_t.c.instance_uuid).\
+            limit(batch_size)
+        # continue after the last page - the instances left there have at most max_instance_faults faults now
+        if last_instance_uuid is not None:
+            instances_q = instances_q.where(instance_faults_t.c.instance_uuid > last_instance_uuid)
+        with engine.connect() as db_conn:
+            instance_uuids = [instance_uuid for (instance_uuid,) in db_conn.execute(instances_q)]
+        if not instance_uuids:
+            break
+        last_instance_uuid = instance_uuids[-1]
+
+        # get all but the max_instance_faults latest instance fault entries of the instances of this page
+        ranked_q = select(columns=[
+            instance_faults_t.c.id,
+            instance_faults_t.c.instance_uuid,
+            func.dense_rank().over(
+                order_by=instance_faults_t.c.created_at.desc(),
+                partition_by=instance_faults_t.c.instance_uuid
+            ).label('rank')
+        ]).where(instance_faults_t.c.instance_uuid.in_(instance_uuids)).alias('ranked')
+        surplus_q = select(columns=[ranked_q.c.id, ranked_q.c.instance_uuid]).\
+            where(ranked_q.c.rank > max_instance_faults)
+
+        # the surplus ids are streamed and deleted batch by batch through another connection, so neither the ids
+        # held in memory nor a single delete grow with the number of faults of the instances of this page
+        surplus_per_instance = {}
+        for surplus in iter_partitions(engine, surplus_q, batch_size, stream=True):
+            with engine.begin() as db_conn:
+                db_conn.execute(instance_faults_t.delete().where(instance_faults_t.c.id.in_([fault_id for (fault_id, _) in surplus])))
+            for (_, instance_uuid) in surplus:
+                surplus_per_instance[instance_uuid] = surplus_per_instance.get(instance_uuid, 0) + 1
+            purged += len(surplus)
+
+        for instance_uuid in instance_uuids:
+            if surplus_per_instance.get(instance_uuid):
+                log.info("- action: deleted %s old instance fault entries for instance %s",
+                         surplus_per_instance[instance_uuid], instance_uuid)
+
+    log.info("- purged %s instance fault entries", purged)
+    return purged
+
+
 # establish an openstack connection
 def makeOsConnection():
     try:
@@ -211,14 +349,13 @@ def makeOsConnection():
 
 
 # establish a database connection and return the handle
-def makeConnection(db_url):
+def makeConnection(db_url, schema_cache_dir=None):
 
     engine = create_engine(db_url)
     engine.connect()
     Session = sessionmaker(bind=engine)
     thisSession = Session()
-    metadata = MetaData()
-    metadata.bind = engine
+    metadata = load_metadata(engine, schema_cache_dir)
     Base = declarative_base()
     return thisSession, metadata, Base
 
@@ -248,52 +385,233 @@ def parse_cmdline_args():
     parser.add_argument("--older-than",
                         type=int,
                         help="how many days of marked as deleted entries to keep")
+    parser.add_argument("--purge-batch-size",
+                        type=int,
+                        default=DEFAULT_BATCH_SIZE,
+                        help="maximum number of deleted rows to purge per statement and transaction")
+    parser.add_argument("--purge-pause",
+                        type=float,
+                        default=0.5,
+                        help="seconds to wait in between two purge chunks")
+    parser.add_argument("--purge-max-rows",
+                        type=int,
+                        help="maximum number of deleted rows to purge per run - the rest is left for the next runs")
+    parser.add_argument("--estimate-days",
+                        type=lambda days: [int(d) for d in days.split(',')],
+                        default=list(DEFAULT_ESTIMATE_DAYS),
+                        help="comma separated ages in days to estimate the rows to purge for in a dry run - only for tables with an index on deleted_at")
+    parser.add_argument("--archive",
+                        action="store_true",
+                        help="move the deleted rows to the shadow tables in chunks instead of deleting them")
+    parser.add_argument("--archive-parallel",
+                        type=int,
+                        default=1,
+                        help="with --archive archive up to this many tables without foreign keys between them in parallel")
     parser.add_argument("--max-instance-faults",
                         type=int,
                         help="how many instance faults entries to keep")
+    parser.add_argument("--set-based-instance-faults",
+                        action="store_true",
+                        help="purge the instance faults for pages of instances with only the ids of the surplus faults "
+                        "and delete them in batches of --purge-batch-size")
     parser.add_argument("--fix-limit",
                         default=25,
                         help="maximum number of inconsistencies to fix automatically - if there are more, "
                         "automatic fixing is denied")
+    parser.add_argument("--count-first",
+                        action="store_true",
+                        help="fetch at most fix-limit + 1 wrong block device mappings - if there are more, "
+                        "only a sample is shown and fixing is denied")
+    parser.add_argument("--schema-cache-dir",
+                        help="directory to cache the reflected db schema in between runs")
+    parser.add_argument("--inventory-page-size",
+                        type=int,
+                        default=DEFAULT_PAGE_SIZE,
+                        help="number of volumes to request per page from the cinder api")
+    parser.add_argument("--db-anti-join",
+                        action="store_true",
+                        help="find wrong block device mappings in the db against a temporary table of the cinder volume uuids")
+    parser.add_argument("--cinder-db-url",
+                        default=os.getenv('CINDER_DB_URL'),
+                        help="read-only connection string of the cinder db to read the cinder volumes from instead of the cinder api")
+    parser.add_argument("--nova-api-db-url",
+                        default=os.getenv('NOVA_API_DB_URL'),
+                        help="read-only connection string of the nova api db to read the cell mappings from with --all-cells")
+    parser.add_argument("--all-cells",
+                        action="store_true",
+                        help="run the purges and checks against the dbs of all cells from the cell mappings concurrently")
+    parser.add_argument("--daemon",
+                        action="store_true",
+                        help="keep running and repeat the purges and checks every interval seconds")
+    parser.add_argument("--interval",
+                        type=float,
+                        default=3600,
+                        help="seconds to wait between the runs in daemon mode")
+    parser.add_argument("--prom-port",
+                        type=int,
+                        default=9000,
+                        help="prometheus exporter port in daemon mode")
+    parser.add_argument("--pushgateway",
+                        default=os.getenv('PROMETHEUS_PUSHGATEWAY'),
+                        help="prometheus pushgateway to push the metrics of a run to when not in daemon mode")
     return parser.parse_args()
 
 
-def main():
-    try:
-        args = parse_cmdline_args()
-    except Exception as e:
-        log.error("Check command line arguments (%s)", e.strerror)
-
-    # connect to openstack
-    conn = makeOsConnection()
-
-    # connect to the DB
-    db_url = get_db_url(args.config)
-    nova_session, nova_metadata, nova_Base = makeConnection(db_url)
+# purge old deleted rows and instance faults
+def purge_deleted_rows(session, meta, args, purger):
 
+    # the purges are skipped in a dry run - only estimate the rows they would purge per age
+    if args.dry_run:
+        estimate_deleted_rows(purger, meta, args.estimate_days)
     if args.older_than and not args.dry_run:
-        purge_block_device_mappings(nova_metadata, args.older_than)
-        purge_reservations(nova_metadata, args.older_than)
-        purge_instance_id_mappings(nova_metadata, args.older_than)
-        # purge_instance_system_metadata(nova_metadata, args.older_than)
+        # the deleted rows are purged in small chunks and at most --purge-max-rows of them per run
+        purger.start_run()
+        if args.archive:
+            archive_deleted_rows(purger, meta, args.older_than, args.archive_parallel)
+        else:
+            purge_block_device_mappings(purger, meta, args.older_than)
+            purge_reservations(purger, meta, args.older_than)
+            purge_instance_id_mappings(purger, meta, args.older_than)
+        # purge_instance_system_metadata(meta, args.older_than)
     if args.max_instance_faults and not args.dry_run:
-        purge_instance_faults(nova_session, nova_metadata, args.max_instance_faults)
-    block_device_mappings = get_block_device_mappings(nova_metadata)
-    cinder_volumes = get_cinder_volumes(conn)
-    wrong_block_device_mappings = get_wrong_block_device_mappings(cinder_volumes, block_device_mappings)
+        if args.set_based_instance_faults:
+            purge_instance_faults_set_based(meta, args.max_instance_faults, args.purge_batch_size)
+        else:
+            purge_instance_faults(session, meta, args.max_instance_faults)
+
+
+# check and fix block device mappings for already deleted volumes in cinder
+# - the cinder volumes and block device mappings already read for all cells can be passed in
+def check_block_device_mappings(meta, args, conn, cinder_volumes=None, block_device_mappings=None):
+
+    # with --count-first at most one more finding than fix_limit is fetched - enough to know that fixing is denied
+    finding_limit = int(args.fix_limit) + 1 if args.count_first else None
+    if args.db_anti_join:
+        if cinder_volumes is None:
+            cinder_volumes = get_cinder_volumes(conn, args.inventory_page_size, args.cinder_db_url)
+        wrong_block_device_mappings = get_wrong_block_device_mappings_db(meta, cinder_volumes, limit=finding_limit)
+    else:
+        # the block device mappings have to be read before the cinder volumes, so that a volume created
+        # in between is never taken for a deleted one
+        if block_device_mappings is None:
+            block_device_mappings = get_block_device_mappings(meta)
+        if cinder_volumes is None:
+            cinder_volumes = get_cinder_volumes(conn, args.inventory_page_size, args.cinder_db_url)
+        wrong_block_device_mappings = get_wrong_block_device_mappings(cinder_volumes, block_device_mappings, finding_limit)
     if len(wrong_block_device_mappings) != 0:
         log.info("- block device mapping inconsistencies found:")
+        if finding_limit and len(wrong_block_device_mappings) >= finding_limit:
+            log.warn("- PLEASE CHECK MANUALLY - more than %s block device mapping inconsistencies found - "
+                     "only showing a sample of them", str(args.fix_limit))
         # print out what we would delete
         for block_device_mapping_id in wrong_block_device_mappings:
             log.info("-- block device mapping (id in nova db: %s) for non existent volume in cinder: %s",
                      block_device_mapping_id,
-                     block_device_mappings[block_device_mapping_id])
+                     wrong_block_device_mappings[block_device_mapping_id])
         if not args.dry_run:
             log.info("- deleting block device mapping inconsistencies found")
-            fix_wrong_block_device_mappings(nova_metadata, wrong_block_device_mappings, args.fix_limit)
+            fix_wrong_block_device_mappings(meta, wrong_block_device_mappings, args.fix_limit)
     else:
         log.info("- block device mappings are consistent")
 
+    return len(wrong_block_device_mappings)
+
+
+# run the purges and checks once and return them with their results
+def run_consistency_checks(args, conn, nova_session, nova_metadata, purger):
+
+    checks = [
+        Check('purge', partial(purge_deleted_rows, nova_session, nova_metadata, args, purger)),
+        Check('block device mappings', partial(check_block_device_mappings, nova_metadata, args, conn)),
+    ]
+    run_checks(checks)
+
+    # end the transaction the session query of the instance faults purge has started - in daemon mode
+    # the next run would otherwise still read from its snapshot
+    nova_session.close()
+    save_metadata(nova_metadata)
+    return checks
+
+
+# run the purges and checks against the dbs of all cells concurrently with one worker per cell - the cinder
+# volumes are fetched only once for all of them
+def run_consistency_checks_all_cells(args, conn, cells):
+
+    # read the block device mappings of all cells before the cinder volumes
+    block_device_mappings = {}
+    if not args.db_anti_join:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(cells), thread_name_prefix='cell') as executor:
+            futures = {cell_name: executor.submit(get_block_device_mappings, cell_metadata)
+                       for cell_name, (_, cell_metadata, _) in cells.items()}
+        block_device_mappings = {cell_name: future.result() for cell_name, future in futures.items()}
+    cinder_volumes = get_cinder_volumes(conn, args.inventory_page_size, args.cinder_db_url)
+
+    checks = []
+    for cell_name, (cell_session, cell_metadata, cell_purger) in cells.items():
+        # the checks of a cell run one after the other, the ones of different cells concurrently
+        checks += [
+            Check(f'{cell_name} purge',
+                  partial(purge_deleted_rows, cell_session, cell_metadata, args, cell_purger),
+                  writes=[cell_name]),
+            Check(f'{cell_name} block device mappings',
+                  partial(check_block_device_mappings, cell_metadata, args, conn, cinder_volumes,
+                          block_device_mappings.get(cell_name)),
+                  writes=[cell_name]),
+        ]
+    run_checks(checks, len(cells))
+
+    for cell_name, (cell_session, cell_metadata, _) in cells.items():
+        cell_session.close()
+        save_metadata(cell_metadata)
+
+    # report the results per cell
+    for check in checks:
+        if check.result is not None:
+            log.info("- %s: %s inconsistencies found", check.name, check.result)
+    return checks
+
+
+def main():
+    try:
+        args = parse_cmdline_args()
+    except Exception as e:
+        log.error("Check command line arguments (%s)", e.strerror)
+
+    # connect to openstack
+    conn = makeOsConnection()
+
+    # the purger and its metrics are kept for all the runs in daemon mode
+    purger = DbPurger('nova', args.purge_batch_size, args.purge_pause, args.purge_max_rows, cells=args.all_cells)
+
+    if args.all_cells:
+        if not args.nova_api_db_url:
+            log.error("- the cell mappings can only be read with --nova-api-db-url")
+            sys.exit(1)
+        # connect to the DB of each cell - with its own engine and connection pool
+        cells = {}
+        for cell_name, cell_db_url in sorted(get_nova_cell_db_urls(args.nova_api_db_url).items(),
+                                             key=lambda cell: str(cell[0])):
+            cell_session, cell_metadata, cell_Base = makeConnection(cell_db_url, args.schema_cache_dir)
+            cells[str(cell_name)] = (cell_session, cell_metadata, purger.for_cell(str(cell_name)))
+        log.info("- checking the %s cells %s", len(cells), ", ".join(cells))
+        run_once = partial(run_consistency_checks_all_cells, args, conn, cells)
+    else:
+        # connect to the DB
+        db_url = get_db_url(args.config)
+        nova_session, nova_metadata, nova_Base = makeConnection(db_url, args.schema_cache_dir)
+        run_once = partial(run_consistency_checks, args, conn, nova_session, nova_metadata, purger)
+
+    if args.daemon:
+        # keep the openstack connection, the db engines and the reflected tables for all the runs
+        ConsistencyDaemon('nova', run_once, args.interval, args.prom_port).run()
+    else:
+        try:
+            run_once()
+        finally:
+            # the metrics of a one-shot run, e.g. the purge rates, would otherwise never be scraped
+            if args.pushgateway:
+                prometheus_push(args.pushgateway, 'nova_nanny_consistency')
+
 
 if __name__ == "__main__":
     main()
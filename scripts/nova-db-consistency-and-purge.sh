@@ -40,6 +40,71 @@ else
   cp -f /etc/nova/nova.conf.d/cell1.conf /etc/nova/nova.conf.d/db-to-cleanup.conf
 fi
 
+# the reflected db schema is cached here in between the loop runs
+SCHEMA_CACHE_DIR="/tmp/nova-nanny-schema-cache"
+
+# the deleted rows are purged in chunks of NOVA_CONSISTENCY_PURGE_BATCH_SIZE rows with a pause of
+# NOVA_CONSISTENCY_PURGE_PAUSE seconds in between and at most NOVA_CONSISTENCY_PURGE_MAX_ROWS rows per run
+CONSISTENCY_ARGS="--purge-pause ${NOVA_CONSISTENCY_PURGE_PAUSE:-0.5}"
+if [ "$NOVA_CONSISTENCY_PURGE_BATCH_SIZE" != "" ]; then
+    CONSISTENCY_ARGS="$CONSISTENCY_ARGS --purge-batch-size $NOVA_CONSISTENCY_PURGE_BATCH_SIZE"
+fi
+if [ "$NOVA_CONSISTENCY_PURGE_MAX_ROWS" != "" ]; then
+    CONSISTENCY_ARGS="$CONSISTENCY_ARGS --purge-max-rows $NOVA_CONSISTENCY_PURGE_MAX_ROWS"
+fi
+
+# in a dry run the rows to purge are estimated for these ages in days instead
+if [ "$NOVA_CONSISTENCY_ESTIMATE_DAYS" != "" ]; then
+    CONSISTENCY_ARGS="$CONSISTENCY_ARGS --estimate-days $NOVA_CONSISTENCY_ESTIMATE_DAYS"
+fi
+
+# move the deleted rows to the shadow tables instead of deleting them - up to NOVA_CONSISTENCY_ARCHIVE_PARALLEL
+# tables at a time
+if [ "$NOVA_CONSISTENCY_ARCHIVE" = "True" ] || [ "$NOVA_CONSISTENCY_ARCHIVE" = "true" ]; then
+    CONSISTENCY_ARGS="$CONSISTENCY_ARGS --archive --archive-parallel ${NOVA_CONSISTENCY_ARCHIVE_PARALLEL:-1}"
+fi
+
+# trim the instance faults set based in batches instead of one delete per surplus fault
+if [ "$NOVA_CONSISTENCY_SET_BASED_INSTANCE_FAULTS" = "True" ] || [ "$NOVA_CONSISTENCY_SET_BASED_INSTANCE_FAULTS" = "true" ]; then
+    CONSISTENCY_ARGS="$CONSISTENCY_ARGS --set-based-instance-faults"
+fi
+
+# check the dbs of all cells from the cell mappings in the nova api db (NOVA_API_DB_URL) concurrently and
+# fetch the cinder volumes only once for all of them instead of the single db-to-cleanup db
+if [ "$NOVA_CONSISTENCY_ALL_CELLS" = "True" ] || [ "$NOVA_CONSISTENCY_ALL_CELLS" = "true" ]; then
+    CONSISTENCY_ARGS="$CONSISTENCY_ARGS --all-cells"
+fi
+
+# in daemon mode the consistency check is started only once and keeps its connections and
+# reflected tables in between its runs - the loop below then only takes care of the other jobs
+if [ "$NOVA_CONSISTENCY_ENABLED" = "True" ] || [ "$NOVA_CONSISTENCY_ENABLED" = "true" ]; then
+    if [ "$NOVA_CONSISTENCY_DAEMON" = "True" ] || [ "$NOVA_CONSISTENCY_DAEMON" = "true" ]; then
+        if [ "$NOVA_CONSISTENCY_DRY_RUN" = "False" ] || [ "$NOVA_CONSISTENCY_DRY_RUN" = "false" ]; then
+            DAEMON_ARGS=""
+            if [ "$NOVA_CONSISTENCY_OLDER_THAN" != "" ]; then
+                DAEMON_ARGS="$DAEMON_ARGS --older-than $NOVA_CONSISTENCY_OLDER_THAN"
+            fi
+            if [ "$NOVA_CONSISTENCY_MAX_INSTANCE_FAULTS" != "" ]; then
+                DAEMON_ARGS="$DAEMON_ARGS --max-instance-faults $NOVA_CONSISTENCY_MAX_INSTANCE_FAULTS"
+            fi
+            if [ "$NOVA_CONSISTENCY_FIX_LIMIT" != "" ]; then
+                DAEMON_ARGS="$DAEMON_ARGS --fix-limit $NOVA_CONSISTENCY_FIX_LIMIT"
+            fi
+        else
+            DAEMON_ARGS="--dry-run"
+        fi
+        echo "INFO: starting the nova db consistency check daemon"
+        # restart the daemon should it ever exit - the loop below does not run the check anymore
+        while true; do
+            python3 /scripts/nova-consistency.py --config /etc/nova/nova.conf.d/db-to-cleanup.conf --schema-cache-dir "${SCHEMA_CACHE_DIR}" --daemon --interval $(( 60 * $NOVA_NANNY_INTERVAL )) --prom-port ${NOVA_CONSISTENCY_PROMETHEUS_PORT:-9000} $DAEMON_ARGS $CONSISTENCY_ARGS || true
+            echo -n "WARNING: the consistency check daemon exited - restarting it in a minute - "
+            date
+            sleep 60
+        done &
+        NOVA_CONSISTENCY_ENABLED="false"
+    fi
+fi
+
 # we run an endless loop to run the script periodically
 echo "INFO: starting a loop to periodically run the nanny job for the nova db concistency check and purge"
 while true; do
@@ -62,11 +127,11 @@ while true; do
             fi
             echo -n "INFO: checking and fixing nova db consistency - "
             date
-            python3 /scripts/nova-consistency.py --config /etc/nova/nova.conf.d/db-to-cleanup.conf $OLDER_THAN $MAX_INSTANCE_FAULTS $FIX_LIMIT
+            python3 /scripts/nova-consistency.py --config /etc/nova/nova.conf.d/db-to-cleanup.conf --schema-cache-dir "${SCHEMA_CACHE_DIR}" $OLDER_THAN $MAX_INSTANCE_FAULTS $FIX_LIMIT $CONSISTENCY_ARGS
         else
             echo -n "INFO: checking nova db consistency - "
             date
-            python3 /scripts/nova-consistency.py --config /etc/nova/nova.conf.d/db-to-cleanup.conf --dry-run
+            python3 /scripts/nova-consistency.py --config /etc/nova/nova.conf.d/db-to-cleanup.conf --schema-cache-dir "${SCHEMA_CACHE_DIR}" --dry-run $CONSISTENCY_ARGS
         fi
     fi
     if [ "$NOVA_QUEENS_INSTANCE_MAPPING_ENABLED" = "True" ] || [ "$NOVA_QUEENS_INSTANCE_MAPPING_ENABLED" = "true" ]; then